@@ -4,7 +4,7 @@ import logging
 import asyncio
 from datetime import datetime, timezone, timedelta
 from uuid import uuid4
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Awaitable, Callable, Union, NamedTuple, Tuple, Iterable
 from enum import Enum
 import numpy as np
 import matplotlib.pyplot as plt
@@ -12,15 +12,17 @@ import re
 import copy
 from contextlib import asynccontextmanager
 import time
+import hashlib
 from fastapi import FastAPI, HTTPException, Depends, Header, status, Request, Query
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.responses import StreamingResponse
-from pydantic import BaseModel, Field, ConfigDict
+from pydantic import BaseModel, Field, ConfigDict, PrivateAttr, model_validator
+from pydantic_core import to_jsonable_python
 from dotenv import load_dotenv
 import ollama
 import motor.motor_asyncio
-from neo4j import GraphDatabase, exceptions as neo4j_exceptions
+from neo4j import exceptions as neo4j_exceptions
 from langchain_mistralai.embeddings import MistralAIEmbeddings
 from langchain_core.embeddings import Embeddings as LangChainEmbeddings
 from together_ai import TogetherAIClient
@@ -32,18 +34,28 @@ from collections import defaultdict
 import io
 from prompt_manager import PromptManager
 from response_validator import ResponseValidator
-from asyncio import Lock
+from caching import EmbeddingCache, LRUCache
+from neo4j_async import Neo4jClient, as_prerequisite_chain, as_concept_relations
+from kg_cache import (KGVersionTracker, RagContextCache, ChunkVectorIndex, ChapterCatalog,
+                      KG_VERSION_QUERY, CHUNK_EMBEDDINGS_QUERY, CHAPTER_CATALOG_QUERY,
+                      TOPIC_CHAPTER_MAP_QUERY, KGSchema, KG_SCHEMA_QUERY)
+from question_bank import QuestionBank
+from interaction_store import InteractionStore, PATH_PROJECTION
+from session_store import SessionStore, VERSION_FIELD
+from state_vectors import (TopicVector, current_layout, ensure_layout, expand_vectors, pack_vectors, sync_layouts,
+                           unpack_vectors)
+from pre_grader import PreGrader
+from embedding_service import EmbeddingService, TokenBucket, warm_topic_query_embeddings, topic_query_embeddings_path
 import seaborn as sns
 import random
 import collections
-from pymongo.errors import OperationFailure
 
 try:
     from ncert_tutor import (
         NCERTLearningSystem, TeachingStrategies as NCERTTeachingStrategies,
         LearningStyles as NCERTLearningStyles, DifficultyLevel as NCERTDifficultyLevel,
         ScaffoldingLevel as NCERTScaffoldingLevel, FeedbackType as NCERTFeedbackType,
-        ContentLength as NCERTContentLength
+        ContentLength as NCERTContentLength, compute_topic_mask, build_action_mask
     )
     if hasattr(NCERTTeachingStrategies, '__members__'):
         NUM_STRATEGIES = len(NCERTTeachingStrategies.__members__)
@@ -116,8 +128,6 @@ except ImportError as e:
         "Cannot load model, SB3 unavailable."); return None
 
 load_dotenv()
-embedding_lock = Lock()
-embedding_cache = {}
 API_VERSION = "0.7.1"
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
 RL_MODEL_PATH = os.environ.get("RL_MODEL_PATH")
@@ -161,8 +171,23 @@ rl_system: Optional[NCERTLearningSystem] = None
 ollama_client: Optional[ollama.AsyncClient] = None
 mongo_client: Optional[motor.motor_asyncio.AsyncIOMotorClient] = None
 learning_db: Optional[motor.motor_asyncio.AsyncIOMotorDatabase] = None
-neo4j_driver: Optional[GraphDatabase.driver] = None
+neo4j_client: Optional[Neo4jClient] = None
 embedding_client: Optional[LangChainEmbeddings] = None
+embedding_cache: Optional[EmbeddingCache] = None
+embedding_service: Optional[EmbeddingService] = None
+embedding_warmup_task: Optional[asyncio.Task] = None
+kg_version_tracker: Optional[KGVersionTracker] = None
+rag_context_cache: Optional[RagContextCache] = None
+chunk_vector_index: Optional[ChunkVectorIndex] = None
+chunk_index_task: Optional[asyncio.Task] = None
+chapter_catalog: Optional[ChapterCatalog] = None
+kg_schema: Optional[KGSchema] = None
+exercise_generator: Optional["ExerciseGenerator"] = None
+assessment_engine: Optional["AssessmentEngine"] = None
+question_bank: Optional[QuestionBank] = None
+interaction_store: Optional[InteractionStore] = None
+interaction_migration_task: Optional[asyncio.Task] = None
+session_store: Optional[SessionStore] = None
 
 
 class InteractionMetadata(BaseModel):
@@ -201,17 +226,24 @@ class StudentProfile(BaseModel):
     )
 
 
+# Per-topic maps of StudentState, stored packed as float32 vectors (see state_vectors).
+TOPIC_VECTOR_FIELDS = ("mastery", "topic_attempts", "last_practiced_step", "misconceptions", "previous_mastery")
+
+
 class StudentState(BaseModel):
-    mastery: Dict[str, float] = Field(default_factory=dict)
+    mastery: TopicVector = Field(default_factory=TopicVector)
     recent_performance: float = Field(default=0.5, ge=0.0, le=1.0)
     engagement: float = Field(default=0.7, ge=0.0, le=1.0)
     motivation: float = Field(default=0.7, ge=0.0, le=1.0)
 
-    topic_attempts: Dict[str, float] = Field(default_factory=dict)
-    time_since_last_practiced: Dict[str, float] = Field(default_factory=dict)
-    misconceptions: Dict[str, float] = Field(default_factory=dict)
+    topic_attempts: TopicVector = Field(default_factory=TopicVector)
+    # Interactions so far and the step each topic was last practiced at; time since
+    # practice is derived from the two, so an interaction changes one topic entry.
+    interaction_counter: int = Field(default=0)
+    last_practiced_step: TopicVector = Field(default_factory=TopicVector)
+    misconceptions: TopicVector = Field(default_factory=TopicVector)
 
-    previous_mastery: Dict[str, float] = Field(default_factory=dict)
+    previous_mastery: TopicVector = Field(default_factory=TopicVector)
     strategy_history_vector: List[float] = Field(
         default_factory=lambda: [0.0] * NUM_STRATEGIES)
     current_topic_idx_persistent: int = Field(default=-1)
@@ -220,6 +252,47 @@ class StudentState(BaseModel):
     cognitive_load: float = Field(default=0.4, ge=0.0, le=1.0)
     attention: float = Field(default=0.8, ge=0.0, le=1.0)
 
+    # The state as read from Mongo when it was stored in an older shape or layout; the next save rewrites it.
+    _stored_form: Optional[Dict[str, Any]] = PrivateAttr(default=None)
+
+    @model_validator(mode="wrap")
+    @classmethod
+    def _from_stored_form(cls, data: Any, handler) -> "StudentState":
+        """Accept the packed stored form as well as older ones (string-keyed maps, time-since counters)."""
+        stored_form = None
+        if isinstance(data, dict):
+            vectors = data.get("vectors")
+            if ("time_since_last_practiced" in data
+                    or any(isinstance(data.get(name), dict) for name in TOPIC_VECTOR_FIELDS)
+                    or (isinstance(vectors, dict) and vectors.get("layout") != current_layout().version)):
+                stored_form = data
+            data = dict(data)
+            legacy = data.pop("time_since_last_practiced", None) or {}
+            if isinstance(vectors, dict):
+                del data["vectors"]
+                data.update(unpack_vectors(vectors, TOPIC_VECTOR_FIELDS))
+            elif legacy and "last_practiced_step" not in data:
+                counter = int(np.ceil(max(legacy.values(), default=0.0)))
+                data["interaction_counter"] = counter
+                data["last_practiced_step"] = {t: counter - v for t, v in legacy.items()}
+        state = handler(data)
+        state._stored_form = stored_form
+        return state
+
+    def packed(self) -> Dict[str, Any]:
+        """Stored form: scalar fields as JSON, per-topic maps as float32 vectors in the current layout."""
+        doc = self.model_dump(mode='json', exclude=set(TOPIC_VECTOR_FIELDS))
+        doc["vectors"] = pack_vectors({name: getattr(self, name) for name in TOPIC_VECTOR_FIELDS})
+        return doc
+
+    def mark_practiced(self, topic: str):
+        self.last_practiced_step[topic] = float(self.interaction_counter)
+
+    def time_since_practiced(self, topic: str) -> Optional[float]:
+        """Interactions since `topic` was last practiced, or None if it never was."""
+        step = self.last_practiced_step.get(topic)
+        return None if step is None else max(0.0, self.interaction_counter - step)
+
     def update_core_metrics_from_assessment(self,
                                             topic: str,
                                             score: float,
@@ -278,7 +351,7 @@ class StudentState(BaseModel):
 
         self.topic_attempts[topic] = self.topic_attempts.get(topic, 0.0) + 1.0
 
-        self.time_since_last_practiced[topic] = 0.0
+        self.mark_practiced(topic)
 
         return gain
 
@@ -307,7 +380,7 @@ class StudentState(BaseModel):
 
         self.topic_attempts[topic] = self.topic_attempts.get(topic, 0.0) + 1.0
 
-        self.time_since_last_practiced[topic] = 0.0
+        self.mark_practiced(topic)
 
         if helpful_rating is not None:
             norm_rating = (helpful_rating - 1) / 4.0
@@ -324,6 +397,58 @@ class StudentState(BaseModel):
         return gain
 
 
+_UNSET = object()
+# Depth of nested dicts diffed key by key (e.g. state.mastery.<topic>); deeper changes set the whole value.
+SESSION_DIFF_DEPTH = 3
+
+
+def _is_safe_mongo_key(key: Any) -> bool:
+    return isinstance(key, str) and bool(key) and "." not in key and not key.startswith("$")
+
+
+def _collect_field_changes(path: str, old: Any, new: Any, sets: Dict[str, Any], unsets: Dict[str, str],
+                           depth: int):
+    if old == new:
+        return
+    if (depth > 1 and isinstance(old, dict) and isinstance(new, dict)
+            and all(_is_safe_mongo_key(k) for k in old.keys() | new.keys())):
+        for key, value in new.items():
+            _collect_field_changes(f"{path}.{key}", old.get(key, _UNSET), value, sets, unsets, depth - 1)
+        for key in old.keys() - new.keys():
+            unsets[f"{path}.{key}"] = ""
+        return
+    sets[path] = new
+
+
+class SessionDelta(NamedTuple):
+    sets: Dict[str, Any]
+    unsets: Dict[str, str]
+    # (interaction_id, entry) pairs for already-stored learning_path entries that changed.
+    entry_updates: List[Tuple[str, Dict[str, Any]]]
+    new_entries: List[Dict[str, Any]]
+    path_length: int
+    # Entries were dropped from the front, so the stored path needs slicing even without appends.
+    trimmed: bool
+    # Set instead of the above when the path cannot be expressed as edits + appends.
+    full_path: Optional[List[Dict[str, Any]]]
+    stored: Dict[str, Any]
+
+    @property
+    def empty(self) -> bool:
+        return not (self.sets or self.unsets or self.entry_updates or self.new_entries or self.trimmed
+                    or self.full_path is not None)
+
+
+def find_path_entry(learning_path: List[Dict[str, Any]], interaction_id: Optional[str] = None,
+                    assessment_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    for entry in reversed(learning_path):
+        if isinstance(entry, dict) and (
+                (interaction_id and entry.get("interaction_id") == interaction_id)
+                or (assessment_id and entry.get("assessment_id") == assessment_id)):
+            return entry
+    return None
+
+
 class StudentSessionData(BaseModel):
     student_id: str
     profile: StudentProfile
@@ -334,6 +459,105 @@ class StudentSessionData(BaseModel):
         default_factory=lambda: datetime.now(timezone.utc))
     learning_path: List[Dict[str, Any]] = Field(default_factory=list)
     analytics: Dict[str, Any] = Field(default_factory=dict)
+    # Set once the whole learning_path has been copied into the interactions collection (see interaction_store).
+    interactions_migrated: bool = False
+
+    # Stored form of the document as of the last load/save, used to compute delta saves.
+    _stored: Optional[Dict[str, Any]] = PrivateAttr(default=None)
+    # Document version the snapshot corresponds to (see session_store).
+    _version: int = PrivateAttr(default=0)
+
+    def persisted_document(self, exclude: Optional[set] = None) -> Dict[str, Any]:
+        """The session as stored in Mongo: JSON-mode fields, with the state's per-topic maps packed."""
+        doc = self.model_dump(mode='json', exclude={'state', *(exclude or ())})
+        doc['state'] = self.state.packed()
+        return doc
+
+    def _tracked_fields(self) -> Dict[str, Any]:
+        return self.persisted_document(exclude={'student_id', 'created_at', 'learning_path'})
+
+    def mark_persisted(self, stored_learning_path: Optional[List[Dict[str, Any]]] = None,
+                       version: Optional[int] = None):
+        """Snapshot the current values as stored; later saves only write what differs from this.
+
+        `stored_learning_path` is the path exactly as read from Mongo (entries are compared
+        at their top level, so callers should not mutate nested values in place).
+        """
+        stored = self._tracked_fields()
+        if self.state._stored_form is not None:
+            # Diff against the state as it is stored, so the next save rewrites it in the current form.
+            stored['state'] = self.state._stored_form
+            self.state._stored_form = None
+        stored['learning_path'] = list(stored_learning_path if stored_learning_path is not None
+                                       else to_jsonable_python(self.learning_path))
+        self._stored = stored
+        if version is not None:
+            self._version = version
+
+    @property
+    def is_tracked(self) -> bool:
+        return self._stored is not None
+
+    @property
+    def persisted_version(self) -> int:
+        return self._version
+
+    def persistence_delta(self) -> SessionDelta:
+        """Changes since `mark_persisted`, expressed as field sets/unsets plus learning_path edits and appends."""
+        if self._stored is None:
+            raise ValueError("Session has no persisted snapshot; save it in full first.")
+        current = self._tracked_fields()
+        sets: Dict[str, Any] = {}
+        unsets: Dict[str, str] = {}
+        for key in (current.keys() | self._stored.keys()) - {'learning_path'}:
+            _collect_field_changes(key, self._stored.get(key, _UNSET), current.get(key, _UNSET),
+                                   sets, unsets, SESSION_DIFF_DEPTH)
+        for path in [p for p, v in sets.items() if v is _UNSET]:
+            del sets[path]
+            unsets[path] = ""
+
+        stored_path = self._stored['learning_path']
+        path = self.learning_path
+        stored_ids = [e.get('interaction_id') if isinstance(e, dict) else None for e in stored_path]
+        # Entries dropped from the front (prune_learning_path) are what $push's $slice removes anyway.
+        offset = len(stored_path)
+        if path and path[0].get('interaction_id') in stored_ids:
+            offset = stored_ids.index(path[0].get('interaction_id'))
+        kept = len(stored_path) - offset
+
+        new_stored_path: List[Dict[str, Any]] = []
+        entry_updates: List[Tuple[str, Dict[str, Any]]] = []
+        full_path = None
+        if (not path and stored_path) or kept > len(path) \
+                or [e.get('interaction_id') for e in path[:kept]] != stored_ids[offset:]:
+            full_path = to_jsonable_python(path)
+            new_stored_path = full_path
+        else:
+            for entry, stored_entry in zip(path[:kept], stored_path[offset:]):
+                if entry == stored_entry:
+                    new_stored_path.append(stored_entry)
+                    continue
+                interaction_id = entry.get('interaction_id')
+                if not interaction_id or stored_ids.count(interaction_id) > 1:
+                    full_path = to_jsonable_python(path)
+                    new_stored_path = full_path
+                    entry_updates = []
+                    break
+                stored_entry = to_jsonable_python(entry)
+                entry_updates.append((interaction_id, stored_entry))
+                new_stored_path.append(stored_entry)
+        new_entries = [] if full_path is not None else to_jsonable_python(path[kept:])
+        if full_path is None:
+            new_stored_path.extend(new_entries)
+
+        stored = dict(current, learning_path=new_stored_path)
+        return SessionDelta(sets, unsets, entry_updates, new_entries, len(path),
+                            full_path is None and offset > 0, full_path, stored)
+
+    def commit_persisted(self, delta: SessionDelta, version: Optional[int] = None):
+        self._stored = delta.stored
+        if version is not None:
+            self._version = version
 
     def detect_stagnation(self, topic: str, threshold: int = 3) -> bool:
         """Detect if student is stuck on a topic despite multiple attempts"""
@@ -346,7 +570,7 @@ class StudentSessionData(BaseModel):
     def prune_learning_path(self, max_entries: int = 100):
         """Keep learning path from growing too large"""
         if len(self.learning_path) > max_entries:
-            self.learning_path = self.learning_path[-max_entries:]
+            self.learning_path = self.learning_path[-max_entries:] if max_entries > 0 else []
 
     def update_analytics(self, topic: str = None):
         """Compute analytics on-demand rather than storing everything"""
@@ -369,11 +593,16 @@ class StudentSessionData(BaseModel):
         self.prune_learning_path()
         return interaction_log
 
+    def find_path_entry(self, interaction_id: Optional[str] = None,
+                        assessment_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Look up an entry in the recent learning_path tail; older ones live in the interactions collection."""
+        return find_path_entry(self.learning_path, interaction_id, assessment_id)
+
     def update_from_assessment(self,
                                assessment_id: str,
                                topic: str,
                                score: float,
-                               responses: List[Dict[str, Any]]) -> Dict[str, float]:
+                               responses: List[Dict[str, Any]]) -> Dict[str, Any]:
         """Update metrics from assessment results and return delta values"""
         mastery_before = self.state.mastery.get(topic, 0.0)
         motivation_before = self.state.motivation
@@ -385,38 +614,38 @@ class StudentSessionData(BaseModel):
             score=score
         )
 
-        for i, interaction in enumerate(self.learning_path):
-            if isinstance(interaction, dict) and interaction.get("assessment_id") == assessment_id:
-                self.learning_path[i].update({
-                    "completed": True,
-                    "score": score,
-                    "mastery_before_assessment": mastery_before,
-                    "mastery_after_assessment": self.state.mastery.get(topic, 0.0),
-                    "mastery_gain": mastery_gain,
-                    "completed_at": datetime.now(timezone.utc).isoformat(),
-                    "response_count": len(responses)
-                })
-                break
+        interaction_update = {
+            "completed": True,
+            "score": score,
+            "mastery_before_assessment": mastery_before,
+            "mastery_after_assessment": self.state.mastery.get(topic, 0.0),
+            "mastery_gain": mastery_gain,
+            "completed_at": datetime.now(timezone.utc).isoformat(),
+            "response_count": len(responses)
+        }
+        entry = self.find_path_entry(assessment_id=assessment_id)
+        if entry is not None:
+            entry.update(interaction_update)
 
         self.update_analytics(topic)
 
         return {
             "mastery_gain": mastery_gain,
             "motivation_delta": self.state.motivation - motivation_before,
-            "engagement_delta": self.state.engagement - engagement_before
+            "engagement_delta": self.state.engagement - engagement_before,
+            "interaction_update": interaction_update
         }
 
     def update_from_content_feedback(self,
                                      interaction_id: str,
-                                     feedback_data: SessionFeedback) -> Dict[str, float]:
-        """Update metrics based on content feedback and return delta values"""
-        interaction = None
-        idx = -1
-        for i, log in enumerate(self.learning_path):
-            if isinstance(log, dict) and log.get("interaction_id") == interaction_id:
-                interaction = log
-                idx = i
-                break
+                                     feedback_data: SessionFeedback,
+                                     interaction: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Update metrics based on content feedback and return delta values.
+
+        `interaction` is the stored entry for interactions no longer in the recent tail.
+        """
+        entry = self.find_path_entry(interaction_id=interaction_id)
+        interaction = entry if entry is not None else interaction
 
         if not interaction:
             return {"error": "Interaction not found"}
@@ -439,21 +668,22 @@ class StudentSessionData(BaseModel):
             time_spent_seconds=feedback_data.time_spent_seconds
         )
 
-        if idx >= 0:
-            details = feedback_data.model_dump()
-            details["feedback_received_utc"] = datetime.now(
-                timezone.utc).isoformat()
-            details["mastery_after_feedback"] = self.state.mastery.get(
-                topic, 0.0)
-            details["mastery_gain_from_feedback"] = mastery_gain
-            self.learning_path[idx].update(details)
+        details = feedback_data.model_dump()
+        details["feedback_received_utc"] = datetime.now(
+            timezone.utc).isoformat()
+        details["mastery_after_feedback"] = self.state.mastery.get(
+            topic, 0.0)
+        details["mastery_gain_from_feedback"] = mastery_gain
+        if entry is not None:
+            entry.update(details)
 
         self.update_analytics(topic)
 
         return {
             "mastery_gain": mastery_gain,
             "motivation_delta": self.state.motivation - motivation_before,
-            "engagement_delta": self.state.engagement - engagement_before
+            "engagement_delta": self.state.engagement - engagement_before,
+            "interaction_update": details
         }
 
 
@@ -493,25 +723,50 @@ class AssessmentEvaluateRequest(BaseModel):
 class ExerciseGenerator:
     """Dynamically generates exercises at appropriate difficulty levels"""
 
-    def __init__(self, llm_client, kg_client=None):
+    # Bump when the exercise prompt or response parsing changes so cached batches are not reused.
+    PROMPT_VERSION = "1"
+
+    def __init__(self, llm_client, kg_client: Optional[Neo4jClient] = None,
+                 kg_schema: Optional[KGSchema] = None, model: str = OPEN_ROUTER_MODEL,
+                 cache_max_entries: int = 256, cache_ttl_seconds: Optional[float] = 1800,
+                 context_cache_max_entries: int = 512):
         self.llm = llm_client
         self.kg = kg_client
-        self.cache = {}
+        self.kg_schema = kg_schema
+        self.model = model
+        self._context_query: Optional[tuple] = None
+        self.cache = LRUCache(cache_max_entries, cache_ttl_seconds or None, name="exercise_batches")
+        # Keyed by the KG schema version, so a rebuilt graph never serves old contexts.
+        self.context_cache = LRUCache(context_cache_max_entries, name="topic_context")
+
+    def _batch_cache_key(self, topic: str, difficulty: float, misconceptions: Optional[List[str]],
+                         question_count: int, question_types: Optional[List[str]], kg_context: str) -> tuple:
+        context_hash = hashlib.sha256(kg_context.encode("utf-8")).hexdigest() if kg_context else ""
+        return (self.model, self.PROMPT_VERSION, topic, round(difficulty, 2),
+                tuple(sorted(misconceptions or [])), question_count,
+                tuple(sorted(question_types or [])), context_hash)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"model": self.model, "prompt_version": self.PROMPT_VERSION,
+                "exercise_batches": self.cache.stats(), "topic_context": self.context_cache.stats()}
 
     async def generate_multiple_exercises(self, topic: str, difficulty: float,
                                           misconceptions: List[str] = None,
                                           question_count: int = 5,
                                           question_types: List[str] = None,
-                                          provided_kg_context: str = "") -> List[Dict]:
+                                          provided_kg_context: str = "",
+                                          use_cache: bool = True) -> List[Dict]:
         """Generate multiple exercises in a single API call"""
-        cache_key = f"{topic}_{difficulty}_{','.join(misconceptions or [])}_{question_count}"
-        if cache_key in self.cache:
-            return self.cache[cache_key]
-
         kg_context = provided_kg_context
         if not kg_context and self.kg:
             kg_context = await self.get_topic_context(topic)
 
+        cache_key = self._batch_cache_key(
+            topic, difficulty, misconceptions, question_count, question_types, kg_context)
+        cached = self.cache.get(cache_key) if use_cache else None
+        if cached is not None:
+            return copy.deepcopy(cached)
+
         prompt = self._create_batch_exercise_prompt(
             topic, difficulty, misconceptions, kg_context, question_count, question_types)
 
@@ -527,8 +782,7 @@ class ExerciseGenerator:
             async for chunk in self.llm.stream_chat(
                 prompt=prompt,
                 # model=os.environ.get("TOGETHER_MODEL", "meta-llama/Llama-3.3-70B-Instruct-Turbo-Free"),
-                model=os.environ.get("OPEN_ROUTER_MODEL",
-                                     "google/gemini-2.0-flash-exp:free"),
+                model=self.model,
                 temperature=0.7,
                 max_tokens=4000,  # Increased token limit for multiple questions
                 system_prompt=system_prompt
@@ -550,136 +804,91 @@ class ExerciseGenerator:
         exercises = self._parse_batch_exercises_response(
             full_response, question_count)
 
-        self.cache[cache_key] = exercises
+        # Fallback batches are not cached so the next request retries generation.
+        if exercises and not any(ex.get("source") == "fallback" for ex in exercises):
+            self.cache.set(cache_key, copy.deepcopy(exercises))
         return exercises
 
+    # Optional per-concept collections, included only when the schema has them.
+    TOPIC_CONTEXT_SECTIONS = (
+        ("HAS_DEFINITION", "Definition", "definitions",
+         "OPTIONAL MATCH (c)-[:HAS_DEFINITION]->(def:Definition)\n    RETURN collect(DISTINCT def.text) AS definitions"),
+        ("HAS_EXAMPLE", "Example", "examples",
+         "OPTIONAL MATCH (c)-[:HAS_EXAMPLE]->(ex:Example)\n    RETURN collect(DISTINCT ex.text) AS examples"),
+        ("RELATES_TO", None, "related",
+         "OPTIONAL MATCH (c)-[:RELATES_TO]->(rel:Concept)\n    RETURN collect(DISTINCT rel.name) AS related"),
+    )
+
+    def _topic_context_query(self) -> str:
+        """One statement for the concept, its schema-dependent collections and the text fallback."""
+        schema_refreshes = self.kg_schema.refreshes if self.kg_schema else 0
+        if self._context_query and self._context_query[0] == schema_refreshes:
+            return self._context_query[1]
+
+        parts = ["OPTIONAL MATCH (c:Concept {name: $topic})"]
+        columns = ["c.description AS description"]
+        for rel_type, label, column, body in self.TOPIC_CONTEXT_SECTIONS:
+            if self.kg_schema and self.kg_schema.has(rel_type, label):
+                parts.append(f"CALL {{\n    WITH c\n    {body}\n}}")
+                columns.append(column)
+        parts.append("""CALL {
+    WITH c
+    MATCH (f:Concept)
+    WHERE (c IS NULL OR c.description IS NULL)
+      AND (f.name CONTAINS $term OR f.description CONTAINS $term)
+    RETURN collect({name: f.name, description: f.description})[..3] AS fallback
+}""")
+        columns.append("fallback")
+        query = "\n".join(parts) + "\nRETURN " + ", ".join(columns)
+        self._context_query = (schema_refreshes, query)
+        return query
+
     async def get_topic_context(self, topic: str) -> str:
         """Retrieve topic context from Neo4j knowledge graph"""
         if not self.kg:
             return ""
 
+        cache_key = (self.kg_schema.version if self.kg_schema else None,
+                     self.kg_schema.refreshes if self.kg_schema else 0, topic)
+        cached = self.context_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
         try:
             topic_clean = topic.replace("-", "_").replace(" ", "_").lower()
             context = []
 
-            basic_query = """
-            MATCH (c:Concept {name: $topic})
-            RETURN c.name as name, c.description as description
-            """
-
-            def run_basic_query():
-                with self.kg.session(database=NEO4J_DATABASE) as session:
-                    result = session.run(basic_query, topic=topic_clean)
-                    return [record.data() for record in result]
-
-            basic_records = await asyncio.to_thread(run_basic_query)
-
-            if basic_records and basic_records[0]:
-                data = basic_records[0]
-                if data.get("description"):
-                    context.append(f"Description: {data['description']}")
-
-            schema_check_query = """
-            CALL db.schema.visualization()
-            YIELD nodes, relationships
-            RETURN 
-                [rel IN relationships | type(rel)] as rel_types,
-                [node IN nodes | labels(node)[0]] as node_labels
-            """
-
-            def run_schema_check():
-                with self.kg.session(database=NEO4J_DATABASE) as session:
-                    result = session.run(schema_check_query)
-                    return result.single()
-
-            schema_data = await asyncio.to_thread(run_schema_check)
-
-            if schema_data:
-                rel_types = schema_data.get("rel_types", [])
-                node_labels = schema_data.get("node_labels", [])
-
-                dynamic_query_parts = [
-                    "MATCH (c:Concept {name: $topic})"
-                ]
-
-                return_parts = [
-                    "c.name as name",
-                    "c.description as description"
-                ]
-
-                collect_parts = []
-
-                if "HAS_DEFINITION" in rel_types and "Definition" in node_labels:
-                    dynamic_query_parts.append(
-                        "OPTIONAL MATCH (c)-[:HAS_DEFINITION]->(def:Definition)")
-                    collect_parts.append(
-                        "collect(distinct def.text) as definitions")
-
-                if "HAS_EXAMPLE" in rel_types and "Example" in node_labels:
-                    dynamic_query_parts.append(
-                        "OPTIONAL MATCH (c)-[:HAS_EXAMPLE]->(ex:Example)")
-                    collect_parts.append(
-                        "collect(distinct ex.text) as examples")
-
-                if "RELATES_TO" in rel_types:
-                    dynamic_query_parts.append(
-                        "OPTIONAL MATCH (c)-[:RELATES_TO]->(rel:Concept)")
-                    collect_parts.append(
-                        "collect(distinct rel.name) as related")
-
-                return_parts.extend(collect_parts)
-
-                dynamic_query = "\n".join(
-                    dynamic_query_parts) + "\nRETURN " + ",\n".join(return_parts)
-
-                def run_dynamic_query():
-                    with self.kg.session(database=NEO4J_DATABASE) as session:
-                        result = session.run(dynamic_query, topic=topic_clean)
-                        return [record.data() for record in result]
-
-                dynamic_records = await asyncio.to_thread(run_dynamic_query)
-
-                if dynamic_records and dynamic_records[0]:
-                    data = dynamic_records[0]
-
-                    if data.get("definitions") and any(data["definitions"]):
-                        context.append("Definitions:")
-                        for d in [d for d in data["definitions"] if d]:
-                            context.append(f"- {d}")
-
-                    if data.get("examples") and any(data["examples"]):
-                        context.append("Examples:")
-                        for e in [e for e in data["examples"] if e]:
-                            context.append(f"- {e}")
-
-                    if data.get("related") and any(data["related"]):
-                        context.append("Related concepts: " +
-                                       ", ".join([r for r in data["related"] if r]))
-
-            if not context:
-                fallback_query = """
-                MATCH (c:Concept) 
-                WHERE c.name CONTAINS $term OR c.description CONTAINS $term
-                RETURN c.name as name, c.description as description
-                LIMIT 3
-                """
-
-                def run_fallback():
-                    with self.kg.session(database=NEO4J_DATABASE) as session:
-                        result = session.run(
-                            fallback_query, term=topic.lower())
-                        return [record.data() for record in result]
-
-                fallback_records = await asyncio.to_thread(run_fallback)
-
-                if fallback_records:
-                    context.append("Related knowledge graph information:")
-                    for record in fallback_records:
-                        if record.get("name") and record.get("description"):
-                            context.append(
-                                f"{record['name']}: {record['description']}")
-
-            return "\n".join(context) if context else ""
+            data = await self.kg.single(
+                self._topic_context_query(), {"topic": topic_clean, "term": topic.lower()},
+                name="topic_context") or {}
+
+            if data.get("description"):
+                context.append(f"Description: {data['description']}")
+
+            if data.get("definitions") and any(data["definitions"]):
+                context.append("Definitions:")
+                for d in [d for d in data["definitions"] if d]:
+                    context.append(f"- {d}")
+
+            if data.get("examples") and any(data["examples"]):
+                context.append("Examples:")
+                for e in [e for e in data["examples"] if e]:
+                    context.append(f"- {e}")
+
+            if data.get("related") and any(data["related"]):
+                context.append("Related concepts: " +
+                               ", ".join([r for r in data["related"] if r]))
+
+            if not context and data.get("fallback"):
+                context.append("Related knowledge graph information:")
+                for record in data["fallback"]:
+                    if record.get("name") and record.get("description"):
+                        context.append(
+                            f"{record['name']}: {record['description']}")
+
+            result = "\n".join(context) if context else ""
+            self.context_cache.set(cache_key, result)
+            return result
 
         except Exception as e:
             logger.error(
@@ -1018,15 +1227,13 @@ class SpacedRepetitionScheduler:
         schedule = {}
 
         for topic, mastery in student_state.mastery.items():
-            last_practiced = student_state.time_since_last_practiced.get(
-                topic, 100)
-
-            last_practiced_days = last_practiced / 10.0
-
-            if topic not in student_state.time_since_last_practiced:
+            last_practiced = student_state.time_since_practiced(topic)
+            if last_practiced is None:
                 schedule[topic] = now
                 continue
 
+            last_practiced_days = last_practiced / 10.0
+
             performance = student_state.recent_performance
 
             interval = self.calculate_review_interval(
@@ -1066,11 +1273,47 @@ class AssessmentResult(BaseModel):
 class AssessmentEngine:
     """Evaluates student responses and provides detailed pedagogical feedback"""
 
-    def __init__(self, llm_client, embedding_client=None):
+    # Bump when the grading prompt or scoring rules change so cached evaluations are not reused.
+    PROMPT_VERSION = "1"
+
+    # Graded locally without an LLM call; everything else is open-ended.
+    RULE_BASED_TYPES = ("multiple_choice", "true_false", "fill_in_blank")
+
+    def __init__(self, llm_client, embedding_client=None, model: str = OPEN_ROUTER_MODEL,
+                 cache_max_entries: int = 4096, cache_ttl_seconds: Optional[float] = 24 * 3600,
+                 max_concurrency: int = 4, batch_size: int = 8, pre_grader: Optional[PreGrader] = None):
         """Initialize assessment engine with required clients"""
         self.llm = llm_client
         self.embedding_client = embedding_client
-        self.evaluation_cache = {}
+        self.pre_grader = pre_grader
+        self.model = model
+        self.evaluation_cache = LRUCache(cache_max_entries, cache_ttl_seconds or None, name="evaluations")
+        # Bounds concurrent LLM grading calls across all requests.
+        self._llm_slots = asyncio.Semaphore(max(1, max_concurrency))
+        self.batch_size = max(1, batch_size)
+        self.batch_calls = 0
+        self.batch_items = 0
+        self.batch_item_fallbacks = 0
+
+    def _evaluation_cache_key(self, question: str, student_response: str, correct_answer: str,
+                              question_type: str, topic: str, subject: str, grade: int,
+                              explanation: str = "") -> str:
+        normalized_response = " ".join(str(student_response or "").split()).lower()
+        parts = (self.model, self.PROMPT_VERSION, question_type, topic, subject, grade,
+                 question, normalized_response, correct_answer, explanation)
+        return hashlib.sha256("\x00".join(str(p or "") for p in parts).encode("utf-8")).hexdigest()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"model": self.model, "prompt_version": self.PROMPT_VERSION,
+                "evaluations": self.evaluation_cache.stats(),
+                "batch_calls": self.batch_calls, "batch_items": self.batch_items,
+                "batch_item_fallbacks": self.batch_item_fallbacks,
+                "pre_grader": self.pre_grader.stats() if self.pre_grader else None}
+
+    def _remember(self, cache_key: str, result: AssessmentResult):
+        # LLM fallbacks (provider errors) are not cached so the answer is graded again next time.
+        if not (result.response_analysis or {}).get("fallback"):
+            self.evaluation_cache.set(cache_key, result.model_copy(deep=True))
 
     async def evaluate_response(self,
                                 question: str,
@@ -1079,7 +1322,8 @@ class AssessmentEngine:
                                 question_type: str,
                                 topic: str,
                                 subject: str,
-                                grade: int = 6) -> AssessmentResult:
+                                grade: int = 6,
+                                explanation: str = "") -> AssessmentResult:
         """
         Evaluate a student's response to a question.
 
@@ -1091,14 +1335,48 @@ class AssessmentEngine:
             topic: The topic being assessed
             subject: The subject area
             grade: Student grade level
+            explanation: The question's explanation, used as a keyword rubric by the pre-grader
 
         Returns:
             AssessmentResult: Detailed evaluation results
         """
-        cache_key = f"{question}:{student_response}:{correct_answer}"
-        if cache_key in self.evaluation_cache:
-            return self.evaluation_cache[cache_key]
+        cache_key = self._evaluation_cache_key(
+            question, student_response, correct_answer, question_type, topic, subject, grade, explanation)
+        cached = self.evaluation_cache.get(cache_key)
+        if cached is not None:
+            return cached.model_copy(deep=True)
+
+        result = await self._evaluate_uncached(
+            question, student_response, correct_answer, question_type, topic, subject, grade, explanation)
+        self._remember(cache_key, result)
+        return result
+
+    async def _pre_grade(self, student_response, correct_answer, topic, explanation) -> Optional[AssessmentResult]:
+        """Grade an open-ended answer without the LLM when a cheap tier is conclusive."""
+        if not self.pre_grader:
+            return None
+        verdict = await self.pre_grader.grade(student_response, correct_answer, explanation)
+        if verdict is None:
+            return None
+        if verdict.correct:
+            feedback = "That's correct!"
+        elif verdict.tier == "empty":
+            feedback = f"No answer was given. The expected answer is: {correct_answer}"
+        else:
+            feedback = f"That's not correct. The expected answer is: {correct_answer}"
+        return AssessmentResult(
+            score=verdict.score,
+            correct=verdict.correct,
+            feedback=feedback,
+            misconceptions=[] if verdict.correct or verdict.tier == "empty" else [
+                f"Incorrect understanding of {topic}"],
+            key_concepts_understood=[topic] if verdict.correct else [],
+            key_concepts_missed=[] if verdict.correct else [topic],
+            response_analysis={"pre_grader": verdict.tier, "confidence": verdict.confidence}
+        )
 
+    async def _evaluate_uncached(self, question, student_response, correct_answer, question_type,
+                                 topic, subject, grade, explanation="", pre_grade: bool = True) -> AssessmentResult:
         if question_type == "multiple_choice":
             result = await self._evaluate_multiple_choice(
                 question, student_response, correct_answer, topic
@@ -1112,11 +1390,13 @@ class AssessmentEngine:
                 question, student_response, correct_answer, topic
             )
         else:
-            result = await self._evaluate_with_llm(
-                question, student_response, correct_answer, topic, subject, grade
-            )
-
-        self.evaluation_cache[cache_key] = result
+            result = await self._pre_grade(
+                student_response, correct_answer, topic, explanation) if pre_grade else None
+            if result is None:
+                async with self._llm_slots:
+                    result = await self._evaluate_with_llm(
+                        question, student_response, correct_answer, topic, subject, grade
+                    )
         return result
 
     async def _evaluate_multiple_choice(self, question, student_response, correct_answer, topic) -> AssessmentResult:
@@ -1292,31 +1572,7 @@ class AssessmentEngine:
                 "Respond with valid JSON only."
             )
 
-            full_response = ""
-
-            async for chunk in self.llm.stream_chat(
-                prompt=prompt,
-                # model=os.environ.get("TOGETHER_MODEL", "meta-llama/Llama-3.3-70B-Instruct-Turbo-Free"),
-                model=os.environ.get("OPEN_ROUTER_MODEL",
-                                     "google/gemini-2.0-flash-exp:free"),
-                temperature=0.2,
-                max_tokens=1000,
-                system_prompt=system_prompt
-            ):
-                try:
-                    if isinstance(chunk, dict):
-                        if "output" in chunk and isinstance(chunk["output"], dict) and "content" in chunk["output"]:
-                            full_response += chunk["output"]["content"]
-                        elif "content" in chunk:
-                            full_response += chunk["content"]
-                        elif "text" in chunk:
-                            full_response += chunk["text"]
-                    elif isinstance(chunk, str):
-                        full_response += chunk
-                except Exception as e:
-                    logger.error(f"Error processing chunk: {e}")
-                    if isinstance(chunk, str):
-                        full_response += chunk
+            full_response = await self._complete(prompt, system_prompt, max_tokens=1000)
 
             json_match = re.search(r'({.*})', full_response, re.DOTALL)
             if json_match:
@@ -1324,23 +1580,7 @@ class AssessmentEngine:
 
             evaluation = json.loads(full_response)
 
-            result = AssessmentResult(
-                score=evaluation.get("score", 0),
-                correct=evaluation.get("correct", False),
-                partial_credit=evaluation.get("partial_credit"),
-                misconceptions=evaluation.get("misconceptions", []),
-                knowledge_gaps=evaluation.get("knowledge_gaps", []),
-                reasoning_patterns=evaluation.get("reasoning_patterns", []),
-                feedback=evaluation.get("feedback", "No feedback provided."),
-                improvement_suggestions=evaluation.get(
-                    "improvement_suggestions", []),
-                key_concepts_understood=evaluation.get(
-                    "key_concepts_understood", []),
-                key_concepts_missed=evaluation.get("key_concepts_missed", []),
-                response_analysis={"raw_llm_response": full_response[:500]}
-            )
-
-            return result
+            return self._result_from_evaluation(evaluation, full_response)
 
         except Exception as e:
             logger.error(f"Error during LLM evaluation: {e}", exc_info=True)
@@ -1361,22 +1601,194 @@ class AssessmentEngine:
                 response_analysis={"error": str(e), "fallback": True}
             )
 
-    async def batch_evaluate(self, assessments: List[Dict]) -> List[AssessmentResult]:
-        """Process multiple assessments in parallel"""
-        tasks = []
-        for assessment in assessments:
-            task = self.evaluate_response(
-                question=assessment.get("question", ""),
-                student_response=assessment.get("student_response", ""),
-                correct_answer=assessment.get("correct_answer", ""),
-                question_type=assessment.get("question_type", "short_answer"),
-                topic=assessment.get("topic", ""),
-                subject=assessment.get("subject", ""),
-                grade=assessment.get("grade", 6)
-            )
-            tasks.append(task)
+    async def _complete(self, prompt: str, system_prompt: str, max_tokens: int) -> str:
+        full_response = ""
+        async for chunk in self.llm.stream_chat(
+            prompt=prompt,
+            # model=os.environ.get("TOGETHER_MODEL", "meta-llama/Llama-3.3-70B-Instruct-Turbo-Free"),
+            model=self.model,
+            temperature=0.2,
+            max_tokens=max_tokens,
+            system_prompt=system_prompt
+        ):
+            try:
+                if isinstance(chunk, dict):
+                    if "output" in chunk and isinstance(chunk["output"], dict) and "content" in chunk["output"]:
+                        full_response += chunk["output"]["content"]
+                    elif "content" in chunk:
+                        full_response += chunk["content"]
+                    elif "text" in chunk:
+                        full_response += chunk["text"]
+                elif isinstance(chunk, str):
+                    full_response += chunk
+            except Exception as e:
+                logger.error(f"Error processing chunk: {e}")
+                if isinstance(chunk, str):
+                    full_response += chunk
+        return full_response
+
+    @staticmethod
+    def _result_from_evaluation(evaluation: Dict[str, Any], raw_response: str) -> AssessmentResult:
+        return AssessmentResult(
+            score=evaluation.get("score", 0),
+            correct=evaluation.get("correct", False),
+            partial_credit=evaluation.get("partial_credit"),
+            misconceptions=evaluation.get("misconceptions", []),
+            knowledge_gaps=evaluation.get("knowledge_gaps", []),
+            reasoning_patterns=evaluation.get("reasoning_patterns", []),
+            feedback=evaluation.get("feedback", "No feedback provided."),
+            improvement_suggestions=evaluation.get(
+                "improvement_suggestions", []),
+            key_concepts_understood=evaluation.get(
+                "key_concepts_understood", []),
+            key_concepts_missed=evaluation.get("key_concepts_missed", []),
+            response_analysis={"raw_llm_response": raw_response[:500]}
+        )
+
+    async def _evaluate_batch_with_llm(self, items: List[Dict[str, Any]]) -> List[Optional[AssessmentResult]]:
+        """Grade several open-ended answers in one prompt; items the model skips or garbles come back as None."""
+        blocks = []
+        for index, item in enumerate(items):
+            blocks.append(
+                f"""Item {index}:
+        Topic: {item['topic']}
+        Question: {item['question']}
+        Correct Answer: {item['correct_answer']}
+        Student Response: {item['student_response']}""")
+        first = items[0]
+        prompt = f"""As an educational assessment expert, evaluate each of these student answers independently.
+
+        Grade Level: {first['grade']}
+        Subject: {first['subject']}
+
+        {chr(10).join(blocks)}
 
-        return await asyncio.gather(*tasks)
+        For every item evaluate correctness (score 0-100), misconceptions, knowledge gaps,
+        reasoning patterns and key concepts understood vs. missed.
+
+        Return ONLY a valid JSON object matching this schema, with one entry per item:
+        {{
+          "evaluations": [
+            {{
+              "item": <item number>,
+              "score": <0-100>,
+              "correct": <boolean>,
+              "partial_credit": <float or null>,
+              "misconceptions": ["..."],
+              "knowledge_gaps": ["..."],
+              "reasoning_patterns": ["..."],
+              "feedback": "detailed feedback for student",
+              "improvement_suggestions": ["..."],
+              "key_concepts_understood": ["..."],
+              "key_concepts_missed": ["..."]
+            }}
+          ]
+        }}
+
+        Your assessment must be fair, objective, and grade-appropriate. Each "feedback" should be encouraging while identifying specific areas for improvement.
+        """
+        system_prompt = (
+            "You are an expert educational assessment evaluator. "
+            "Respond with valid JSON only."
+        )
+        results: List[Optional[AssessmentResult]] = [None] * len(items)
+        self.batch_calls += 1
+        self.batch_items += len(items)
+        try:
+            async with self._llm_slots:
+                full_response = await self._complete(
+                    prompt, system_prompt, max_tokens=min(4000, 200 + 600 * len(items)))
+            json_match = re.search(r'({.*})', full_response, re.DOTALL)
+            evaluations = json.loads(json_match.group(1) if json_match else full_response).get("evaluations", [])
+        except Exception as e:
+            logger.error(f"Error during batched LLM evaluation of {len(items)} items: {e}", exc_info=True)
+            return results
+
+        for position, evaluation in enumerate(evaluations):
+            if not isinstance(evaluation, dict):
+                continue
+            index = evaluation.get("item", position)
+            if not isinstance(index, int) or not 0 <= index < len(items) or results[index] is not None:
+                continue
+            try:
+                results[index] = self._result_from_evaluation(evaluation, json.dumps(evaluation))
+            except Exception as e:
+                logger.warning(f"Discarding malformed batched evaluation for item {index}: {e}")
+        return results
+
+    async def batch_evaluate(self, assessments: List[Dict],
+                             batch_llm: bool = True) -> List[Union[AssessmentResult, Exception]]:
+        """Grade several responses concurrently, in input order; failed items are returned as exceptions.
+
+        Rule-based types are graded locally; with `batch_llm`, uncached open-ended
+        answers share one LLM prompt per `batch_size` items and any item the batch
+        fails to grade falls back to its own LLM call.
+        """
+        items = [{
+            "question": assessment.get("question", ""),
+            "student_response": assessment.get("student_response", "") or "",
+            "correct_answer": assessment.get("correct_answer", ""),
+            "question_type": assessment.get("question_type", "short_answer"),
+            "topic": assessment.get("topic", ""),
+            "subject": assessment.get("subject", ""),
+            "grade": assessment.get("grade", 6),
+            "explanation": assessment.get("explanation", "") or "",
+        } for assessment in assessments]
+        results: List[Union[AssessmentResult, Exception, None]] = [None] * len(items)
+        keys = [self._evaluation_cache_key(**item) for item in items]
+
+        singles, open_ended = [], []
+        for index, (item, key) in enumerate(zip(items, keys)):
+            cached = self.evaluation_cache.get(key)
+            if cached is not None:
+                results[index] = cached.model_copy(deep=True)
+            elif batch_llm and item["question_type"] not in self.RULE_BASED_TYPES:
+                open_ended.append(index)
+            else:
+                singles.append(index)
+
+        if open_ended and self.pre_grader:
+            pre_graded = await asyncio.gather(*(self._pre_grade(
+                items[i]["student_response"], items[i]["correct_answer"], items[i]["topic"],
+                items[i]["explanation"]) for i in open_ended), return_exceptions=True)
+            remaining = []
+            for index, result in zip(open_ended, pre_graded):
+                if isinstance(result, AssessmentResult):
+                    results[index] = result
+                    self._remember(keys[index], result)
+                else:
+                    remaining.append(index)
+            open_ended = remaining
+        llm_only = set(open_ended)
+        if len(open_ended) == 1:
+            singles += open_ended
+            open_ended = []
+
+        async def grade_single(index: int):
+            try:
+                # Open-ended items here have already been through the pre-grader.
+                results[index] = await self._evaluate_uncached(
+                    **items[index], pre_grade=index not in llm_only)
+                self._remember(keys[index], results[index])
+            except Exception as e:
+                logger.error(f"Error evaluating item {index}: {e}", exc_info=True)
+                results[index] = e
+
+        async def grade_batch(indices: List[int]):
+            graded = await self._evaluate_batch_with_llm([items[i] for i in indices])
+            missed = []
+            for index, result in zip(indices, graded):
+                if result is None:
+                    missed.append(index)
+                else:
+                    results[index] = result
+                    self._remember(keys[index], result)
+            self.batch_item_fallbacks += len(missed)
+            await asyncio.gather(*(grade_single(i) for i in missed))
+
+        batches = [open_ended[i:i + self.batch_size] for i in range(0, len(open_ended), self.batch_size)]
+        await asyncio.gather(*(grade_single(i) for i in singles), *(grade_batch(b) for b in batches))
+        return results
 
     async def aggregate_results(self, results: List[AssessmentResult], topic: str) -> Dict[str, Any]:
         """Aggregate multiple assessment results into an overall analysis"""
@@ -1466,12 +1878,16 @@ class HeatmapResponse(BaseModel):
     image_base64: Optional[str] = None
 
 
+# Most recent interactions loaded for per-student analytics.
+ANALYTICS_HISTORY_LIMIT = 500
+
+
 class LearningAnalytics:
     """Advanced learning analytics for educational insights"""
 
-    def __init__(self, mongo_db, neo4j_driver=None):
+    def __init__(self, mongo_db, neo4j_client: Optional[Neo4jClient] = None):
         self.db = mongo_db
-        self.neo4j_driver = neo4j_driver
+        self.neo4j = neo4j_client
 
     async def get_student_analytics(self, student_id: str) -> Dict[str, Any]:
         session = await self._get_student_session(student_id)
@@ -1522,7 +1938,7 @@ class LearningAnalytics:
         }
 
     async def generate_mastery_heatmap(self, student_id: str) -> HeatmapResponse:
-        session = await self._get_student_session(student_id)
+        session = await self._get_student_session(student_id, with_history=False)
         if not session or 'state' not in session or 'mastery' not in session['state']:
             logger.warning(
                 f"No session or mastery data found for heatmap generation for student {student_id}")
@@ -1598,43 +2014,48 @@ class LearningAnalytics:
 
     async def get_prerequisite_chain(self, topic: str) -> Dict[str, Any]:
         """Get prerequisite chains for a topic from the knowledge graph"""
-        if not self.neo4j_driver:
+        if not self.neo4j:
             return {"error": "Neo4j not available"}
 
         try:
-            with self.neo4j_driver.session() as session:
-                result = session.run("""
-                MATCH path = (start:Concept)-[:PREREQUISITE_FOR*1..5]->(target:Concept)
-                WHERE target.name = $topic
-                WITH start, target, [node IN nodes(path) | node.name] AS chain,
-                     length(path) AS depth
-                RETURN start.name AS prerequisite, chain, depth
-                ORDER BY depth DESC
-                LIMIT 10
-                """, topic=topic)
-
-                chains = [{"prerequisite": record["prerequisite"],
-                          "chain": record["chain"],
-                           "depth": record["depth"]}
-                          for record in result]
-
-                return {
-                    "topic": topic,
-                    "prerequisite_chains": chains,
-                    "timestamp": datetime.now(timezone.utc).isoformat()
-                }
+            chains = await self.neo4j.run("""
+            MATCH path = (start:Concept)-[:PREREQUISITE_FOR*1..5]->(target:Concept)
+            WHERE target.name = $topic
+            WITH start, target, [node IN nodes(path) | node.name] AS chain,
+                 length(path) AS depth
+            RETURN start.name AS prerequisite, chain, depth
+            ORDER BY depth DESC
+            LIMIT 10
+            """, {"topic": topic}, name="prerequisite_chain", mapper=as_prerequisite_chain)
+
+            return {
+                "topic": topic,
+                "prerequisite_chains": [chain._asdict() for chain in chains],
+                "timestamp": datetime.now(timezone.utc).isoformat()
+            }
 
         except Exception as e:
             logger.error(
                 f"Error retrieving prerequisite chains: {e}", exc_info=True)
             return {"error": f"Could not retrieve prerequisite chains: {str(e)}"}
 
-    async def _get_student_session(self, student_id: str) -> Dict:
-        """Retrieve student session data from database"""
+    async def _get_student_session(self, student_id: str, with_history: bool = True) -> Dict:
+        """Retrieve the student's state (and interaction history) as stored, without validating the session"""
         try:
-            data = await self.db["learning_states"].find_one({"student_id": student_id})
+            projection = {"_id": 0, "student_id": 1, "state": 1}
+            if with_history:
+                projection["learning_path"] = 1
+            data = await self.db["learning_states"].find_one({"student_id": student_id}, projection)
+            if data and isinstance(data.get("state"), dict):
+                await ensure_layout(data["state"])
+                data["state"] = expand_vectors(data["state"])
+            if data and with_history:
+                # The session only embeds a recent tail; analytics use the stored history.
+                history = await InteractionStore(self.db["interactions"]).history(
+                    student_id, limit=ANALYTICS_HISTORY_LIMIT, newest_first=True)
+                if history:
+                    data["learning_path"] = history[::-1]
             if data:
-                data.pop("_id", None)
                 return data
             return None
         except Exception as e:
@@ -1823,7 +2244,7 @@ class LearningAnalytics:
         }
 
     async def _identify_knowledge_structure(self, session: Dict) -> Dict[str, Any]:
-        if not self.neo4j_driver:
+        if not self.neo4j:
             logger.warning(
                 "Neo4j driver not available, skipping knowledge structure analysis.")
             return {"identified_clusters": [], "potential_knowledge_gaps": [], "identified_strengths": []}
@@ -1838,20 +2259,17 @@ class LearningAnalytics:
             if not topics:
                 return {"identified_clusters": [], "potential_knowledge_gaps": [], "identified_strengths": []}
 
-            with self.neo4j_driver.session(database=NEO4J_DATABASE) as neo4j_session:
-                result = neo4j_session.run("""
-                     UNWIND $topics AS topic
-                     MATCH (c:Concept {name: topic})
-                     MATCH (c)-[r:PART_OF|RELATED_TO|MENTIONS]-(related:Concept)
-                     WHERE related.name IN $topics AND c <> related
-                     WITH c, collect(DISTINCT related.name) AS related_concepts
-                     RETURN c.name AS topic, related_concepts, size(related_concepts) AS connection_count
-                     ORDER BY connection_count DESC
-                     """, topics=topics)
-                clusters_raw = [dict(record) for record in result]
-
-            adj_list = {item['topic']: set(
-                item['related_concepts']) for item in clusters_raw}
+            clusters_raw = await self.neo4j.run("""
+                 UNWIND $topics AS topic
+                 MATCH (c:Concept {name: topic})
+                 MATCH (c)-[r:PART_OF|RELATED_TO|MENTIONS]-(related:Concept)
+                 WHERE related.name IN $topics AND c <> related
+                 WITH c, collect(DISTINCT related.name) AS related
+                 RETURN c.name AS topic, related, size(related) AS connection_count
+                 ORDER BY connection_count DESC
+                 """, {"topics": topics}, name="knowledge_structure", mapper=as_concept_relations)
+
+            adj_list = {item.topic: set(item.related) for item in clusters_raw}
             all_relevant_topics = set(adj_list.keys()) | set(
                 concept for concepts in adj_list.values() for concept in concepts)
             processed_topics = set()
@@ -2197,12 +2615,16 @@ async def update_student_metrics_from_assessment(
     )
 
     await save_student_session_mongo(session)
+    interaction_update = result.pop("interaction_update")
+    if interaction_store and assessment_results.get("assessment_id"):
+        await interaction_store.update(session.student_id, interaction_update,
+                                       assessment_id=assessment_results["assessment_id"])
 
     return result
 
 
 async def optimize_session_storage(session: StudentSessionData) -> Dict[str, Any]:
-    """Optimize session storage by pruning unused metrics and limiting history"""
+    """Optimize session storage by pruning unused metrics and limiting history; the caller saves the session."""
     if not session:
         return {"error": "Invalid session"}
 
@@ -2228,8 +2650,6 @@ async def optimize_session_storage(session: StudentSessionData) -> Dict[str, Any
             for topic in to_remove:
                 session.analytics["per_topic_analytics"].pop(topic, None)
 
-    await save_student_session_mongo(session)
-
     return {
         "learning_path_pruned": original_path_length - len(session.learning_path),
         "analytics_optimized": True
@@ -2260,16 +2680,17 @@ async def migrate_to_optimized_model(db) -> Dict[str, Any]:
                 session_id = old_session_data.get("student_id", str(uuid4()))
                 old_session_data.pop("_id", None)
 
+                await ensure_layout(old_session_data.get("state"))
                 session = StudentSessionData.model_validate(old_session_data)
 
                 session.prune_learning_path(max_entries=100)
 
-                session_dict = session.model_dump(mode='json')
+                session_dict = session.persisted_document()
                 session_dict["model_version"] = "optimized"
 
                 await db["learning_states"].update_one(
                     {"student_id": session_id},
-                    {"$set": session_dict},
+                    {"$set": session_dict, "$inc": {VERSION_FIELD: 1}},
                     upsert=True
                 )
 
@@ -2291,7 +2712,10 @@ async def migrate_to_optimized_model(db) -> Dict[str, Any]:
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Handles startup and shutdown events for resource initialization and cleanup."""
-    global rl_system, ollama_client, mongo_client, learning_db, neo4j_driver, embedding_client, mistral_client, together_client, config, open_router_client
+    global rl_system, ollama_client, mongo_client, learning_db, neo4j_client, embedding_client, mistral_client, together_client, config, open_router_client, embedding_cache, embedding_service, embedding_warmup_task
+    global kg_version_tracker, rag_context_cache, chunk_vector_index, chunk_index_task, chapter_catalog, kg_schema
+    global exercise_generator, assessment_engine, question_bank, interaction_store, interaction_migration_task
+    global session_store
     global prompt_manager, response_validator
     config = load_config()
     logger.info(f"API v{config.api.version} server starting up...")
@@ -2306,7 +2730,8 @@ async def lifespan(app: FastAPI):
         logger.info(f"Initializing RL System from {config.rl.model_path}...")
         try:
             rl_system = NCERTLearningSystem(
-                log_dir=os.path.dirname(config.rl.model_path))
+                log_dir=os.path.dirname(config.rl.model_path),
+                normalize_observations=config.rl.normalize_observations)
             rl_system.load_model(str(config.rl.model_path))
             if rl_system.model is None:
                 logger.error(
@@ -2314,6 +2739,14 @@ async def lifespan(app: FastAPI):
                 rl_system = None
             else:
                 logger.info(f"RL Model loaded from {config.rl.model_path}")
+                if config.rl.policy_backend:
+                    try:
+                        report = rl_system.enable_compiled_policy(
+                            backend=config.rl.policy_backend, use_bf16=config.rl.policy_bf16)
+                        logger.info(f"Compiled policy check: {report}")
+                    except Exception as e:
+                        logger.warning(
+                            f"Compiled policy unavailable, serving eager policy: {e}")
         except Exception as e:
             logger.error(f"Failed to initialize RL System: {e}", exc_info=True)
             rl_system = None
@@ -2375,30 +2808,75 @@ async def lifespan(app: FastAPI):
             await mongo_client.admin.command('ping')
             learning_db = mongo_client[config.database.mongo_db_name]
             await learning_db["learning_states"].create_index("student_id", unique=True, background=True)
+            # Must run before any session is read: packed state vectors are decoded with these layouts.
+            await sync_layouts(learning_db["state_layouts"],
+                               rl_system.unwrapped_env.topic_to_idx if rl_system and rl_system.unwrapped_env else None)
+            session_store = SessionStore(
+                learning_db["learning_states"], StudentSessionData,
+                max_entries=config.session.cache_max_entries,
+                ttl_seconds=config.session.cache_ttl_seconds,
+                flush_delay=config.session.write_behind_delay,
+                version_check_ttl=config.session.version_check_ttl_seconds,
+                prepare=lambda data: ensure_layout(data.get("state")))
+            interaction_store = InteractionStore(learning_db["interactions"])
+            await interaction_store.ensure_indexes()
+            if config.session.migrate_learning_paths:
+                # Copies embedded learning paths into the interactions collection; idempotent.
+                interaction_migration_task = asyncio.create_task(interaction_store.migrate_embedded_paths(
+                    learning_db["learning_states"], config.session.learning_path_tail))
             logger.info(
                 f"MongoDB client connected to db '{config.database.mongo_db_name}'.")
         except Exception as e:
             logger.error(f"Failed to connect to MongoDB: {e}", exc_info=True)
             mongo_client = None
             learning_db = None
+            interaction_store = None
+            session_store = None
 
     if config.database.neo4j_uri and config.database.neo4j_password:
         logger.info(f"Connecting to Neo4j at {config.database.neo4j_uri}...")
         try:
-            neo4j_driver = GraphDatabase.driver(
+            neo4j_client = Neo4jClient(
                 config.database.neo4j_uri,
                 auth=(config.database.neo4j_username,
                       config.database.neo4j_password),
-                connection_timeout=10,
-                max_connection_lifetime=3600,
-                keep_alive=True
+                database=config.database.neo4j_database,
+                max_pool_size=config.database.neo4j_max_pool_size,
+                connection_timeout=config.database.neo4j_connection_timeout,
+                acquisition_timeout=config.database.neo4j_acquisition_timeout,
+                query_timeout=config.database.neo4j_query_timeout,
+                max_connection_lifetime=3600
             )
-            neo4j_driver.verify_connectivity()
+            await neo4j_client.verify_connectivity()
             logger.info("Neo4j driver connected successfully.")
         except Exception as e:
             logger.error(
                 f"Failed to initialize Neo4j driver: {e}", exc_info=True)
-            neo4j_driver = None
+            if neo4j_client:
+                await neo4j_client.close()
+            neo4j_client = None
+
+    if neo4j_client:
+        rag_context_cache = RagContextCache(
+            max_entries=config.rag.context_cache_max_entries,
+            ttl_seconds=config.rag.context_cache_ttl_seconds or None)
+        kg_version_tracker = KGVersionTracker(
+            _fetch_kg_version, poll_interval=config.rag.kg_version_poll_seconds)
+        kg_version_tracker.add_listener(_on_kg_version_change)
+        await kg_version_tracker.refresh()
+        chapter_catalog = ChapterCatalog(
+            _fetch_chapter_catalog, ttl_seconds=config.rag.chapter_catalog_ttl_seconds,
+            load_topic_map=_fetch_topic_chapter_map)
+        await chapter_catalog.refresh(kg_version_tracker.version)
+        kg_schema = KGSchema(_fetch_kg_schema)
+        await kg_schema.refresh(kg_version_tracker.version)
+        if config.rag.in_process_vector_index:
+            chunk_vector_index = ChunkVectorIndex(
+                _fetch_chunk_embeddings, dimension=EMBEDDING_DIMENSION)
+            # Loaded in the background; retrieval uses Neo4j until it is ready.
+            chunk_index_task = asyncio.create_task(
+                chunk_vector_index.refresh(kg_version_tracker.version))
+        kg_version_tracker.start()
 
     if config.embedding.mistral_api_key and config.embedding.embedding_model_name:
         logger.info(
@@ -2413,11 +2891,70 @@ async def lifespan(app: FastAPI):
             from mistralai import Mistral
             mistral_client = Mistral(api_key=config.embedding.mistral_api_key)
             logger.info("Mistral AI client initialized.")
+
+            embedding_cache = EmbeddingCache(
+                model_name=config.embedding.embedding_model_name,
+                path=config.embedding.cache_path,
+                max_entries=config.embedding.cache_max_entries,
+                ttl_seconds=config.embedding.cache_ttl_seconds,
+                dimension=EMBEDDING_DIMENSION)
+            embedding_service = EmbeddingService(
+                client=mistral_client,
+                model_name=config.embedding.embedding_model_name,
+                cache=embedding_cache,
+                rate_limiter=TokenBucket(
+                    rate=config.embedding.requests_per_second, capacity=config.embedding.burst_size),
+                max_batch_size=config.embedding.max_batch_size,
+                batch_window=config.embedding.batch_window_ms / 1000.0,
+                dimension=EMBEDDING_DIMENSION,
+                max_retries=config.embedding.max_retries,
+                retry_backoff=config.embedding.retry_backoff_seconds)
         except Exception as e:
             logger.error(
                 f"Failed to initialize Mistral AI clients: {e}", exc_info=True)
             embedding_client = None
             mistral_client = None
+            embedding_service = None
+
+    if embedding_service and config.embedding.precompute_topic_embeddings and rl_system and rl_system.unwrapped_env:
+        # Runs in the background so startup is not blocked on the provider quota.
+        embedding_warmup_task = asyncio.create_task(warm_topic_query_embeddings(
+            embedding_service, list(rl_system.unwrapped_env.topics),
+            topic_query_embeddings_path(config.embedding.query_embeddings_dir)))
+
+    if open_router_client:
+        # One instance each for the app lifetime so their caches are shared across requests.
+        exercise_generator = ExerciseGenerator(
+            llm_client=open_router_client, kg_client=neo4j_client, kg_schema=kg_schema,
+            model=config.llm.open_router_model,
+            cache_max_entries=config.assessment.exercise_cache_max_entries,
+            cache_ttl_seconds=config.assessment.exercise_cache_ttl_seconds,
+            context_cache_max_entries=config.assessment.topic_context_cache_max_entries)
+        assessment_engine = AssessmentEngine(
+            llm_client=open_router_client, model=config.llm.open_router_model,
+            cache_max_entries=config.assessment.evaluation_cache_max_entries,
+            cache_ttl_seconds=config.assessment.evaluation_cache_ttl_seconds,
+            max_concurrency=config.assessment.evaluation_concurrency,
+            batch_size=config.assessment.evaluation_batch_size,
+            pre_grader=PreGrader(
+                embed=embedding_service.embed if embedding_service else None,
+                lexical_accept=config.assessment.pre_grade_lexical_accept,
+                embedding_reject=config.assessment.pre_grade_embedding_reject,
+                enabled=config.assessment.pre_grader_enabled))
+        if learning_db is not None and config.assessment.question_bank_enabled:
+            question_bank = QuestionBank(
+                learning_db["question_bank"], exercise_generator,
+                servings=learning_db["question_servings"],
+                bands=config.assessment.question_bank_bands,
+                min_stock=config.assessment.question_bank_min_stock,
+                refill_batch_size=config.assessment.question_bank_refill_batch_size,
+                workers=config.assessment.question_bank_workers,
+                refill_cooldown=config.assessment.question_bank_refill_cooldown)
+            try:
+                await question_bank.ensure_indexes()
+            except Exception as e:
+                logger.warning(f"Could not create question bank indexes: {e}")
+            question_bank.start()
 
     if all(x is not None for x in [together_client, open_router_client, mongo_client, learning_db]):
         await init_advanced_its_components()
@@ -2429,12 +2966,28 @@ async def lifespan(app: FastAPI):
     yield
 
     logger.info("API server shutting down...")
+    if question_bank:
+        await question_bank.stop()
+    if interaction_migration_task and not interaction_migration_task.done():
+        interaction_migration_task.cancel()
+    if embedding_warmup_task and not embedding_warmup_task.done():
+        embedding_warmup_task.cancel()
+    if kg_version_tracker:
+        await kg_version_tracker.stop()
+    if chunk_index_task and not chunk_index_task.done():
+        chunk_index_task.cancel()
+    if embedding_service:
+        await embedding_service.close()
+    if embedding_cache:
+        embedding_cache.close()
+    if session_store:
+        await session_store.close()
     if mongo_client:
         mongo_client.close()
         logger.info("MongoDB connection closed.")
-    if neo4j_driver:
+    if neo4j_client:
         try:
-            neo4j_driver.close()
+            await neo4j_client.close()
             logger.info("Neo4j driver closed.")
         except Exception as e:
             logger.error(f"Error closing Neo4j driver: {e}", exc_info=True)
@@ -2458,13 +3011,7 @@ app.add_middleware(
 
 
 async def init_advanced_its_components():
-    global config, exercise_generator, metacognitive_support, content_selector, spaced_repetition
-
-    exercise_generator = ExerciseGenerator(
-        # llm_client=together_client,
-        llm_client=open_router_client,
-        kg_client=neo4j_driver
-    )
+    global config, metacognitive_support, content_selector, spaced_repetition
 
     metacognitive_support = MetacognitiveSupport(config)
 
@@ -2501,36 +3048,24 @@ async def get_user_id_from_proxy(
 
 
 async def get_student_session_mongo(user_id: str) -> StudentSessionData | None:
-    """Fetches student session data from MongoDB."""
-    if learning_db is None:
+    """Fetches student session data, from the session cache when possible."""
+    if session_store is None:
         logger.error("MongoDB unavailable, cannot fetch session.")
         raise HTTPException(status_code=503, detail="DB unavailable")
     try:
-        data = await learning_db["learning_states"].find_one({"student_id": user_id})
-        if data:
-            data.pop("_id", None)
-            return StudentSessionData.model_validate(data)
-        return None
+        return await session_store.get(user_id)
     except Exception as e:
         logger.error(f"Error fetching session {user_id}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="DB access error")
 
 
 async def save_student_session_mongo(session_data: StudentSessionData):
-    """Saves or updates student session data in MongoDB."""
-    if learning_db is None:
+    """Saves student session data; cached sessions are written behind in coalesced deltas."""
+    if session_store is None:
         logger.error("MongoDB unavailable, cannot save session.")
         raise HTTPException(status_code=503, detail="DB unavailable")
     try:
-        session_dict = session_data.model_dump(mode='json')
-        update_payload = copy.deepcopy(session_dict)
-        update_payload.pop('created_at', None)
-        result = await learning_db["learning_states"].update_one(
-            {"student_id": session_data.student_id},
-            {"$set": update_payload, "$setOnInsert": {
-                "created_at": session_data.created_at}},
-            upsert=True
-        )
+        await session_store.save(session_data)
         return True
     except Exception as e:
         logger.error(
@@ -2538,8 +3073,126 @@ async def save_student_session_mongo(session_data: StudentSessionData):
         raise HTTPException(status_code=500, detail="DB save error")
 
 
-def prepare_observation_from_state(state: StudentState, profile: StudentProfile, env: Any) -> Optional[np.ndarray]:
-    if not SB3_AVAILABLE or env is None or not hasattr(env, 'num_topics') or env.num_topics <= 0:
+class PartialSession(NamedTuple):
+    """Typed subset of a student session; parts that were not requested are None."""
+    student_id: str
+    state: Optional[StudentState] = None
+    profile: Optional[StudentProfile] = None
+    learning_path: Optional[List[Dict[str, Any]]] = None
+    analytics: Optional[Dict[str, Any]] = None
+
+
+SESSION_PARTS = frozenset(PartialSession._fields) - {"student_id"}
+
+
+async def load_session_parts(user_id: str, parts: Iterable[str],
+                             path_tail: Optional[int] = None) -> Optional[PartialSession]:
+    """Loads only the named session parts, for read-only handlers.
+
+    A cached session whose version was confirmed within the last few seconds is
+    used as is (callers must not mutate it); otherwise Mongo is read with a
+    projection and only the requested parts are validated.
+    """
+    parts = set(parts)
+    if parts - SESSION_PARTS:
+        raise ValueError(f"Unknown session parts: {sorted(parts - SESSION_PARTS)}")
+    if session_store is None:
+        logger.error("MongoDB unavailable, cannot fetch session.")
+        raise HTTPException(status_code=503, detail="DB unavailable")
+    try:
+        cached = await session_store.cached_current(user_id)
+        if cached is not None:
+            values = {part: getattr(cached, part) for part in parts}
+        else:
+            data = await session_store.find_fields(user_id, parts, path_tail)
+            if data is None:
+                return None
+            values = {}
+            if "state" in parts:
+                await ensure_layout(data.get("state"))
+                values["state"] = StudentState.model_validate(data.get("state") or {})
+            if "profile" in parts:
+                values["profile"] = StudentProfile.model_validate(data.get("profile") or {"student_id": user_id})
+            if "learning_path" in parts:
+                values["learning_path"] = data.get("learning_path") or []
+            if "analytics" in parts:
+                values["analytics"] = data.get("analytics") or {}
+        if values.get("learning_path") and path_tail is not None:
+            values["learning_path"] = values["learning_path"][-path_tail:] if path_tail > 0 else []
+        return PartialSession(user_id, **values)
+    except Exception as e:
+        logger.error(f"Error fetching session parts {sorted(parts)} for {user_id}: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="DB access error")
+
+
+async def load_session_state(user_id: str) -> Optional[StudentState]:
+    partial = await load_session_parts(user_id, ("state",))
+    return partial.state if partial else None
+
+
+async def load_session_profile(user_id: str) -> Optional[StudentProfile]:
+    partial = await load_session_parts(user_id, ("profile",))
+    return partial.profile if partial else None
+
+
+async def load_learning_path_tail(user_id: str, n: int) -> Optional[List[Dict[str, Any]]]:
+    partial = await load_session_parts(user_id, ("learning_path",), path_tail=n)
+    return partial.learning_path if partial else None
+
+
+def new_student_session(user_id: str) -> StudentSessionData:
+    logger.info(f"New session for user {user_id}.")
+    return StudentSessionData(student_id=user_id, profile=StudentProfile(student_id=user_id),
+                              state=StudentState(), interactions_migrated=True)
+
+
+async def update_student_session(user_id: str, mutate: Callable[[StudentSessionData], Awaitable[Any]],
+                                 create: bool = False) -> Tuple[Optional[StudentSessionData], Any]:
+    """Load, mutate and save one student's session under their lock; returns (session, mutate's result).
+
+    Only this step is serialised: handlers do their reads, retrieval and LLM calls
+    before or after it. `mutate` may be re-run on a reloaded session if another
+    worker saved it first (see SessionStore.update). Without `create`, a missing
+    session gives (None, None).
+    """
+    if session_store is None:
+        logger.error("MongoDB unavailable, cannot update session.")
+        raise HTTPException(status_code=503, detail="DB unavailable")
+    try:
+        return await session_store.update(
+            user_id, mutate, create=(lambda: new_student_session(user_id)) if create else None)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error updating session {user_id}: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="DB save error")
+
+
+async def record_interaction(session: StudentSessionData, interaction_log: Dict[str, Any]):
+    """Log an interaction: the session keeps a short recent tail, the interactions collection keeps all of it."""
+    session.learning_path.append(interaction_log)
+    if interaction_store is None:
+        return
+    if session.interactions_migrated:
+        await interaction_store.record(session.student_id, interaction_log)
+    else:
+        # Not migrated yet: the embedded path is the only copy of this history, so store it before trimming.
+        try:
+            await interaction_store.record_many(session.student_id, session.learning_path)
+        except Exception as e:
+            logger.error(f"Error copying learning path of {session.student_id}; keeping it untrimmed: {e}",
+                         exc_info=True)
+            return
+        session.interactions_migrated = True
+    session.prune_learning_path(max_entries=config.session.learning_path_tail)
+
+
+# Time-since-practice observed for topics the student has not practiced yet (plus elapsed interactions).
+NEVER_PRACTICED_STEPS = 100.0
+
+
+def prepare_observation_from_state(state: StudentState, profile: StudentProfile, env: Any, flattener: Any) -> Optional[np.ndarray]:
+    if not SB3_AVAILABLE or env is None or flattener is None or not hasattr(env, 'num_topics') or env.num_topics <= 0:
         logger.error(
             "Cannot prepare observation: RL Env invalid or SB3 unavailable.")
         return None
@@ -2548,23 +3201,36 @@ def prepare_observation_from_state(state: StudentState, profile: StudentProfile,
         topic_map = env.topic_to_idx
         num_strategies = NUM_STRATEGIES
         num_styles = len(LearningStyles)
-        mastery_obs = np.zeros(num_topics, dtype=np.float32)
-        topic_attempts_obs = np.zeros(num_topics, dtype=np.float32)
-        time_since_last_practiced_obs = np.full(
-            num_topics, getattr(env, 'max_steps', 250.0), dtype=np.float32)
-        misconceptions_obs = np.zeros(num_topics, dtype=np.float32)
-        for t, v in state.mastery.items():
-            if t in topic_map:
-                mastery_obs[topic_map[t]] = np.clip(v, 0., 1.)
-        for t, v in state.topic_attempts.items():
-            if t in topic_map:
-                topic_attempts_obs[topic_map[t]] = v
-        for t, v in state.time_since_last_practiced.items():
-            if t in topic_map:
-                time_since_last_practiced_obs[topic_map[t]] = v
-        for t, v in state.misconceptions.items():
-            if t in topic_map:
-                misconceptions_obs[topic_map[t]] = np.clip(v, 0., 1.)
+        # Unpracticed topics count up from NEVER_PRACTICED_STEPS, as the old per-topic counters did.
+        unpracticed = (NEVER_PRACTICED_STEPS + state.interaction_counter if state.interaction_counter > 0
+                       else getattr(env, 'max_steps', 250.0))
+        layout = current_layout()
+        if layout.matches(topic_map):
+            # The packed vectors are already in observation order.
+            mastery_obs = np.clip(state.mastery.as_array(layout), 0., 1.)
+            topic_attempts_obs = state.topic_attempts.as_array(layout)
+            steps = state.last_practiced_step.as_array(layout, fill=np.nan)
+            time_since_last_practiced_obs = np.where(
+                np.isnan(steps), np.float32(unpracticed),
+                np.maximum(0., state.interaction_counter - steps)).astype(np.float32)
+            misconceptions_obs = np.clip(state.misconceptions.as_array(layout), 0., 1.)
+        else:
+            mastery_obs = np.zeros(num_topics, dtype=np.float32)
+            topic_attempts_obs = np.zeros(num_topics, dtype=np.float32)
+            time_since_last_practiced_obs = np.full(num_topics, unpracticed, dtype=np.float32)
+            misconceptions_obs = np.zeros(num_topics, dtype=np.float32)
+            for t, v in state.mastery.items():
+                if t in topic_map:
+                    mastery_obs[topic_map[t]] = np.clip(v, 0., 1.)
+            for t, v in state.topic_attempts.items():
+                if t in topic_map:
+                    topic_attempts_obs[topic_map[t]] = v
+            for t, step in state.last_practiced_step.items():
+                if t in topic_map:
+                    time_since_last_practiced_obs[topic_map[t]] = max(0.0, state.interaction_counter - step)
+            for t, v in state.misconceptions.items():
+                if t in topic_map:
+                    misconceptions_obs[topic_map[t]] = np.clip(v, 0., 1.)
         eng = np.array([state.engagement], dtype=np.float32)
         att = np.array([state.attention], dtype=np.float32)
         cog = np.array([state.cognitive_load], dtype=np.float32)
@@ -2584,16 +3250,18 @@ def prepare_observation_from_state(state: StudentState, profile: StudentProfile,
         elif hist_len > 0:
             copy_len = min(hist_len, num_strategies)
             strat_hist_obs[:copy_len] = state.strategy_history_vector[:copy_len]
-        topic_idx_max = float(max(1, num_topics))
         cur_topic_idx = state.current_topic_idx_persistent
-        cur_topic_norm = float(
-            cur_topic_idx if 0 <= cur_topic_idx < num_topics else num_topics)/topic_idx_max
-        cur_topic_obs = np.array([cur_topic_norm], dtype=np.float32)
         recent_perf = np.array([state.recent_performance], dtype=np.float32)
         steps_obs = np.array([state.steps_on_current_topic], dtype=np.float32)
-        obs_list = [mastery_obs, eng, att, cog, mot, prefs_obs, strat_hist_obs, topic_attempts_obs,
-                    time_since_last_practiced_obs, misconceptions_obs, cur_topic_obs, recent_perf, steps_obs]
-        flat_obs = np.concatenate(obs_list).astype(np.float32)
+        # Same flattening (and normalization, if enabled) as the training env.
+        flat_obs = flattener.flatten({
+            'mastery': mastery_obs, 'engagement': eng, 'attention': att, 'cognitive_load': cog,
+            'motivation': mot, 'learning_style_prefs': prefs_obs, 'strategy_history': strat_hist_obs,
+            'topic_attempts': topic_attempts_obs, 'time_since_last_practiced': time_since_last_practiced_obs,
+            'misconceptions': misconceptions_obs,
+            'current_topic_idx': cur_topic_idx if 0 <= cur_topic_idx < num_topics else num_topics,
+            'recent_performance': recent_perf, 'steps_on_current_topic': steps_obs,
+        })
         exp_shape = env.observation_space.shape[0]
         if flat_obs.shape[0] != exp_shape:
             logger.error(
@@ -2659,6 +3327,27 @@ def calculate_prerequisite_satisfaction(topic_idx: int, mastery_dict: Dict[str,
         return 0.5
 
 
+def prepare_action_mask_from_state(state: StudentState, env: Any) -> Optional[np.ndarray]:
+    """Same topic mask the simulator applies during training, built from the persisted mastery."""
+    if not SB3_AVAILABLE or env is None or getattr(env, 'prerequisite_matrix', None) is None:
+        return None
+    try:
+        topic_map = env.topic_to_idx
+        layout = current_layout()
+        if layout.matches(topic_map):
+            mastery_obs = np.clip(state.mastery.as_array(layout), 0., 1.)
+        else:
+            mastery_obs = np.zeros(env.num_topics, dtype=np.float32)
+            for t, v in state.mastery.items():
+                if t in topic_map:
+                    mastery_obs[topic_map[t]] = np.clip(v, 0., 1.)
+        topic_mask = compute_topic_mask(mastery_obs, env.prerequisite_matrix)
+        return build_action_mask(env.action_space.nvec, topic_mask)
+    except Exception as e:
+        logger.warning(f"Action mask preparation failed: {e}")
+        return None
+
+
 def update_student_state_history(state: StudentState, topic_name: str, strategy_name: str, topic_map: Dict[str, int]):
     try:
         strat_idx = TeachingStrategies[strategy_name].value
@@ -2673,10 +3362,8 @@ def update_student_state_history(state: StudentState, topic_name: str, strategy_
     state.strategy_history_vector = new_hist
     state.topic_attempts[topic_name] = state.topic_attempts.get(
         topic_name, 0.)+1.
-    for t in topic_map:
-        state.time_since_last_practiced[t] = state.time_since_last_practiced.get(
-            t, 100.)+1.
-    state.time_since_last_practiced[topic_name] = 0.
+    state.interaction_counter += 1
+    state.mark_practiced(topic_name)
     new_idx = topic_map.get(topic_name, -1)
     if new_idx != -1:
         state.steps_on_current_topic = (
@@ -2688,98 +3375,83 @@ def update_student_state_history(state: StudentState, topic_name: str, strategy_
 
 
 async def get_embedding_async(text: str) -> Optional[List[float]]:
-    """Helper to get embeddings using the official Mistral client with rate limiting and caching."""
-    global mistral_client
-    if not mistral_client:
+    """Helper to get embeddings through the shared rate-limited, batching embedding service."""
+    if not embedding_service:
         logger.warning("Direct Mistral client unavailable.")
         return None
+    return await embedding_service.embed(text)
 
-    cache_key = hash(text)
 
-    if cache_key in embedding_cache:
-        logger.debug("Using cached embedding")
-        return embedding_cache[cache_key]
+async def _fetch_kg_version() -> Optional[int]:
+    record = await neo4j_client.single(KG_VERSION_QUERY, name="kg_version")
+    return record.get("version") if record else None
 
-    async with embedding_lock:
-        try:
-            model_name = os.environ.get(
-                "EMBEDDING_MODEL_NAME", "mistral-embed")
-            logger.debug(f"Requesting embedding (Model: {model_name})")
 
-            def embed_sync():
-                return mistral_client.embeddings.create(model=model_name, inputs=[text])
+async def _fetch_chunk_embeddings() -> List[Dict]:
+    # Loading every embedding is a bulk read; give it more than the per-request timeout.
+    return await neo4j_client.run(CHUNK_EMBEDDINGS_QUERY, name="chunk_embeddings",
+                                  timeout=max(neo4j_client.query_timeout, 120.0))
 
-            response = await asyncio.to_thread(embed_sync)
 
-            if response.data and hasattr(response.data[0], 'embedding'):
-                emb = response.data[0].embedding
-                if EMBEDDING_DIMENSION and len(emb) != EMBEDDING_DIMENSION:
-                    logger.error(
-                        f"CRITICAL: Embedding dimension mismatch! Got {len(emb)}, expected {EMBEDDING_DIMENSION}.")
-                    return None
+async def _fetch_chapter_catalog() -> List[Dict]:
+    return await neo4j_client.run(CHAPTER_CATALOG_QUERY, name="chapter_catalog")
 
-                embedding_cache[cache_key] = emb
 
-                await asyncio.sleep(0.5)
+async def _fetch_topic_chapter_map() -> List[Dict]:
+    return await neo4j_client.run(TOPIC_CHAPTER_MAP_QUERY, name="topic_chapter_map")
 
-                return emb
-            else:
-                logger.warning(f"Mistral embedding response missing data.")
-                return None
 
-        except Exception as e:
-            logger.error(
-                f"Error generating Mistral embedding: {e}", exc_info=True)
+async def _fetch_kg_schema() -> Optional[Dict]:
+    return await neo4j_client.single(KG_SCHEMA_QUERY, name="kg_schema")
 
-            if "429" in str(e) or "rate limit" in str(e).lower():
-                logger.warning("Rate limit hit - adding longer delay")
-                await asyncio.sleep(2.0)
 
-            return None
+async def _on_kg_version_change(old_version: Optional[int], new_version: Optional[int]):
+    # Reload the catalog and chunk index first so contexts cached after the clear come from the new graph.
+    if chapter_catalog:
+        await chapter_catalog.refresh(new_version)
+    if kg_schema:
+        await kg_schema.refresh(new_version)
+    if chunk_vector_index:
+        await chunk_vector_index.refresh(new_version)
+    if rag_context_cache:
+        rag_context_cache.invalidate(old_version, new_version)
 
 
-def _run_neo4j_query_sync(driver: GraphDatabase.driver, query: str, parameters: Dict, database_name: str) -> List[Dict]:
-    """Synchronous helper to run Neo4j query against a specific database."""
-    logger.debug(
-        f"Neo4j Sync Run: DB='{database_name}', Query='{query[:100]}...'")
-    param_summary = {k: type(v).__name__ for k, v in parameters.items()}
-    if 'queryVector' in param_summary:
-        param_summary['queryVector'] = f"List[{len(parameters.get('queryVector', []))}]"
-    logger.debug(f"Neo4j Sync Run: Params Summary={param_summary}")
-    try:
-        with driver.session(database=database_name) as session:
-            results = session.run(query, parameters)
-            return [record.data() for record in results]
-    except neo4j_exceptions.ServiceUnavailable as e:
-        logger.error(f"Neo4j Unavailable: {e}")
-        raise
-    except neo4j_exceptions.ConstraintError as e:
-        logger.error(f"Neo4j Constraint Violation: {e}")
-        raise
-    except neo4j_exceptions.Neo4jError as e:
-        logger.error(f"Neo4j Query Error: {e}")
-        raise
-    except TypeError as te:
-        logger.error(f"Neo4j parameter TypeError: {te}", exc_info=True)
-        raise
-    except Exception as e:
-        logger.error(f"Unexpected Neo4j sync query error: {e}", exc_info=True)
-        raise
+async def cached_rag_context(chapter: str, query_text: str, top_k: int, min_similarity: float,
+                             retrieve: Callable[[], Awaitable[Optional[str]]]) -> Optional[str]:
+    """Serve RAG context from the versioned cache, calling `retrieve` on a miss.
+
+    Failed lookups (None) are not cached so a Neo4j or embedding outage is retried.
+    """
+    if rag_context_cache is None:
+        return await retrieve()
+    key = rag_context_cache.make_key(
+        kg_version_tracker.version if kg_version_tracker else None,
+        chapter, query_text, top_k, min_similarity)
+    context = rag_context_cache.get(key)
+    if context is not None:
+        logger.debug(f"RAG context cache hit for chapter '{chapter}'.")
+        return context
+    context = await retrieve()
+    if context is not None:
+        rag_context_cache.set(key, context)
+    return context
 
 
 async def retrieve_rag_context_vector_search(
-    driver: Optional[GraphDatabase.driver],
+    driver: Optional[Neo4jClient],
     chapter_name_sanitized: str,
     query_text: str,
     database_name: str,
     vector_index_name: str = "chunkVectorIndex",
     top_k_vector: int = 3,
     embedding_dimension: Optional[int] = EMBEDDING_DIMENSION,
-    context_chars_per_chunk: int = 600
-) -> str:
+    context_chars_per_chunk: int = 600,
+    min_similarity: float = 0.0
+) -> Optional[str]:
     """
     Retrieves context from Neo4j using vector search on Chunks first,
-    targeting chunks within a specific chapter.
+    targeting chunks within a specific chapter. Returns None if the lookup failed.
     """
     if not all([driver, chapter_name_sanitized, query_text, database_name,
                 isinstance(embedding_dimension, int) and embedding_dimension > 0, mistral_client]):
@@ -2787,9 +3459,25 @@ async def retrieve_rag_context_vector_search(
             "Skipping KG vector retrieval due to missing prerequisites.")
         return ""
 
+    return await cached_rag_context(
+        chapter_name_sanitized, query_text, top_k_vector, min_similarity,
+        lambda: _retrieve_rag_context_vector_search(
+            driver, chapter_name_sanitized, query_text,
+            vector_index_name, top_k_vector, context_chars_per_chunk, min_similarity))
+
+
+async def _retrieve_rag_context_vector_search(
+    driver: Neo4jClient,
+    chapter_name_sanitized: str,
+    query_text: str,
+    vector_index_name: str,
+    top_k_vector: int,
+    context_chars_per_chunk: int,
+    min_similarity: float
+) -> Optional[str]:
     query_embedding = await get_embedding_async(query_text)
     if not query_embedding:
-        return ""
+        return None
 
     vector_search_query = """
         CALL db.index.vector.queryNodes($indexName, $topK, $queryVector) YIELD node, score
@@ -2815,10 +3503,14 @@ async def retrieve_rag_context_vector_search(
     try:
         logger.info(
             f"Performing KG vector search for chapter '{chapter_name_sanitized}', query: '{query_text[:50]}...'")
-        records = await asyncio.to_thread(
-            _run_neo4j_query_sync, driver, vector_search_query, parameters, database_name
-        )
-        logger.debug(f"Neo4j vector query returned {len(records)} records.")
+        indexed = chunk_vector_index.search(
+            query_embedding, [chapter_name_sanitized], top_k_vector, min_similarity) if chunk_vector_index else None
+        if indexed is not None:
+            records = indexed
+            logger.debug(f"In-process vector index returned {len(records)} records.")
+        else:
+            records = await driver.run(vector_search_query, parameters, name="chapter_vector_search")
+            logger.debug(f"Neo4j vector query returned {len(records)} records.")
 
     except neo4j_exceptions.ClientError as e:
         if "index" in str(e).lower() and "not found" in str(e).lower():
@@ -2830,10 +3522,13 @@ async def retrieve_rag_context_vector_search(
         else:
             logger.error(
                 f"Neo4j Client Error during vector search: {e}", exc_info=True)
+        return None
     except Exception as e:
         logger.error(
             f"Error during KG vector search retrieval: {e}", exc_info=True)
+        return None
 
+    records = [r for r in records if r.get("score", 0.0) >= min_similarity]
     if records:
         context_parts = [
             f"Retrieved relevant context snippets for '{query_text}':"]
@@ -2939,7 +3634,7 @@ async def stream_llm_response(prompt: str, model_id: str, config: Optional[Gener
     #    yield json.dumps({"error": "Streaming Error"}) + "\n"
 
 
-async def diagnose_kg_issues(driver, chapter_name, database_name):
+async def diagnose_kg_issues(driver: Optional[Neo4jClient], chapter_name, database_name):
     """Check for actual chapter names in the knowledge graph."""
     if not driver:
         return "Neo4j driver not available"
@@ -2951,9 +3646,7 @@ async def diagnose_kg_issues(driver, chapter_name, database_name):
         LIMIT 50
         """
 
-        records = await asyncio.to_thread(
-            _run_neo4j_query_sync, driver, chapters_query, {}, database_name
-        )
+        records = await driver.run(chapters_query, name="diagnose_chapters")
 
         chapter_names = [r.get('chapter_name')
                          for r in records if r.get('chapter_name')]
@@ -2963,6 +3656,133 @@ async def diagnose_kg_issues(driver, chapter_name, database_name):
         return f"Diagnosis error: {str(e)}"
 
 
+async def retrieve_chapter_context(final_topic_name: str, query_text: str, top_k: int = 3,
+                                   min_similarity: float = 0.0) -> Optional[str]:
+    """Chapter-scoped RAG context for a topic, served from the versioned context cache."""
+    return await cached_rag_context(
+        final_topic_name, query_text, top_k, min_similarity,
+        lambda: _retrieve_chapter_context(final_topic_name, query_text, top_k, min_similarity))
+
+
+async def _retrieve_chapter_context(final_topic_name: str, query_text: str, top_k: int,
+                                    min_similarity: float) -> Optional[str]:
+    """Resolves the chapter once, then runs one vector search and at most one text fallback.
+
+    Returns None on failure so the result is not cached.
+    """
+    if chapter_catalog is None:
+        return None
+    await chapter_catalog.ensure_loaded()
+    if not chapter_catalog.ready:
+        return None
+    candidates, method = chapter_catalog.resolve(final_topic_name)
+    candidates = [c for c in candidates if chapter_catalog.get(c).chunks > 0]
+    cross_chapter = not candidates and config is not None and config.rag.enable_cross_chapter
+    logger.info(
+        f"Resolved '{final_topic_name}' to chapters {candidates} ({method})"
+        f"{' - searching all chapters' if cross_chapter else ''}.")
+    if not candidates and not cross_chapter:
+        return ""
+
+    failed = False
+    query_embedding = await get_embedding_async(query_text)
+    if not query_embedding:
+        failed = True
+    else:
+        # The Neo4j index ranks globally, so over-fetch before the chapter filter.
+        vector_search_query = """
+            CALL db.index.vector.queryNodes($indexName, $searchK, $queryVector) YIELD node, score
+            WHERE node:Chunk AND node.embedding IS NOT NULL AND score >= $minSimilarity
+            MATCH (chap:Chapter)<-[:PART_OF]-(node)
+            WHERE $crossChapter OR chap.name IN $candidates
+            RETURN node.text AS chunkText, score
+            ORDER BY score DESC
+            LIMIT $topK
+        """
+        parameters = {
+            "indexName": config.rag.vector_index_name if config else "chunkVectorIndex",
+            "searchK": top_k if cross_chapter else max(top_k * 10, 50),
+            "topK": top_k,
+            "queryVector": query_embedding,
+            "candidates": candidates,
+            "crossChapter": cross_chapter,
+            "minSimilarity": min_similarity
+        }
+
+        try:
+            records = chunk_vector_index.search(
+                query_embedding, None if cross_chapter else candidates, top_k, min_similarity
+            ) if chunk_vector_index else None
+            if records is None:
+                records = await neo4j_client.run(
+                    vector_search_query, parameters, name="candidate_vector_search")
+
+            if records:
+                context_parts = [
+                    f"Retrieved relevant context snippets for '{query_text}':"]
+
+                for i, record in enumerate(records):
+                    text = record.get("chunkText")
+                    score = record.get("score", 0.0)
+                    if text:
+                        truncated = text[:600] + \
+                            ('...' if len(text) > 600 else '')
+                        context_parts.append(
+                            f"- (Similarity: {score:.3f}) {truncated}")
+
+                if len(context_parts) > 1:
+                    logger.info(
+                        f"KG context successfully retrieved with {len(records)} chunks")
+                    return "\n".join(context_parts)
+
+        except Exception as e:
+            failed = True
+            logger.error(
+                f"Error during KG search for chapters {candidates}: {e}", exc_info=True)
+
+    if not candidates:
+        return None if failed else ""
+
+    try:
+        fallback_query = """
+        MATCH (c:Chapter)<-[:PART_OF]-(chunk:Chunk)
+        WHERE c.name IN $candidates
+        RETURN chunk.text AS chunkText
+        ORDER BY chunk.seq_id
+        LIMIT $topK
+        """
+        fallback_params = {"candidates": candidates, "topK": top_k}
+
+        logger.info(
+            f"Attempting fallback text retrieval for chapters {candidates}")
+        fallback_records = await neo4j_client.run(
+            fallback_query, fallback_params, name="chapter_text_fallback")
+
+        if fallback_records:
+            context_parts = [
+                f"Retrieved relevant context for '{query_text}' (text match):"]
+            for record in fallback_records:
+                text = record.get("chunkText")
+                if text:
+                    truncated = text[:600] + \
+                        ('...' if len(text) > 600 else '')
+                    context_parts.append(f"- {truncated}")
+
+            if len(context_parts) > 1:
+                logger.info(
+                    f"KG context retrieved via text fallback with {len(fallback_records)} chunks")
+                return "\n".join(context_parts)
+        else:
+            logger.info(
+                f"No context found via fallback retrieval for chapters {candidates}")
+    except Exception as e:
+        failed = True
+        logger.error(
+            f"Error during fallback search: {e}", exc_info=True)
+
+    return None if failed else ""
+
+
 @app.post("/content/next", response_class=StreamingResponse)
 async def get_next_content_stream(
     request: ContentRequest,
@@ -2983,21 +3803,16 @@ async def get_next_content_stream(
         raise HTTPException(
             status_code=503, detail="Core services unavailable.")
     use_rag = False
-    if neo4j_driver and mistral_client and NEO4J_DATABASE and isinstance(EMBEDDING_DIMENSION, int):
+    if neo4j_client and mistral_client and NEO4J_DATABASE and isinstance(EMBEDDING_DIMENSION, int):
         use_rag = True
     else:
         logger.warning(
             "One or more RAG dependencies missing/invalid. RAG disabled.")
 
-    session = await get_student_session_mongo(user_id)
-    if session is None:
-        logger.info(f"New session for user {user_id}.")
-        default_profile = StudentProfile(student_id=user_id)
-        session = StudentSessionData(
-            student_id=user_id, profile=default_profile, state=StudentState())
-    session.last_active = datetime.now(timezone.utc)
-    student_state = session.state
-    student_profile = session.profile
+    # Read-only snapshot for choosing and generating content; the session is updated at the end under its lock.
+    partial = await load_session_parts(user_id, ("state", "profile"))
+    student_state = partial.state if partial else StudentState()
+    student_profile = partial.profile if partial else StudentProfile(student_id=user_id)
 
     strategy = TeachingStrategies.EXPLANATION
     topic_idx = 0
@@ -3008,15 +3823,14 @@ async def get_next_content_stream(
     unwrapped_env = rl_system.unwrapped_env if rl_system else None
     if rl_system and rl_system.model and unwrapped_env:
         observation = prepare_observation_from_state(
-            student_state, student_profile, unwrapped_env)
+            student_state, student_profile, unwrapped_env, rl_system.observation_flattener)
+        action_mask = prepare_action_mask_from_state(
+            student_state, unwrapped_env)
         if observation is not None:
             try:
-                if random.random() < 0.3:  # 30% exploration rate
-                    action, _ = rl_system.model.predict(
-                        observation, deterministic=False)
-                else:
-                    action, _ = rl_system.model.predict(
-                        observation, deterministic=True)
+                # 30% exploration rate
+                action, _ = rl_system.predict(
+                    observation, action_mask=action_mask, deterministic=random.random() >= 0.3)
                 action = action.astype(int)
                 strategy = TeachingStrategies(action[0])
                 topic_idx = action[1]
@@ -3099,7 +3913,6 @@ async def get_next_content_stream(
     mastery_eff = base_mastery_factor + mastery_change_factor
     eff_diff = np.clip(base_diff+diff_adj+mastery_eff, 0.05, 0.95)
 
-    student_state.previous_mastery[final_topic_name] = mastery
     diff_desc = f"{final_difficulty_choice.name.capitalize()} ({eff_diff:.2f})"
 
     kg_context = ""
@@ -3107,118 +3920,8 @@ async def get_next_content_stream(
     query_text = request.subtopic if request.subtopic else final_topic_name.split(
         '-')[-1].replace('_', ' ')
     if use_rag and query_text and final_topic_name != "Default_Topic":
-        available_chapters = await diagnose_kg_issues(neo4j_driver, final_topic_name, NEO4J_DATABASE)
-        logger.info(f"Available chapters: {available_chapters}")
-
-        chapter_name_sanitized = re.sub(r'\W+', '_', final_topic_name)
-        chapter_name_alternatives = [
-            final_topic_name,
-            chapter_name_sanitized,
-            final_topic_name.replace(' ', '_'),
-            final_topic_name.split('-')[-1].strip()
-        ]
-
-        for chapter_try in chapter_name_alternatives:
-            logger.info(
-                f"Trying KG retrieval with chapter name: '{chapter_try}'")
-
-            vector_search_query = """
-                CALL db.index.vector.queryNodes($indexName, $topK, $queryVector) YIELD node, score
-                WHERE node:Chunk AND node.embedding IS NOT NULL
-                
-                // Try multiple matching approaches for chapter
-                OPTIONAL MATCH (chap:Chapter)<-[:PART_OF]-(node)
-                WHERE chap.name = $chapter_name 
-                   OR chap.name CONTAINS $chapter_name 
-                   OR $chapter_name CONTAINS chap.name
-                
-                // Only return results where a chapter was matched
-                WITH node, score, chap
-                WHERE chap IS NOT NULL
-                
-                RETURN node.text AS chunkText, score
-                ORDER BY score DESC
-                LIMIT $topK
-            """
-
-            parameters = {
-                "indexName": "chunkVectorIndex",
-                "topK": 3,
-                "queryVector": await get_embedding_async(query_text),
-                "chapter_name": chapter_try
-            }
-
-            try:
-                records = await asyncio.to_thread(
-                    _run_neo4j_query_sync, neo4j_driver, vector_search_query, parameters, NEO4J_DATABASE
-                )
-
-                if records:
-                    logger.info(
-                        f"KG match found using chapter name: {chapter_try}")
-                    context_parts = [
-                        f"Retrieved relevant context snippets for '{query_text}':"]
-
-                    for i, record in enumerate(records):
-                        text = record.get("chunkText")
-                        score = record.get("score", 0.0)
-                        if text:
-                            truncated = text[:600] + \
-                                ('...' if len(text) > 600 else '')
-                            context_parts.append(
-                                f"- (Similarity: {score:.3f}) {truncated}")
-
-                    if len(context_parts) > 1:
-                        kg_context = "\n".join(context_parts)
-                        kg_used = True
-                        logger.info(
-                            f"KG context successfully retrieved with {len(records)} chunks")
-                        break
-
-            except Exception as e:
-                logger.error(
-                    f"Error during KG search with '{chapter_try}': {e}", exc_info=True)
-
-        if not kg_used:
-            try:
-                topic_part = final_topic_name.split(
-                    '-')[-1].replace('_', ' ').strip()
-                fallback_query = """
-                MATCH (c:Chapter)
-                WHERE c.name CONTAINS $search_term OR $search_term CONTAINS c.name
-                MATCH (c)<-[:PART_OF]-(chunk:Chunk)
-                RETURN chunk.text AS chunkText
-                LIMIT 3
-                """
-                fallback_params = {"search_term": topic_part}
-
-                logger.info(
-                    f"Attempting fallback text search for '{topic_part}'")
-                fallback_records = await asyncio.to_thread(
-                    _run_neo4j_query_sync, neo4j_driver, fallback_query, fallback_params, NEO4J_DATABASE
-                )
-
-                if fallback_records:
-                    context_parts = [
-                        f"Retrieved relevant context for '{query_text}' (text match):"]
-                    for record in fallback_records:
-                        text = record.get("chunkText")
-                        if text:
-                            truncated = text[:600] + \
-                                ('...' if len(text) > 600 else '')
-                            context_parts.append(f"- {truncated}")
-
-                    if len(context_parts) > 1:
-                        kg_context = "\n".join(context_parts)
-                        kg_used = True
-                        logger.info(
-                            f"KG context retrieved via text fallback with {len(fallback_records)} chunks")
-                else:
-                    logger.info(
-                        f"No context found via fallback search for '{topic_part}'")
-            except Exception as e:
-                logger.error(
-                    f"Error during fallback search: {e}", exc_info=True)
+        kg_context = await retrieve_chapter_context(final_topic_name, query_text) or ""
+        kg_used = bool(kg_context)
     else:
         logger.debug(
             f"User {user_id}: Skipping RAG retrieval (use_rag={use_rag}, query='{query_text}', topic='{final_topic_name}').")
@@ -3287,13 +3990,17 @@ async def get_next_content_stream(
         length_choice=length_choice.name, subject=subject, content_type=request.content_type,
         difficulty_level_desc=diff_desc, mastery_at_request=mastery,
         effective_difficulty_value=eff_diff, prereq_satisfaction=prereq, kg_context_used=kg_used)
-    update_student_state_history(
-        student_state, final_topic_name, strategy.name, topic_map)
-    interaction_log = metadata.model_dump()
-    interaction_log["timestamp_utc"] = session.last_active.isoformat()
-    session.learning_path.append(interaction_log)
 
-    await save_student_session_mongo(session)
+    async def record_request(session: StudentSessionData):
+        session.last_active = datetime.now(timezone.utc)
+        session.state.previous_mastery[final_topic_name] = session.state.mastery.get(final_topic_name, 0.0)
+        update_student_state_history(
+            session.state, final_topic_name, strategy.name, topic_map)
+        interaction_log = metadata.model_dump()
+        interaction_log["timestamp_utc"] = session.last_active.isoformat()
+        await record_interaction(session, interaction_log)
+
+    await update_student_session(user_id, record_request, create=True)
 
     proc_time = (time.monotonic() - start_time) * 1000
     logger.info(
@@ -3327,16 +4034,18 @@ async def submit_feedback(
         f"User {user_id}: /feedback/submit - ID: {feedback_data.interaction_id}")
     if learning_db is None:
         raise HTTPException(status_code=503, detail="DB unavailable")
-    session = await get_student_session_mongo(user_id)
-    if not session:
-        raise HTTPException(status_code=404, detail="User session not found.")
-    now_utc = datetime.now(timezone.utc)
-    session.last_active = now_utc
 
-    try:
+    async def apply_feedback(session: StudentSessionData) -> Dict[str, Any]:
+        session.last_active = datetime.now(timezone.utc)
+        stored_interaction = None
+        if interaction_store and session.find_path_entry(interaction_id=feedback_data.interaction_id) is None:
+            stored_interaction = await interaction_store.find(
+                user_id, interaction_id=feedback_data.interaction_id)
+
         update_result = session.update_from_content_feedback(
             interaction_id=feedback_data.interaction_id,
-            feedback_data=feedback_data
+            feedback_data=feedback_data,
+            interaction=stored_interaction
         )
 
         if "error" in update_result:
@@ -3345,10 +4054,18 @@ async def submit_feedback(
             raise HTTPException(
                 status_code=404, detail=update_result["error"])
 
-        await save_student_session_mongo(session)
-
         if random.random() < 0.1:
             await optimize_session_storage(session)
+        return update_result
+
+    try:
+        session, update_result = await update_student_session(user_id, apply_feedback)
+        if session is None:
+            raise HTTPException(status_code=404, detail="User session not found.")
+
+        if interaction_store:
+            await interaction_store.update(
+                user_id, update_result.pop("interaction_update"), interaction_id=feedback_data.interaction_id)
 
         proc_time = (time.monotonic()-start_time)*1000
         logger.info(
@@ -3532,19 +4249,18 @@ async def generate_assessment(
     if together_client is None:
         raise HTTPException(status_code=503, detail="LLM service unavailable")
 
-    if open_router_client is None:
+    if open_router_client is None or exercise_generator is None:
         raise HTTPException(status_code=503, detail="LLM service unavailable")
 
     if learning_db is None:
         raise HTTPException(status_code=503, detail="DB unavailable")
 
-    session = await get_student_session_mongo(user_id)
-    if not session:
+    # Read-only snapshot; the session is updated under its lock once the assessment is set up.
+    partial = await load_session_parts(user_id, ("state", "profile"))
+    if not partial:
         raise HTTPException(status_code=404, detail="User session not found.")
-
-    session.last_active = datetime.now(timezone.utc)
-    student_state = session.state
-    student_profile = session.profile
+    student_state = partial.state
+    student_profile = partial.profile
 
     strategy = TeachingStrategies.ASSESSMENT
     topic_idx = 0
@@ -3556,11 +4272,13 @@ async def generate_assessment(
     unwrapped_env = rl_system.unwrapped_env if rl_system else None
     if rl_system and rl_system.model and unwrapped_env:
         observation = prepare_observation_from_state(
-            student_state, student_profile, unwrapped_env)
+            student_state, student_profile, unwrapped_env, rl_system.observation_flattener)
+        action_mask = prepare_action_mask_from_state(
+            student_state, unwrapped_env)
         if observation is not None:
             try:
-                action, _ = rl_system.model.predict(
-                    observation, deterministic=True)
+                action, _ = rl_system.predict(
+                    observation, action_mask=action_mask, deterministic=True)
                 action = action.astype(int)
                 strategy = TeachingStrategies(action[0])
                 topic_idx = action[1]
@@ -3655,7 +4373,7 @@ async def generate_assessment(
         '-')[0].replace('_', ' ') if '-' in final_topic_name else request.subject
 
     use_rag = False
-    if neo4j_driver and mistral_client and NEO4J_DATABASE and isinstance(EMBEDDING_DIMENSION, int):
+    if neo4j_client and mistral_client and NEO4J_DATABASE and isinstance(EMBEDDING_DIMENSION, int):
         use_rag = True
     else:
         logger.warning(
@@ -3666,33 +4384,11 @@ async def generate_assessment(
     query_text = final_topic_name.split('-')[-1].replace('_', ' ')
 
     if use_rag and final_topic_name != "Default_Topic":
-        chapter_name_sanitized = re.sub(r'\W+', '_', final_topic_name)
-        chapter_name_alternatives = [
-            final_topic_name,
-            chapter_name_sanitized,
-            final_topic_name.replace(' ', '_'),
-            final_topic_name.split('-')[-1].strip()
-        ]
-
-        for chapter_try in chapter_name_alternatives:
+        kg_context = await retrieve_chapter_context(final_topic_name, query_text) or ""
+        kg_used = bool(kg_context)
+        if kg_used:
             logger.info(
-                f"Trying KG retrieval for assessment with chapter name: '{chapter_try}'")
-
-            retrieved_context = await retrieve_rag_context_vector_search(
-                driver=neo4j_driver,
-                chapter_name_sanitized=chapter_try,
-                query_text=query_text,
-                database_name=NEO4J_DATABASE,
-                vector_index_name="chunkVectorIndex",
-                top_k_vector=3
-            )
-
-            if retrieved_context:
-                kg_context = retrieved_context
-                kg_used = True
-                logger.info(
-                    f"KG context successfully retrieved for assessment on {final_topic_name}")
-                break
+                f"KG context successfully retrieved for assessment on {final_topic_name}")
 
     metadata = InteractionMetadata(
         strategy=strategy.name,
@@ -3710,37 +4406,46 @@ async def generate_assessment(
         kg_context_used=kg_used,
     )
 
-    update_student_state_history(
-        student_state, final_topic_name, strategy.name, topic_map)
+    assessment_id = str(uuid4())
 
-    interaction_log = metadata.model_dump()
-    interaction_log["timestamp_utc"] = session.last_active.isoformat()
-    interaction_log["assessment_id"] = str(uuid4())
-    session.learning_path.append(interaction_log)
-
-    await save_student_session_mongo(session)
+    async def record_request(session: StudentSessionData):
+        session.last_active = datetime.now(timezone.utc)
+        update_student_state_history(
+            session.state, final_topic_name, strategy.name, topic_map)
+        interaction_log = metadata.model_dump()
+        interaction_log["timestamp_utc"] = session.last_active.isoformat()
+        interaction_log["assessment_id"] = assessment_id
+        await record_interaction(session, interaction_log)
 
-    exercise_generator = ExerciseGenerator(
-        # llm_client=together_client,
-        llm_client=open_router_client,
-        kg_client=neo4j_driver
-    )
+    session, _ = await update_student_session(user_id, record_request)
+    if session is None:
+        raise HTTPException(status_code=404, detail="User session not found.")
 
     misconceptions = request.misconceptions
-    if not misconceptions and final_topic_name in session.state.misconceptions:
+    if not misconceptions and final_topic_name in student_state.misconceptions:
         misconceptions = [final_topic_name]
 
-    assessment_id = interaction_log["assessment_id"]
-
     try:
-        questions = await exercise_generator.generate_multiple_exercises(
-            topic=final_topic_name,
-            difficulty=float(difficulty),
-            misconceptions=misconceptions,
-            question_count=request.question_count,
-            question_types=request.question_types,
-            provided_kg_context=kg_context
-        )
+        questions = []
+        # Misconception-targeted sets are always generated; banked questions are generic.
+        if question_bank and not misconceptions:
+            questions = await question_bank.draw(
+                user_id, final_topic_name, float(difficulty),
+                request.question_count, request.question_types)
+
+        if len(questions) < request.question_count:
+            generated = await exercise_generator.generate_multiple_exercises(
+                topic=final_topic_name,
+                difficulty=float(difficulty),
+                misconceptions=misconceptions,
+                question_count=request.question_count - len(questions),
+                question_types=request.question_types,
+                provided_kg_context=kg_context
+            )
+            if question_bank and not misconceptions:
+                question_bank.add_later(
+                    final_topic_name, float(difficulty), generated, served_to=[user_id])
+            questions += generated
 
         assessment_doc = {
             "assessment_id": assessment_id,
@@ -3781,7 +4486,7 @@ async def evaluate_assessment(
     if together_client is None:
         raise HTTPException(status_code=503, detail="LLM service unavailable")
 
-    if open_router_client is None:
+    if open_router_client is None or assessment_engine is None:
         raise HTTPException(status_code=503, detail="LLM service unavailable")
 
     if learning_db is None:
@@ -3795,20 +4500,14 @@ async def evaluate_assessment(
     if not assessment:
         raise HTTPException(status_code=404, detail="Assessment not found")
 
-    assessment_engine = AssessmentEngine(
-        # llm_client=together_client
-        llm_client=open_router_client
-    )
-
-    session = await get_student_session_mongo(user_id)
-    if not session:
+    # Read-only snapshot for grading; state changes are applied under the session lock afterwards.
+    snapshot = await load_session_parts(user_id, ("state", "profile", "learning_path"))
+    if not snapshot:
         raise HTTPException(status_code=404, detail="User session not found.")
 
-    interaction_log = None
-    for i, interaction in enumerate(session.learning_path):
-        if isinstance(interaction, dict) and interaction.get("assessment_id") == request.assessment_id:
-            interaction_log = interaction
-            break
+    interaction_log = find_path_entry(snapshot.learning_path, assessment_id=request.assessment_id)
+    if interaction_log is None and interaction_store:
+        interaction_log = await interaction_store.find(user_id, assessment_id=request.assessment_id)
 
     if not interaction_log:
         logger.warning(
@@ -3820,10 +4519,10 @@ async def evaluate_assessment(
     assessment_topic = assessment.get("topic", original_topic)
 
     state_topic_key = original_topic
-    if original_topic not in session.state.mastery:
+    if original_topic not in snapshot.state.mastery:
         best_match = None
         best_score = 0
-        for topic_key in session.state.mastery:
+        for topic_key in snapshot.state.mastery:
             if original_topic in topic_key or topic_key in original_topic:
                 score = len(set(original_topic.lower().split())
                             & set(topic_key.lower().split()))
@@ -3839,129 +4538,138 @@ async def evaluate_assessment(
             logger.warning(
                 f"No matching topic found for '{original_topic}' in state.mastery")
 
-    evaluation_tasks = []
+    questions_by_id = {q.get("id"): q for q in assessment["questions"]}
+    graded_ids = []
+    grading_items = []
     for response_data in request.responses:
         question_id = response_data.get("question_id")
-        student_response = response_data.get("response")
-
-        question = next(
-            (q for q in assessment["questions"] if q.get("id") == question_id), None)
+        question = questions_by_id.get(question_id)
         if not question:
             continue
 
-        task = assessment_engine.evaluate_response(
-            question=question.get("question", ""),
-            student_response=student_response,
-            correct_answer=question.get("correct_answer", ""),
-            question_type=question.get("exercise_type", "short_answer"),
-            topic=assessment_topic,
-            subject=assessment.get("subject", ""),
-            grade=session.profile.grade
-        )
-        evaluation_tasks.append((question_id, task))
+        graded_ids.append(question_id)
+        grading_items.append({
+            "question": question.get("question", ""),
+            "student_response": response_data.get("response"),
+            "correct_answer": question.get("correct_answer", ""),
+            "question_type": question.get("exercise_type", "short_answer"),
+            "topic": assessment_topic,
+            "subject": assessment.get("subject", ""),
+            "grade": snapshot.profile.grade,
+            "explanation": question.get("explanation", "")
+        })
+
+    results = await assessment_engine.batch_evaluate(
+        grading_items, batch_llm=config.assessment.batch_llm_grading)
 
     evaluations = {}
     total_score = 0
 
-    for question_id, task in evaluation_tasks:
-        try:
-            result = await task
+    for question_id, result in zip(graded_ids, results):
+        if isinstance(result, Exception):
+            logger.error(
+                f"Error evaluating response for question {question_id}: {result}")
+            evaluations[question_id] = {"error": str(result), "score": 0}
+        else:
             evaluations[question_id] = result.model_dump()
             total_score += result.score
-        except Exception as e:
-            logger.error(
-                f"Error evaluating response for question {question_id}: {e}", exc_info=True)
-            evaluations[question_id] = {"error": str(e), "score": 0}
 
     question_count = len(request.responses)
     average_score = total_score / question_count if question_count > 0 else 0
 
-    student_state = session.state
-
     mastery_at_request = interaction_log.get("mastery_at_request", 0.0)
 
-    current_mastery = student_state.mastery.get(
-        state_topic_key, mastery_at_request)
-
-    mastery_impact = 0
-
-    if average_score >= 90:
-        mastery_impact = 0.20
-    elif average_score >= 80:
-        mastery_impact = 0.15
-    elif average_score >= 70:
-        mastery_impact = 0.10
-    elif average_score >= 60:
-        mastery_impact = 0.05
-    elif average_score >= 50:
-        mastery_impact = 0.02
-    elif average_score >= 40:
-        mastery_impact = 0.01
-    elif average_score >= 30:
-        mastery_impact = -0.02
-    elif average_score >= 20:
-        mastery_impact = -0.05
-    elif average_score >= 10:
-        mastery_impact = -0.08
-    else:
-        mastery_impact = -0.10
+    async def apply_assessment(session: StudentSessionData) -> Tuple[float, float, Dict[str, Any]]:
+        student_state = session.state
+        current_mastery = student_state.mastery.get(
+            state_topic_key, mastery_at_request)
+
+        mastery_impact = 0
+
+        if average_score >= 90:
+            mastery_impact = 0.20
+        elif average_score >= 80:
+            mastery_impact = 0.15
+        elif average_score >= 70:
+            mastery_impact = 0.10
+        elif average_score >= 60:
+            mastery_impact = 0.05
+        elif average_score >= 50:
+            mastery_impact = 0.02
+        elif average_score >= 40:
+            mastery_impact = 0.01
+        elif average_score >= 30:
+            mastery_impact = -0.02
+        elif average_score >= 20:
+            mastery_impact = -0.05
+        elif average_score >= 10:
+            mastery_impact = -0.08
+        else:
+            mastery_impact = -0.10
 
-    student_state.previous_mastery[state_topic_key] = current_mastery
+        student_state.previous_mastery[state_topic_key] = current_mastery
 
-    new_mastery = min(1.0, max(0.0, current_mastery + mastery_impact))
-    student_state.mastery[state_topic_key] = new_mastery
+        new_mastery = min(1.0, max(0.0, current_mastery + mastery_impact))
+        student_state.mastery[state_topic_key] = new_mastery
 
-    logger.info(
-        f"Mastery update for '{state_topic_key}': {current_mastery:.4f} → {new_mastery:.4f} (impact: {mastery_impact:.4f})")
+        logger.info(
+            f"Mastery update for '{state_topic_key}': {current_mastery:.4f} → {new_mastery:.4f} (impact: {mastery_impact:.4f})")
 
-    normalized_score = average_score / 100.0
-    student_state.recent_performance = np.clip(
-        0.6 * student_state.recent_performance + 0.4 * normalized_score, 0.0, 1.0
-    )
+        normalized_score = average_score / 100.0
+        student_state.recent_performance = np.clip(
+            0.6 * student_state.recent_performance + 0.4 * normalized_score, 0.0, 1.0
+        )
 
-    mot_chg = 0.0
-    if mastery_impact > 0.01:
-        mot_chg += 0.02
-    if mastery_impact > 0.05:
-        mot_chg += 0.03
-    if average_score < 40:
-        mot_chg -= 0.03
-    student_state.motivation = np.clip(
-        student_state.motivation + mot_chg, 0.1, 0.95)
-
-    if average_score < 50:
-        misconception_strength = (50 - average_score) / 50 * 0.7
-        student_state.misconceptions[state_topic_key] = max(
-            student_state.misconceptions.get(state_topic_key, 0.0),
-            misconception_strength
+        mot_chg = 0.0
+        if mastery_impact > 0.01:
+            mot_chg += 0.02
+        if mastery_impact > 0.05:
+            mot_chg += 0.03
+        if average_score < 40:
+            mot_chg -= 0.03
+        student_state.motivation = np.clip(
+            student_state.motivation + mot_chg, 0.1, 0.95)
+
+        if average_score < 50:
+            misconception_strength = (50 - average_score) / 50 * 0.7
+            student_state.misconceptions[state_topic_key] = max(
+                student_state.misconceptions.get(state_topic_key, 0.0),
+                misconception_strength
+            )
+
+        student_state.engagement = np.clip(
+            student_state.engagement + (0.03 if average_score > 70 else -0.02),
+            0.1, 0.95
         )
 
-    student_state.engagement = np.clip(
-        student_state.engagement + (0.03 if average_score > 70 else -0.02),
-        0.1, 0.95
-    )
+        cognitive_load_change = 0.03 if average_score < 45 else -0.02
+        student_state.cognitive_load = np.clip(
+            student_state.cognitive_load + cognitive_load_change,
+            0.1, 0.95
+        )
 
-    cognitive_load_change = 0.03 if average_score < 45 else -0.02
-    student_state.cognitive_load = np.clip(
-        student_state.cognitive_load + cognitive_load_change,
-        0.1, 0.95
-    )
+        interaction_update = {
+            "completed": True,
+            "score": average_score,
+            "mastery_before_assessment": current_mastery,
+            "mastery_after_assessment": new_mastery,
+            "mastery_gain": new_mastery - current_mastery,
+            "completed_at": datetime.now(timezone.utc).isoformat()
+        }
+        path_entry = session.find_path_entry(assessment_id=request.assessment_id)
+        if path_entry is not None:
+            path_entry.update(interaction_update)
+        return current_mastery, new_mastery, interaction_update
 
-    for i, interaction in enumerate(session.learning_path):
-        if isinstance(interaction, dict) and interaction.get("assessment_id") == request.assessment_id:
-            session.learning_path[i].update({
-                "completed": True,
-                "score": average_score,
-                "mastery_before_assessment": current_mastery,
-                "mastery_after_assessment": new_mastery,
-                "mastery_gain": new_mastery - current_mastery,
-                "completed_at": datetime.now(timezone.utc).isoformat()
-            })
-            logger.info(
-                f"Updated learning path for assessment {request.assessment_id} with mastery changes")
-            break
+    session, applied = await update_student_session(user_id, apply_assessment)
+    if session is None:
+        raise HTTPException(status_code=404, detail="User session not found.")
+    current_mastery, new_mastery, interaction_update = applied
 
-    await save_student_session_mongo(session)
+    if interaction_store:
+        await interaction_store.update(user_id, interaction_update, assessment_id=request.assessment_id)
+    logger.info(
+        f"Updated learning path for assessment {request.assessment_id} with mastery changes")
 
     await learning_db["assessments"].update_one(
         {"assessment_id": request.assessment_id},
@@ -4098,19 +4806,22 @@ async def get_assessment_detail(
 
         assessment["_id"] = str(assessment["_id"])
 
-        session = await get_student_session_mongo(user_id)
-        if session:
-            for entry in session.learning_path:
-                if isinstance(entry, dict) and entry.get("assessment_id") == assessment_id:
-                    assessment["learning_path_data"] = {
-                        "mastery_at_request": entry.get("mastery_at_request"),
-                        "mastery_before_assessment": entry.get("mastery_before_assessment"),
-                        "mastery_after_assessment": entry.get("mastery_after_assessment"),
-                        "mastery_gain": entry.get("mastery_gain"),
-                        "timestamp_utc": entry.get("timestamp_utc"),
-                        "completed_at": entry.get("completed_at")
-                    }
-                    break
+        entry = None
+        if interaction_store:
+            entry = await interaction_store.find(user_id, assessment_id=assessment_id)
+        if entry is None:
+            path = await load_learning_path_tail(user_id, config.session.learning_path_tail) or []
+            entry = next((e for e in path if isinstance(e, dict)
+                          and e.get("assessment_id") == assessment_id), None)
+        if entry:
+            assessment["learning_path_data"] = {
+                "mastery_at_request": entry.get("mastery_at_request"),
+                "mastery_before_assessment": entry.get("mastery_before_assessment"),
+                "mastery_after_assessment": entry.get("mastery_after_assessment"),
+                "mastery_gain": entry.get("mastery_gain"),
+                "timestamp_utc": entry.get("timestamp_utc"),
+                "completed_at": entry.get("completed_at")
+            }
 
         if "common_misconceptions" not in assessment and "evaluations" in assessment:
             all_misconceptions = []
@@ -4148,12 +4859,73 @@ async def optimize_database(cleanup_older_than_days: int = 90):
     if learning_db is None:
         raise HTTPException(status_code=503, detail="DB unavailable")
 
+    interactions_result = None
+    if interaction_store:
+        # Move embedded paths out first so the optimized model's pruning never drops history.
+        interactions_result = await interaction_store.migrate_embedded_paths(
+            learning_db["learning_states"], config.session.learning_path_tail)
+
     migration_result = await migrate_to_optimized_model(learning_db)
+    if session_store:
+        session_store.invalidate()
 
     return {
+        "interactions_migration": interactions_result,
         "migration_result": migration_result
     }
 
+@app.get("/admin/cache-stats")
+async def get_cache_stats():
+    """Hit/miss counters for the in-process caches."""
+    warmup = None
+    if embedding_warmup_task:
+        if not embedding_warmup_task.done():
+            warmup = "running"
+        elif embedding_warmup_task.cancelled() or embedding_warmup_task.exception():
+            warmup = "failed"
+        else:
+            warmup = embedding_warmup_task.result()
+    return {
+        "embeddings": embedding_cache.stats() if embedding_cache else None,
+        "embedding_service": embedding_service.stats() if embedding_service else None,
+        "topic_query_warmup": warmup,
+        "rag_context": rag_context_cache.stats() if rag_context_cache else None,
+        "kg_version": kg_version_tracker.stats() if kg_version_tracker else None,
+        "chunk_vector_index": chunk_vector_index.stats() if chunk_vector_index else None,
+        "chapter_catalog": chapter_catalog.stats() if chapter_catalog else None,
+        "kg_schema": kg_schema.stats() if kg_schema else None,
+        "exercise_generator": exercise_generator.stats() if exercise_generator else None,
+        "assessment_engine": assessment_engine.stats() if assessment_engine else None,
+        "question_bank": question_bank.stats() if question_bank else None,
+        "interactions": interaction_store.stats() if interaction_store else None,
+        "sessions": session_store.stats() if session_store else None,
+    }
+
+
+@app.get("/admin/neo4j-stats")
+async def get_neo4j_stats():
+    """Connection pool settings and per-query latency for the async Neo4j client."""
+    if neo4j_client is None:
+        raise HTTPException(status_code=503, detail="Neo4j unavailable")
+    return neo4j_client.stats()
+
+
+@app.get("/admin/kg/diagnose")
+async def diagnose_knowledge_graph(chapter_name: Optional[str] = None):
+    """List the chapters in the KG and, optionally, how a topic name resolves against them."""
+    if neo4j_client is None:
+        raise HTTPException(status_code=503, detail="Neo4j unavailable")
+    chapters = await diagnose_kg_issues(neo4j_client, chapter_name, NEO4J_DATABASE)
+    if not isinstance(chapters, list):
+        raise HTTPException(status_code=500, detail=chapters)
+    result = {"chapters": chapters,
+              "catalog": chapter_catalog.stats() if chapter_catalog else None}
+    if chapter_name and chapter_catalog:
+        candidates, method = chapter_catalog.resolve(chapter_name)
+        result["resolution"] = {"candidates": candidates, "method": method,
+                                "chapters": [chapter_catalog.get(c)._asdict() for c in candidates]}
+    return result
+
 # Add this after your other route definitions, before the main block
 
 
@@ -4168,19 +4940,18 @@ async def get_system_metrics():
     # Content generation metrics
     try:
         # Ensure feedback_details exists before accessing nested fields
-        content_pipeline = await learning_db["learning_states"].aggregate([
-            {"$unwind": "$learning_path"},
+        content_pipeline = await learning_db["interactions"].aggregate([
             {"$match": {
-                "learning_path.content_type": {"$exists": True}
+                "content_type": {"$exists": True}
                 # Add filter for existing feedback if needed for ratings/completion
-                # "learning_path.feedback_details": {"$exists": True, "$ne": None}
+                # "feedback_details": {"$exists": True, "$ne": None}
             }},
             {"$group": {
-                "_id": "$learning_path.content_type",
+                "_id": "$content_type",
                 "count": {"$sum": 1},
                 # Use $ifNull to handle potentially missing feedback details
-                "avg_helpful_rating": {"$avg": {"$ifNull": ["$learning_path.feedback_details.helpful_rating", None]}},
-                "avg_completion": {"$avg": {"$ifNull": ["$learning_path.feedback_details.completion_percentage", None]}}
+                "avg_helpful_rating": {"$avg": {"$ifNull": ["$feedback_details.helpful_rating", None]}},
+                "avg_completion": {"$avg": {"$ifNull": ["$feedback_details.completion_percentage", None]}}
             }}
         ]).to_list(length=100)
 
@@ -4197,19 +4968,18 @@ async def get_system_metrics():
     # Strategy effectiveness metrics
     try:
         # Ensure necessary fields for subtraction exist
-        strategy_pipeline = await learning_db["learning_states"].aggregate([
-            {"$unwind": "$learning_path"},
+        strategy_pipeline = await learning_db["interactions"].aggregate([
             {"$match": {
-                "learning_path.strategy": {"$exists": True},
+                "strategy": {"$exists": True},
                 # Ensure both mastery fields are present and numeric for subtraction
-                "learning_path.mastery_after_feedback": {"$exists": True, "$type": "number"},
-                "learning_path.mastery_at_request": {"$exists": True, "$type": "number"}
+                "mastery_after_feedback": {"$exists": True, "$type": "number"},
+                "mastery_at_request": {"$exists": True, "$type": "number"}
             }},
             {"$group": {
-                "_id": "$learning_path.strategy",
+                "_id": "$strategy",
                 "count": {"$sum": 1},
                 "avg_mastery_gain": {"$avg": {
-                    "$subtract": ["$learning_path.mastery_after_feedback", "$learning_path.mastery_at_request"]
+                    "$subtract": ["$mastery_after_feedback", "$mastery_at_request"]
                 }}
             }}
         ]).to_list(length=100)
@@ -4298,8 +5068,8 @@ async def get_student_metrics_endpoint(
             raise HTTPException(
                 status_code=503, detail="Database service unavailable")
 
-        # Ensure neo4j_driver is passed if available, handle None inside Analytics class
-        analytics = LearningAnalytics(learning_db, neo4j_driver)
+        # Ensure neo4j_client is passed if available, handle None inside Analytics class
+        analytics = LearningAnalytics(learning_db, neo4j_client)
         student_analytics_summary = await analytics.get_student_analytics(student_id)
 
         if "error" in student_analytics_summary:
@@ -4336,55 +5106,25 @@ async def get_student_learning_path(
         raise HTTPException(
             status_code=503, detail="Database service unavailable")
 
+    if interaction_store is None:
+        raise HTTPException(
+            status_code=503, detail="Database service unavailable")
+
     try:
         skip = (page - 1) * limit
-        pipeline = [
-            {"$match": {"student_id": student_id}},
-            {"$project": {
-                "_id": 0,
-                "total": {"$size": {"$ifNull": ["$learning_path", []]}},
-                "items": {"$slice": [{"$ifNull": ["$learning_path", []]}, skip, limit]}
-            }},
-            {"$project": {
-                "total": 1,
-                "items": {
-                    "$map": {
-                        "input": "$items", "as": "item", "in": {
-                            "interaction_id": "$$item.interaction_id",
-                            "timestamp_utc": "$$item.timestamp_utc",
-                            "topic": "$$item.topic",
-                            "strategy": "$$item.strategy",
-                            "content_type": "$$item.content_type",
-                            "mastery_at_request": "$$item.mastery_at_request",
-                            "mastery_after_feedback": "$$item.mastery_after_feedback",
-                            "feedback_details": {  # Project nested fields safely
-                                "assessment_score": {"$ifNull": ["$$item.feedback_details.assessment_score", None]},
-                                "completion_percentage": {"$ifNull": ["$$item.feedback_details.completion_percentage", None]},
-                                "helpful_rating": {"$ifNull": ["$$item.feedback_details.helpful_rating", None]},
-                                "engagement_rating": {"$ifNull": ["$$item.feedback_details.engagement_rating", None]},
-                                "time_spent_seconds": {"$ifNull": ["$$item.feedback_details.time_spent_seconds", None]}
-                            }
-                        }
-                    }
-                }
-            }}
-        ]
-        result_list = await learning_db["learning_states"].aggregate(pipeline).to_list(length=1)
-
-        if not result_list:
-            return PaginatedResponse(page=page, limit=limit, total=0, items=[])
-
-        result_data = result_list[0]
-        total_count = result_data.get("total", 0)
-        items = result_data.get("items", [])
+        total_count, items = await asyncio.gather(
+            interaction_store.count(student_id),
+            interaction_store.history(student_id, skip=skip, limit=limit, projection=PATH_PROJECTION))
+        for item in items:
+            details = item.get("feedback_details") or {}
+            item["feedback_details"] = {field: details.get(field) for field in (
+                "assessment_score", "completion_percentage", "helpful_rating",
+                "engagement_rating", "time_spent_seconds")}
 
         return PaginatedResponse(page=page, limit=limit, total=total_count, items=items)
     except Exception as e:
         logger.error(
-            f"Error fetching learning path for {student_id} using aggregation: {e}", exc_info=True)
-        if isinstance(e, OperationFailure) and 'Path collision' in str(e):
-            raise HTTPException(
-                status_code=500, detail="DB query conflict processing learning path.")
+            f"Error fetching learning path for {student_id}: {e}", exc_info=True)
         raise HTTPException(
             status_code=500, detail="Failed to retrieve learning path")
 
@@ -4459,7 +5199,7 @@ async def get_student_mastery_heatmap(
             status_code=503, detail="Database service unavailable")
 
     try:
-        analytics = LearningAnalytics(learning_db, neo4j_driver)
+        analytics = LearningAnalytics(learning_db, neo4j_client)
         heatmap_data = await analytics.generate_mastery_heatmap(student_id)
         # generate_mastery_heatmap now returns HeatmapResponse directly
         if not heatmap_data.subjects:
@@ -4477,21 +5217,20 @@ async def get_topic_metrics():
     if learning_db is None:
         raise HTTPException(status_code=503, detail="DB unavailable")
     try:
-        # Pipeline to aggregate topic stats from learning path
-        topic_pipeline = await learning_db["learning_states"].aggregate([
-            {"$unwind": "$learning_path"},
+        # Pipeline to aggregate topic stats from the interactions log
+        topic_pipeline = await learning_db["interactions"].aggregate([
             {"$match": {
-                "learning_path.topic": {"$exists": True},
-                "learning_path.mastery_after_feedback": {"$exists": True, "$type": "number"},
-                "learning_path.mastery_at_request": {"$exists": True, "$type": "number"}
+                "topic": {"$exists": True},
+                "mastery_after_feedback": {"$exists": True, "$type": "number"},
+                "mastery_at_request": {"$exists": True, "$type": "number"}
             }},
             {"$group": {
-                "_id": "$learning_path.topic",
+                "_id": "$topic",
                 "attempts": {"$sum": 1},
-                "total_mastery_gain": {"$sum": {"$subtract": ["$learning_path.mastery_after_feedback", "$learning_path.mastery_at_request"]}},
+                "total_mastery_gain": {"$sum": {"$subtract": ["$mastery_after_feedback", "$mastery_at_request"]}},
                 # Get the LAST mastery_after_feedback for each topic per user, then average those
                 # This requires a more complex pipeline, maybe simplify for now
-                # "avg_final_mastery": {"$avg": "$learning_path.mastery_after_feedback"} # This averages over all interactions, not final mastery
+                # "avg_final_mastery": {"$avg": "$mastery_after_feedback"} # This averages over all interactions, not final mastery
             }},
             {"$addFields": {
                 "learning_velocity": {"$divide": ["$total_mastery_gain", "$attempts"]}
@@ -4507,29 +5246,25 @@ async def get_topic_metrics():
 
         # Get topic clusters (keep simple version for now)
         topic_clusters = []
-        if neo4j_driver:
+        if neo4j_client:
             try:
-                with neo4j_driver.session(database=NEO4J_DATABASE) as session:
-                    result = session.run("""
-                    MATCH (c:Concept)-[r:RELATED_TO|PART_OF]-(related:Concept) // Only use existing types
-                    WHERE c <> related
-                    WITH c, collect(DISTINCT related.name) as relatedConcepts
-                    RETURN c.name as topic, relatedConcepts
-                    LIMIT 200
-                    """)  # Limit results for performance
-                    concept_relations = [
-                        {"topic": record["topic"], "related": record["related"]} for record in result]
-                    # Basic grouping - needs refinement if complex clustering is desired
-                    processed = set()
-                    for relation in concept_relations:
-                        if relation["topic"] in processed:
-                            continue
-                        cluster = {relation["topic"]} | set(
-                            relation["related"])
-                        if len(cluster) > 1:
-                            topic_clusters.append(
-                                {"topics": list(cluster), "size": len(cluster)})
-                        processed.update(cluster)
+                concept_relations = await neo4j_client.run("""
+                MATCH (c:Concept)-[r:RELATED_TO|PART_OF]-(related:Concept) // Only use existing types
+                WHERE c <> related
+                WITH c, collect(DISTINCT related.name) as related
+                RETURN c.name as topic, related
+                LIMIT 200
+                """, name="topic_metric_clusters", mapper=as_concept_relations)  # Limit results for performance
+                # Basic grouping - needs refinement if complex clustering is desired
+                processed = set()
+                for relation in concept_relations:
+                    if relation.topic in processed:
+                        continue
+                    cluster = {relation.topic} | set(relation.related)
+                    if len(cluster) > 1:
+                        topic_clusters.append(
+                            {"topics": list(cluster), "size": len(cluster)})
+                    processed.update(cluster)
             except Exception as e:
                 logger.error(
                     f"Error getting knowledge graph clusters for topic metrics: {e}", exc_info=True)
@@ -4563,9 +5298,9 @@ async def healthcheck():
             deps["mongodb"] = "ok"
         except Exception:
             pass
-    if neo4j_driver:
+    if neo4j_client:
         try:
-            await asyncio.to_thread(neo4j_driver.verify_connectivity)
+            await neo4j_client.verify_connectivity()
             deps["neo4j"] = "ok"
         except Exception:
             pass
@@ -4620,17 +5355,19 @@ async def healthcheck():
 
 @app.get("/analytics/student/{student_id}")
 async def get_student_analytics(student_id: str):
-    session = await get_student_session_mongo(student_id)
+    state = await load_session_state(student_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Student session not found")
 
     topic_velocities = {}
-    for topic, mastery in session.state.mastery.items():
-        attempts = session.state.topic_attempts.get(topic, 1)
+    for topic, mastery in state.mastery.items():
+        attempts = state.topic_attempts.get(topic, 1)
         topic_velocities[topic] = mastery / attempts
 
     strategy_effects = {}
 
     return {
-        "mastery_by_topic": session.state.mastery,
+        "mastery_by_topic": state.mastery,
         "learning_velocity": topic_velocities,
         "effective_strategies": strategy_effects
     }
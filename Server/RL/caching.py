@@ -0,0 +1,187 @@
+import os
+import time
+import sqlite3
+import threading
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger("caching")
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Bounded in-memory LRU with an optional TTL and hit/miss counters."""
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: Optional[float] = None, name: str = "cache"):
+        self.name = name
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING:
+            self.misses += 1
+            return default
+        value, expires_at = entry
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds else None
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[0]
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name, "size": len(self._data), "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds, "hits": self.hits, "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions, "expirations": self.expirations,
+        }
+
+
+class EmbeddingCache:
+    """Two-tier embedding cache: in-memory LRU in front of a SQLite file shared by all workers on the host.
+
+    Entries are keyed by sha256(model + text) and stored on disk as float32 blobs,
+    so the cache survives restarts and is safe to share between uvicorn workers
+    (SQLite WAL mode handles concurrent readers and writers).
+    """
+
+    def __init__(self, model_name: str, path: Optional[str] = "./cache/embeddings.sqlite3",
+                 max_entries: int = 4096, ttl_seconds: Optional[float] = 24 * 3600,
+                 dimension: Optional[int] = None):
+        self.model_name = model_name
+        self.dimension = dimension
+        self.memory = LRUCache(max_entries, ttl_seconds, name="embeddings_memory")
+        self.disk_hits = 0
+        self.disk_misses = 0
+        self.disk_writes = 0
+        self.disk_errors = 0
+        self._db: Optional[sqlite3.Connection] = None
+        # The disk tier is used from worker threads (see EmbeddingService), one statement at a time.
+        self._db_lock = threading.Lock()
+        if path:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                self._db = sqlite3.connect(
+                    path, timeout=5.0, isolation_level=None, check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("PRAGMA synchronous=NORMAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS embeddings ("
+                    "key TEXT PRIMARY KEY, model TEXT NOT NULL, dim INTEGER NOT NULL, "
+                    "vector BLOB NOT NULL, created_at REAL NOT NULL)")
+                logger.info(f"Embedding disk cache at {path}")
+            except sqlite3.Error as e:
+                logger.warning(
+                    f"Embedding disk cache unavailable ({e}); using memory tier only.")
+                self._db = None
+
+    def key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\x00{text}".encode("utf-8")).hexdigest()
+
+    def get(self, text: str) -> Optional[List[float]]:
+        embedding = self.get_memory(text)
+        return embedding if embedding is not None else self.get_disk(text)
+
+    def get_memory(self, text: str) -> Optional[List[float]]:
+        return self.memory.get(self.key(text))
+
+    @property
+    def has_disk(self) -> bool:
+        return self._db is not None
+
+    def get_disk(self, text: str, remember: bool = True) -> Optional[List[float]]:
+        """Blocking SQLite lookup; async callers run it in a thread with `remember=False`
+        and fill the (not thread-safe) memory tier themselves."""
+        if self._db is None:
+            return None
+        key = self.key(text)
+        try:
+            with self._db_lock:
+                row = self._db.execute(
+                    "SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            self.disk_errors += 1
+            logger.warning(f"Embedding disk cache read failed: {e}")
+            return None
+        if row is None:
+            self.disk_misses += 1
+            return None
+        self.disk_hits += 1
+        embedding = np.frombuffer(row[0], dtype=np.float32).tolist()
+        if remember:
+            self.memory.set(key, embedding)
+        return embedding
+
+    def put(self, text: str, embedding: List[float], disk: bool = True):
+        if self.dimension and len(embedding) != self.dimension:
+            return
+        self.memory.set(self.key(text), embedding)
+        if disk:
+            self.put_disk([(text, embedding)])
+
+    def put_disk(self, items: List[Tuple[str, List[float]]]):
+        """Blocking SQLite write of several embeddings; async callers run it in a thread."""
+        rows = [(self.key(text), self.model_name, len(embedding),
+                 np.asarray(embedding, dtype=np.float32).tobytes(), time.time())
+                for text, embedding in items if not (self.dimension and len(embedding) != self.dimension)]
+        if self._db is None or not rows:
+            return
+        try:
+            with self._db_lock:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, model, dim, vector, created_at) VALUES (?, ?, ?, ?, ?)",
+                    rows)
+            self.disk_writes += len(rows)
+        except sqlite3.Error as e:
+            self.disk_errors += 1
+            logger.warning(f"Embedding disk cache write failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        memory = self.memory.stats()
+        lookups = memory["hits"] + memory["misses"]
+        return {
+            "model": self.model_name,
+            "memory": memory,
+            "disk": {"enabled": self._db is not None, "hits": self.disk_hits, "misses": self.disk_misses,
+                     "writes": self.disk_writes, "errors": self.disk_errors},
+            "hit_rate": round((memory["hits"] + self.disk_hits) / lookups, 4) if lookups else 0.0,
+        }
+
+    def close(self):
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+                self._db = None
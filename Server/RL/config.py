@@ -23,6 +23,14 @@ class DatabaseConfig(BaseModel):
     neo4j_username: str = Field("neo4j", description="Neo4j username")
     neo4j_password: Optional[str] = Field(None, description="Neo4j password")
     neo4j_database: str = Field("neo4j", description="Neo4j database name")
+    neo4j_max_pool_size: int = Field(
+        50, ge=1, description="Maximum Neo4j connections in the async driver pool")
+    neo4j_connection_timeout: float = Field(
+        10.0, gt=0, description="Seconds to establish a Neo4j connection")
+    neo4j_acquisition_timeout: float = Field(
+        30.0, gt=0, description="Seconds to wait for a pooled Neo4j connection")
+    neo4j_query_timeout: float = Field(
+        15.0, gt=0, description="Server-side timeout for a single Neo4j query")
 
 
 class LLMConfig(BaseModel):
@@ -61,12 +69,43 @@ class EmbeddingConfig(BaseModel):
     ocr_max_wait_time: int = Field(
         600, description="Maximum OCR wait time in seconds")
 
+    cache_path: Optional[str] = Field(
+        "./cache/embeddings.sqlite3", description="SQLite file for the shared on-disk embedding cache (None disables it)")
+    cache_max_entries: int = Field(
+        4096, ge=1, description="Maximum embeddings kept in the in-memory LRU")
+    cache_ttl_seconds: Optional[float] = Field(
+        24 * 3600, description="TTL for in-memory embedding entries")
+
+    requests_per_second: float = Field(
+        2.0, gt=0, description="Embedding provider request quota")
+    burst_size: float = Field(
+        4.0, ge=1, description="Requests allowed in a burst above the steady rate")
+    max_batch_size: int = Field(
+        32, ge=1, description="Maximum texts per embeddings.create call")
+    batch_window_ms: float = Field(
+        10.0, ge=0, description="How long to collect concurrent texts into one batch")
+    max_retries: int = Field(
+        2, ge=0, description="Retries of a failed embeddings.create batch before its callers get None")
+    retry_backoff_seconds: float = Field(
+        0.5, ge=0, description="Delay before the first retry of a failed batch, doubled for each further retry")
+
+    precompute_topic_embeddings: bool = Field(
+        True, description="Embed all topic query texts at startup")
+    query_embeddings_dir: str = Field(
+        "./cache", description="Directory for the versioned topic query embeddings file")
+
 
 class RLConfig(BaseModel):
     model_path: Optional[str] = Field(None, description="Path to RL model")
     available: bool = Field(False, description="Whether RL is available")
     sb3_logging_level: str = Field(
         "INFO", description="Stable Baselines3 logging level")
+    normalize_observations: bool = Field(
+        False, description="Serve with the normalized observation mode the model was trained with")
+    policy_backend: Optional[str] = Field(
+        None, description="Compiled inference backend: 'torchscript', 'compile' or None for eager")
+    policy_bf16: bool = Field(
+        False, description="Run compiled inference in bfloat16 when the CPU supports it")
 
 
 class SecurityConfig(BaseModel):
@@ -89,6 +128,72 @@ class RAGConfig(BaseModel):
         False, description="Whether to search across all chapters")
     max_total_context_length: int = Field(
         3000, description="Maximum total context length in characters")
+    context_cache_max_entries: int = Field(
+        512, ge=1, description="Maximum cached RAG context strings")
+    context_cache_ttl_seconds: float = Field(
+        3600, ge=0, description="RAG context cache TTL (0 disables expiry)")
+    kg_version_poll_seconds: float = Field(
+        60, ge=0, description="How often to check the KG version stamp (0 disables polling)")
+    in_process_vector_index: bool = Field(
+        True, description="Serve chunk vector search from an in-memory index, falling back to Neo4j")
+    chapter_catalog_ttl_seconds: float = Field(
+        600, ge=0, description="Background refresh interval for the chapter catalog (0 disables)")
+
+
+class AssessmentConfig(BaseModel):
+    """Caches for exercise generation and answer evaluation"""
+    exercise_cache_max_entries: int = Field(
+        256, ge=1, description="Maximum cached generated exercise batches")
+    exercise_cache_ttl_seconds: float = Field(
+        1800, ge=0, description="Exercise batch cache TTL (0 disables expiry)")
+    topic_context_cache_max_entries: int = Field(
+        512, ge=1, description="Maximum cached KG topic contexts")
+    evaluation_cache_max_entries: int = Field(
+        4096, ge=1, description="Maximum cached answer evaluations")
+    evaluation_cache_ttl_seconds: float = Field(
+        24 * 3600, ge=0, description="Answer evaluation cache TTL (0 disables expiry)")
+    evaluation_concurrency: int = Field(
+        4, ge=1, description="Maximum concurrent LLM grading calls")
+    batch_llm_grading: bool = Field(
+        True, description="Grade an assessment's open-ended answers in one LLM prompt")
+    evaluation_batch_size: int = Field(
+        8, ge=1, le=20, description="Maximum answers per batched grading prompt")
+    pre_grader_enabled: bool = Field(
+        True, description="Try exact/lexical/embedding checks before LLM grading of short answers")
+    pre_grade_lexical_accept: float = Field(
+        0.85, ge=0, le=1.0,
+        description="Ordered content-word match at or above which an answer containing every reference word is accepted")
+    pre_grade_embedding_reject: float = Field(
+        0.55, ge=0, le=1.0, description="Embedding cosine at or below which an answer with no overlap is rejected")
+    question_bank_enabled: bool = Field(
+        True, description="Serve assessments from the pre-generated question bank")
+    question_bank_bands: int = Field(
+        5, ge=1, le=20, description="Number of difficulty bands questions are banked under")
+    question_bank_min_stock: int = Field(
+        20, ge=0, description="Questions no student has been served yet below which a key is topped up")
+    question_bank_refill_batch_size: int = Field(
+        5, ge=1, le=20, description="Questions generated per refill call")
+    question_bank_workers: int = Field(
+        1, ge=1, description="Concurrent background refill workers")
+    question_bank_refill_cooldown: float = Field(
+        300.0, ge=0, description="Seconds between stock checks of one bank key")
+
+
+class SessionConfig(BaseModel):
+    """Student session persistence"""
+    learning_path_tail: int = Field(
+        20, ge=0, description="Recent learning_path entries embedded in the session document")
+    migrate_learning_paths: bool = Field(
+        True, description="Copy embedded learning paths into the interactions collection at startup")
+    cache_max_entries: int = Field(
+        2048, ge=1, description="Validated sessions kept in the per-process session cache")
+    cache_ttl_seconds: float = Field(
+        300.0, ge=0, description="Seconds a clean cached session is trusted before re-reading Mongo (0 = no expiry)")
+    write_behind_delay: float = Field(
+        2.0, ge=0, description="Seconds session saves are held and coalesced before writing (0 = write-through)")
+    version_check_ttl_seconds: float = Field(
+        5.0, ge=0, description="Seconds a cached session is served to read-only handlers before its stored version "
+                               "is re-checked (0 = every time)")
 
 
 class APIConfig(BaseModel):
@@ -108,6 +213,8 @@ class AppConfig(BaseModel):
     security: SecurityConfig
     api: APIConfig
     rag: RAGConfig
+    assessment: AssessmentConfig
+    session: SessionConfig
 
 
 def load_config() -> AppConfig:
@@ -119,7 +226,13 @@ def load_config() -> AppConfig:
             neo4j_uri=os.getenv("NEO4J_URI"),
             neo4j_username=os.getenv("NEO4J_USERNAME", "neo4j"),
             neo4j_password=os.getenv("NEO4J_PASSWORD"),
-            neo4j_database=os.getenv("NEO4J_DATABASE", "neo4j")
+            neo4j_database=os.getenv("NEO4J_DATABASE", "neo4j"),
+            neo4j_max_pool_size=int(os.getenv("NEO4J_MAX_POOL_SIZE", "50")),
+            neo4j_connection_timeout=float(
+                os.getenv("NEO4J_CONNECTION_TIMEOUT", "10")),
+            neo4j_acquisition_timeout=float(
+                os.getenv("NEO4J_ACQUISITION_TIMEOUT", "30")),
+            neo4j_query_timeout=float(os.getenv("NEO4J_QUERY_TIMEOUT", "15"))
         )
 
         llm_config = LLMConfig(
@@ -144,14 +257,35 @@ def load_config() -> AppConfig:
             mistral_ocr_model=os.getenv("MISTRAL_OCR_MODEL"),
             mistral_extract_model=os.getenv("MISTRAL_EXTRACT_MODEL"),
             ocr_poll_interval=int(os.getenv("OCR_POLL_INTERVAL", "10")),
-            ocr_max_wait_time=int(os.getenv("OCR_MAX_WAIT_TIME", "600"))
+            ocr_max_wait_time=int(os.getenv("OCR_MAX_WAIT_TIME", "600")),
+            cache_path=os.getenv(
+                "EMBEDDING_CACHE_PATH", "./cache/embeddings.sqlite3") or None,
+            cache_max_entries=int(
+                os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "4096")),
+            cache_ttl_seconds=float(
+                os.getenv("EMBEDDING_CACHE_TTL_SECONDS", str(24 * 3600))),
+            requests_per_second=float(
+                os.getenv("EMBEDDING_REQUESTS_PER_SECOND", "2.0")),
+            burst_size=float(os.getenv("EMBEDDING_BURST_SIZE", "4")),
+            max_batch_size=int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", "32")),
+            batch_window_ms=float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "10")),
+            max_retries=int(os.getenv("EMBEDDING_MAX_RETRIES", "2")),
+            retry_backoff_seconds=float(os.getenv("EMBEDDING_RETRY_BACKOFF_SECONDS", "0.5")),
+            precompute_topic_embeddings=os.getenv(
+                "PRECOMPUTE_TOPIC_EMBEDDINGS", "true").lower() == "true",
+            query_embeddings_dir=os.getenv(
+                "QUERY_EMBEDDINGS_DIR", "./cache")
         )
 
         rl_path = os.getenv("RL_MODEL_PATH")
         rl_config = RLConfig(
             model_path=rl_path,
             available=bool(rl_path and os.path.exists(rl_path)),
-            sb3_logging_level=os.getenv("SB3_LOGGING_LEVEL", "INFO")
+            sb3_logging_level=os.getenv("SB3_LOGGING_LEVEL", "INFO"),
+            normalize_observations=os.getenv(
+                "RL_NORMALIZE_OBSERVATIONS", "false").lower() == "true",
+            policy_backend=os.getenv("RL_POLICY_BACKEND") or None,
+            policy_bf16=os.getenv("RL_POLICY_BF16", "false").lower() == "true"
         )
 
         security_config = SecurityConfig(
@@ -176,7 +310,62 @@ def load_config() -> AppConfig:
             enable_cross_chapter=os.getenv(
                 "ENABLE_CROSS_CHAPTER", "False").lower() == "true",
             max_total_context_length=int(
-                os.getenv("MAX_TOTAL_CONTEXT_LENGTH", "3000"))
+                os.getenv("MAX_TOTAL_CONTEXT_LENGTH", "3000")),
+            context_cache_max_entries=int(
+                os.getenv("RAG_CONTEXT_CACHE_MAX_ENTRIES", "512")),
+            context_cache_ttl_seconds=float(
+                os.getenv("RAG_CONTEXT_CACHE_TTL_SECONDS", "3600")),
+            kg_version_poll_seconds=float(
+                os.getenv("KG_VERSION_POLL_SECONDS", "60")),
+            in_process_vector_index=os.getenv(
+                "IN_PROCESS_VECTOR_INDEX", "true").lower() == "true",
+            chapter_catalog_ttl_seconds=float(
+                os.getenv("CHAPTER_CATALOG_TTL_SECONDS", "600"))
+        )
+
+        assessment_config = AssessmentConfig(
+            exercise_cache_max_entries=int(
+                os.getenv("EXERCISE_CACHE_MAX_ENTRIES", "256")),
+            exercise_cache_ttl_seconds=float(
+                os.getenv("EXERCISE_CACHE_TTL_SECONDS", "1800")),
+            topic_context_cache_max_entries=int(
+                os.getenv("TOPIC_CONTEXT_CACHE_MAX_ENTRIES", "512")),
+            evaluation_cache_max_entries=int(
+                os.getenv("EVALUATION_CACHE_MAX_ENTRIES", "4096")),
+            evaluation_cache_ttl_seconds=float(
+                os.getenv("EVALUATION_CACHE_TTL_SECONDS", str(24 * 3600))),
+            evaluation_concurrency=int(
+                os.getenv("EVALUATION_CONCURRENCY", "4")),
+            batch_llm_grading=os.getenv(
+                "BATCH_LLM_GRADING", "true").lower() == "true",
+            evaluation_batch_size=int(
+                os.getenv("EVALUATION_BATCH_SIZE", "8")),
+            pre_grader_enabled=os.getenv(
+                "PRE_GRADER_ENABLED", "true").lower() == "true",
+            pre_grade_lexical_accept=float(
+                os.getenv("PRE_GRADE_LEXICAL_ACCEPT", "0.85")),
+            pre_grade_embedding_reject=float(
+                os.getenv("PRE_GRADE_EMBEDDING_REJECT", "0.55")),
+            question_bank_enabled=os.getenv(
+                "QUESTION_BANK_ENABLED", "true").lower() == "true",
+            question_bank_bands=int(os.getenv("QUESTION_BANK_BANDS", "5")),
+            question_bank_min_stock=int(
+                os.getenv("QUESTION_BANK_MIN_STOCK", "20")),
+            question_bank_refill_batch_size=int(
+                os.getenv("QUESTION_BANK_REFILL_BATCH_SIZE", "5")),
+            question_bank_workers=int(os.getenv("QUESTION_BANK_WORKERS", "1")),
+            question_bank_refill_cooldown=float(
+                os.getenv("QUESTION_BANK_REFILL_COOLDOWN", "300"))
+        )
+
+        session_config = SessionConfig(
+            learning_path_tail=int(os.getenv("LEARNING_PATH_TAIL", "20")),
+            migrate_learning_paths=os.getenv(
+                "MIGRATE_LEARNING_PATHS", "true").lower() == "true",
+            cache_max_entries=int(os.getenv("SESSION_CACHE_MAX_ENTRIES", "2048")),
+            cache_ttl_seconds=float(os.getenv("SESSION_CACHE_TTL_SECONDS", "300")),
+            write_behind_delay=float(os.getenv("SESSION_WRITE_BEHIND_DELAY", "2.0")),
+            version_check_ttl_seconds=float(os.getenv("SESSION_VERSION_CHECK_TTL_SECONDS", "5"))
         )
 
         config = AppConfig(
@@ -186,7 +375,9 @@ def load_config() -> AppConfig:
             rl=rl_config,
             security=security_config,
             api=api_config,
-            rag=rag_config
+            rag=rag_config,
+            assessment=assessment_config,
+            session=session_config
         )
 
         if not config.database.mongo_url or not config.database.mongo_db_name:
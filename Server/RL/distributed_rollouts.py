@@ -0,0 +1,375 @@
+import os
+import logging
+import argparse
+import pickle
+import socket
+import zlib
+import multiprocessing
+from multiprocessing.connection import Listener, Client, Connection
+from typing import List, Dict, Optional, Any, Tuple, Union
+
+import numpy as np
+import torch as th
+from stable_baselines3 import PPO
+from stable_baselines3.common.monitor import Monitor
+from stable_baselines3.common.policies import ActorCriticPolicy
+from stable_baselines3.common.utils import obs_as_tensor
+from stable_baselines3.common.vec_env import DummyVecEnv
+
+from ncert_tutor import (
+    NCERTStudentEnv, FlattenObservation, NCERTLearningSystem,
+    MaskablePPO, MaskableActorCriticPolicy, MASKABLE_PPO_AVAILABLE
+)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s [%(levelname)s] - %(message)s'
+)
+logger = logging.getLogger("distributed_rollouts")
+
+DEFAULT_ADDRESS = "127.0.0.1:6100"
+AUTHKEY_ENV_VAR = "RL_LEARNER_AUTHKEY"
+COMPRESSION_LEVEL = 1
+
+
+def parse_address(address: str) -> Tuple[Union[Tuple[str, int], str], str]:
+    """'host:port' -> TCP address; anything else is treated as a Unix socket path."""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return (host or "127.0.0.1", int(port)), "AF_INET"
+    return address, "AF_UNIX"
+
+
+def resolve_authkey(authkey: Optional[Union[str, bytes]]) -> bytes:
+    if authkey is None:
+        authkey = os.getenv(AUTHKEY_ENV_VAR)
+    if not authkey:
+        raise ValueError(
+            f"An authkey is required (pass one or set {AUTHKEY_ENV_VAR}).")
+    return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+def send_message(conn: Connection, message: Dict[str, Any]):
+    conn.send_bytes(zlib.compress(pickle.dumps(
+        message, protocol=pickle.HIGHEST_PROTOCOL), COMPRESSION_LEVEL))
+
+
+def recv_message(conn: Connection) -> Dict[str, Any]:
+    # Connections are authenticated with the shared authkey before any payload is unpickled.
+    return pickle.loads(zlib.decompress(conn.recv_bytes()))
+
+
+class RemoteRolloutMixin:
+    """Replaces local rollout collection with batches streamed from rollout workers."""
+
+    rollout_connections: List[Connection]
+
+    def __init__(self, *args, **kwargs):
+        self.rollout_connections = []
+        super().__init__(*args, **kwargs)
+
+    def _excluded_save_params(self) -> List[str]:
+        return super()._excluded_save_params() + ["rollout_connections"]
+
+    def collect_rollouts(self, env, callback, rollout_buffer, n_rollout_steps, use_masking=True) -> bool:
+        if not self.rollout_connections:
+            raise RuntimeError("No rollout workers connected.")
+        self.policy.set_training_mode(False)
+        rollout_buffer.reset()
+        callback.on_rollout_start()
+
+        weights = {k: v.detach().cpu().numpy()
+                   for k, v in self.policy.state_dict().items()}
+        for conn in self.rollout_connections:
+            send_message(conn, {"type": "weights",
+                         "state_dict": weights, "n_steps": n_rollout_steps})
+        batches = [recv_message(conn) for conn in self.rollout_connections]
+
+        def _stack(key):
+            # Worker arrays are (n_steps, n_envs_worker, ...); env axis follows worker order.
+            return np.concatenate([b[key] for b in batches], axis=1)
+
+        observations, actions, rewards = _stack(
+            "observations"), _stack("actions"), _stack("rewards")
+        episode_starts, values, log_probs = _stack(
+            "episode_starts"), _stack("values"), _stack("log_probs")
+        masks = _stack("action_masks") if use_masking and all(
+            b.get("action_masks") is not None for b in batches) else None
+
+        for step in range(n_rollout_steps):
+            self.num_timesteps += env.num_envs
+            callback.update_locals(locals())
+            if not callback.on_step():
+                return False
+            add_kwargs = {"action_masks": masks[step]} if masks is not None else {}
+            rollout_buffer.add(observations[step], actions[step], rewards[step], episode_starts[step],
+                               th.as_tensor(values[step]), th.as_tensor(log_probs[step]), **add_kwargs)
+
+        for batch in batches:
+            self._update_info_buffer(batch["episode_infos"])
+        last_values = th.as_tensor(np.concatenate(
+            [b["last_values"] for b in batches])).to(self.device)
+        dones = np.concatenate([b["dones"] for b in batches])
+        rollout_buffer.compute_returns_and_advantage(
+            last_values=last_values, dones=dones)
+
+        callback.update_locals(locals())
+        callback.on_rollout_end()
+        return True
+
+
+class RemotePPO(RemoteRolloutMixin, PPO):
+    pass
+
+
+if MASKABLE_PPO_AVAILABLE:
+    class RemoteMaskablePPO(RemoteRolloutMixin, MaskablePPO):
+        pass
+else:
+    RemoteMaskablePPO = None
+
+
+class ActorLearnerTrainer:
+    """Learner side: accepts rollout workers and owns the PPO model that consumes their batches."""
+
+    def __init__(self, system: NCERTLearningSystem, address: str = DEFAULT_ADDRESS, num_workers: int = 2,
+                 envs_per_worker: int = 4, authkey: Optional[Union[str, bytes]] = None):
+        self.system = system
+        self.address, self.family = parse_address(address)
+        self.num_workers = max(1, num_workers)
+        self.envs_per_worker = max(1, envs_per_worker)
+        self.total_envs = self.num_workers * self.envs_per_worker
+        # Local-only runs get a throwaway key; remote workers need the shared RL_LEARNER_AUTHKEY.
+        self.authkey = resolve_authkey(
+            authkey or os.getenv(AUTHKEY_ENV_VAR) or os.urandom(16).hex())
+        self.listener: Optional[Listener] = None
+        self.connections: List[Connection] = []
+        self.worker_processes: List[multiprocessing.Process] = []
+
+        # Local envs are never stepped; they only size the rollout buffer and provide spaces.
+        placeholder_env = DummyVecEnv([self._make_placeholder_env for _ in range(self.total_envs)])
+        algorithm = RemoteMaskablePPO if system.use_action_masking else RemotePPO
+        previous_model = system.model
+        if previous_model is None:
+            self.model = system.build_model(algorithm, placeholder_env)
+        else:
+            # SB3 reads the learning rate through lr_schedule, built in _setup_model, so it must be
+            # passed at construction; the Adam moments are carried over alongside the weights.
+            self.model = system.build_model(algorithm, placeholder_env, learning_rate=previous_model.learning_rate,
+                                            ent_coef=previous_model.ent_coef)
+            self.model.policy.load_state_dict(previous_model.policy.state_dict())
+            self.model.policy.optimizer.load_state_dict(previous_model.policy.optimizer.state_dict())
+            self.model.num_timesteps = previous_model.num_timesteps
+        system.model = self.model
+
+    def _make_placeholder_env(self):
+        return FlattenObservation(NCERTStudentEnv(num_students=self.system.num_students, max_steps=self.system.max_steps),
+                                  normalize=self.system.normalize_observations)
+
+    def _worker_config(self, worker_index: int) -> Dict[str, Any]:
+        return {
+            "type": "config",
+            "worker_index": worker_index,
+            "num_envs": self.envs_per_worker,
+            "num_students": self.system.num_students,
+            "max_steps": self.system.max_steps,
+            "normalize_observations": self.system.normalize_observations,
+            "use_action_masking": self.system.use_action_masking,
+            "gamma": self.model.gamma,
+            "policy_kwargs": self.model.policy_kwargs,
+            "compile_policy": self.system.compile_policy,
+        }
+
+    def _listen(self):
+        if self.listener is None:
+            self.listener = Listener(self.address, family=self.family, authkey=self.authkey)
+
+    def spawn_local_workers(self):
+        """Start all workers as local processes (single-box runs and tests)."""
+        self._listen()
+        ctx = multiprocessing.get_context("spawn")
+        # Use the bound address so port 0 (pick any free port) works for local runs.
+        bound = self.listener.address
+        address = f"{bound[0]}:{bound[1]}" if self.family == "AF_INET" else bound
+        for worker_index in range(self.num_workers):
+            process = ctx.Process(target=run_rollout_worker, args=(address, self.authkey), daemon=True,
+                                  name=f"rollout-worker-{worker_index}")
+            process.start()
+            self.worker_processes.append(process)
+
+    def accept_workers(self):
+        self._listen()
+        logger.info(
+            f"Learner listening on {self.address}; waiting for {self.num_workers} worker(s)...")
+        while len(self.connections) < self.num_workers:
+            conn = self.listener.accept()
+            hello = recv_message(conn)
+            worker_index = len(self.connections)
+            send_message(conn, self._worker_config(worker_index))
+            self.connections.append(conn)
+            logger.info(
+                f"Worker {worker_index} connected ({hello.get('host', '?')}, pid {hello.get('pid', '?')}).")
+        self.model.rollout_connections = self.connections
+
+    def close(self):
+        for conn in self.connections:
+            try:
+                send_message(conn, {"type": "stop"})
+                conn.close()
+            except (OSError, EOFError):
+                pass
+        self.connections = []
+        self.model.rollout_connections = []
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+        for process in self.worker_processes:
+            process.join(timeout=10)
+        self.worker_processes = []
+
+
+def _build_worker_envs(config: Dict[str, Any]) -> DummyVecEnv:
+    seed_base = 10_000 * (config["worker_index"] + 1)
+
+    def _make(rank):
+        def _init():
+            env = NCERTStudentEnv(
+                num_students=config["num_students"], max_steps=config["max_steps"])
+            env = Monitor(FlattenObservation(
+                env, normalize=config["normalize_observations"]))
+            env.reset(seed=seed_base + rank)
+            return env
+        return _init
+    return DummyVecEnv([_make(rank) for rank in range(config["num_envs"])])
+
+
+def _collect_rollout(envs: DummyVecEnv, policy: ActorCriticPolicy, n_steps: int, gamma: float,
+                     use_masking: bool, carry: Dict[str, np.ndarray]) -> Dict[str, Any]:
+    """Mirror of OnPolicyAlgorithm.collect_rollouts that returns the raw arrays instead of filling a buffer."""
+    n_envs = envs.num_envs
+    obs_buf = np.zeros((n_steps, n_envs) + envs.observation_space.shape, dtype=np.float32)
+    actions_buf = np.zeros((n_steps, n_envs, len(envs.action_space.nvec)), dtype=np.int64)
+    rewards_buf = np.zeros((n_steps, n_envs), dtype=np.float32)
+    starts_buf = np.zeros((n_steps, n_envs), dtype=np.float32)
+    values_buf = np.zeros((n_steps, n_envs), dtype=np.float32)
+    log_probs_buf = np.zeros((n_steps, n_envs), dtype=np.float32)
+    masks_buf = np.zeros((n_steps, n_envs, int(envs.action_space.nvec.sum())), dtype=bool) if use_masking else None
+    episode_infos = []
+
+    obs, episode_starts = carry["obs"], carry["episode_starts"]
+    for step in range(n_steps):
+        with th.no_grad():
+            obs_tensor = obs_as_tensor(obs, policy.device)
+            if use_masking:
+                masks = np.stack(envs.env_method("action_masks"))
+                actions, values, log_probs = policy(obs_tensor, action_masks=masks)
+                masks_buf[step] = masks
+            else:
+                actions, values, log_probs = policy(obs_tensor)
+        actions = actions.cpu().numpy()
+        new_obs, rewards, dones, infos = envs.step(actions)
+
+        for idx, done in enumerate(dones):
+            if done and infos[idx].get("terminal_observation") is not None and infos[idx].get("TimeLimit.truncated", False):
+                terminal_obs = policy.obs_to_tensor(infos[idx]["terminal_observation"])[0]
+                with th.no_grad():
+                    terminal_value = policy.predict_values(terminal_obs)[0]
+                rewards[idx] += gamma * terminal_value.item()
+            if infos[idx].get("episode") is not None:
+                episode_infos.append({"episode": infos[idx]["episode"]})
+
+        obs_buf[step] = obs
+        actions_buf[step] = actions.reshape(n_envs, -1)
+        rewards_buf[step] = rewards
+        starts_buf[step] = episode_starts
+        values_buf[step] = values.cpu().numpy().flatten()
+        log_probs_buf[step] = log_probs.cpu().numpy()
+        obs, episode_starts = new_obs, dones
+
+    with th.no_grad():
+        last_values = policy.predict_values(obs_as_tensor(obs, policy.device))
+    carry["obs"], carry["episode_starts"] = obs, episode_starts
+    return {
+        "type": "rollout", "observations": obs_buf, "actions": actions_buf, "rewards": rewards_buf,
+        "episode_starts": starts_buf, "values": values_buf, "log_probs": log_probs_buf,
+        "action_masks": masks_buf, "last_values": last_values.cpu().numpy().flatten(),
+        "dones": np.asarray(episode_starts, dtype=np.float32), "episode_infos": episode_infos,
+    }
+
+
+def run_rollout_worker(address: str = DEFAULT_ADDRESS, authkey: Optional[Union[str, bytes]] = None):
+    """Actor side: simulate students with the latest weights and stream rollouts to the learner."""
+    target, family = parse_address(address)
+    conn = Client(target, family=family, authkey=resolve_authkey(authkey))
+    send_message(conn, {"type": "hello", "host": socket.gethostname(), "pid": os.getpid()})
+    config = recv_message(conn)
+    th.set_num_threads(1)
+
+    envs = _build_worker_envs(config)
+    use_masking = config["use_action_masking"] and MASKABLE_PPO_AVAILABLE
+    policy_class = MaskableActorCriticPolicy if use_masking else ActorCriticPolicy
+    policy = policy_class(envs.observation_space, envs.action_space,
+                          lambda _: 0.0, **config["policy_kwargs"])
+    policy.set_training_mode(False)
+    if config.get("compile_policy"):
+        from policy_inference import compile_policy_for_training
+        compile_policy_for_training(policy)
+    carry = {"obs": envs.reset(), "episode_starts": np.ones(envs.num_envs, dtype=bool)}
+    logger.info(
+        f"Rollout worker {config['worker_index']} running {envs.num_envs} env(s).")
+
+    try:
+        while True:
+            message = recv_message(conn)
+            if message["type"] == "stop":
+                break
+            policy.load_state_dict({k: th.as_tensor(v) for k, v in message["state_dict"].items()})
+            send_message(conn, _collect_rollout(
+                envs, policy, message["n_steps"], config["gamma"], use_masking, carry))
+    except (EOFError, ConnectionResetError):
+        logger.info("Learner closed the connection.")
+    finally:
+        envs.close()
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Actor-learner PPO training for the NCERT tutor.")
+    subparsers = parser.add_subparsers(
+        dest="command", help="Command to execute")
+
+    learner_parser = subparsers.add_parser(
+        "learner", help="Run the PPO learner and wait for rollout workers")
+    learner_parser.add_argument("--address", default=DEFAULT_ADDRESS,
+                                help="host:port to listen on, or a Unix socket path")
+    learner_parser.add_argument("--workers", type=int, default=2)
+    learner_parser.add_argument("--envs-per-worker", type=int, default=4)
+    learner_parser.add_argument("--timesteps", type=int, default=2_000_000)
+    learner_parser.add_argument("--log-dir", default="./ncert_tutor_logs_v1")
+    learner_parser.add_argument("--local-workers", action="store_true",
+                                help="Also spawn the workers on this machine")
+
+    worker_parser = subparsers.add_parser(
+        "worker", help="Run a rollout worker that connects to a learner")
+    worker_parser.add_argument("--address", default=DEFAULT_ADDRESS,
+                               help="Learner host:port, or a Unix socket path")
+
+    args = parser.parse_args()
+    if args.command == "learner":
+        system = NCERTLearningSystem(
+            num_students=20, max_steps=250, log_dir=args.log_dir, num_cpu=1,
+            normalize_observations=os.getenv("RL_NORMALIZE_OBSERVATIONS", "false").lower() == "true")
+        system.train_model_actor_learner(
+            total_timesteps=args.timesteps, address=args.address, num_workers=args.workers,
+            envs_per_worker=args.envs_per_worker, spawn_local_workers=args.local_workers,
+            authkey=resolve_authkey(None))
+        system.save_final_model()
+    elif args.command == "worker":
+        run_rollout_worker(args.address)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
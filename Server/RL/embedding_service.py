@@ -0,0 +1,268 @@
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from caching import EmbeddingCache
+
+logger = logging.getLogger("embedding_service")
+
+# Bump when the set of generated query texts changes so stale files are rebuilt.
+TOPIC_QUERY_EMBEDDINGS_VERSION = 1
+TOPIC_QUERY_TEMPLATES = ("{topic}", "{subject} {topic}", "{topic} in {subject}")
+
+
+class TokenBucket:
+    """Async token bucket: `rate` requests per second with bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = max(rate, 1e-6)
+        self.capacity = max(capacity, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        self.waits = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens: float = 1.0):
+        # The lock only orders waiters (FIFO); it is never held across a provider call.
+        async with self._lock:
+            self._refill()
+            if self._tokens < tokens:
+                self.waits += 1
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= tokens
+
+    def penalize(self, seconds: float):
+        """Push the next token out after the provider signalled a rate-limit (HTTP 429)."""
+        self._refill()
+        self._tokens = min(self._tokens, 0.0) - seconds * self.rate
+
+
+class EmbeddingService:
+    """Cache-first embedding client with singleflight coalescing and micro-batching.
+
+    Concurrent requests for the same text share one in-flight future, and distinct
+    texts arriving within `batch_window` seconds are sent as one embeddings.create
+    call. Provider calls are paced by a TokenBucket sized to the account quota. A
+    failed batch is retried up to `max_retries` times with doubling backoff
+    (rate-limited ones wait on the penalized bucket instead) before its callers get None.
+    """
+
+    def __init__(self, client: Any, model_name: str, cache: Optional[EmbeddingCache] = None,
+                 rate_limiter: Optional[TokenBucket] = None, max_batch_size: int = 32,
+                 batch_window: float = 0.01, dimension: Optional[int] = None,
+                 max_retries: int = 2, retry_backoff: float = 0.5):
+        self.client = client
+        self.model_name = model_name
+        self.cache = cache
+        self.rate_limiter = rate_limiter or TokenBucket(rate=2.0, capacity=4.0)
+        self.max_batch_size = max(1, max_batch_size)
+        self.batch_window = batch_window
+        self.dimension = dimension
+        self.max_retries = max(0, max_retries)
+        self.retry_backoff = max(0.0, retry_backoff)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks: set = set()
+        self.requests = 0
+        self.coalesced = 0
+        self.provider_calls = 0
+        self.texts_embedded = 0
+        self.errors = 0
+        self.retries = 0
+
+    async def embed(self, text: str) -> Optional[List[float]]:
+        self.requests += 1
+        if self.cache is not None:
+            cached = self.cache.get_memory(text)
+            if cached is None and self.cache.has_disk and text not in self._inflight:
+                # Only memory misses touch SQLite, and off the event loop.
+                cached = await asyncio.to_thread(self.cache.get_disk, text, False)
+                if cached is not None:
+                    self.cache.put(text, cached, disk=False)
+            if cached is not None:
+                return cached
+        future = self._inflight.get(text)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[text] = future
+            self._pending.append((text, future))
+            self._schedule_flush()
+        # Shield so one cancelled caller does not cancel the result others are waiting on.
+        return await asyncio.shield(future)
+
+    async def embed_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        return list(await asyncio.gather(*(self.embed(t) for t in texts)))
+
+    def _schedule_flush(self):
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.batch_window, self._flush)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        while self._pending:
+            batch, self._pending = self._pending[:self.max_batch_size], self._pending[self.max_batch_size:]
+            task = asyncio.get_running_loop().create_task(self._run_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch: List[Tuple[str, asyncio.Future]]):
+        texts = [text for text, _ in batch]
+        results: List[Optional[List[float]]] = [None] * len(batch)
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.rate_limiter.acquire()
+                self.provider_calls += 1
+                response = await asyncio.to_thread(
+                    self.client.embeddings.create, model=self.model_name, inputs=texts)
+            except Exception as e:
+                self.errors += 1
+                rate_limited = "429" in str(e) or "rate limit" in str(e).lower()
+                if rate_limited:
+                    self.rate_limiter.penalize(1.0)
+                if attempt < self.max_retries:
+                    self.retries += 1
+                    logger.warning(f"Mistral embeddings failed for batch of {len(batch)} "
+                                   f"(attempt {attempt + 1}/{self.max_retries + 1}), retrying: {e}")
+                    if not rate_limited:
+                        # Rate-limited retries already wait on the penalized bucket.
+                        await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+                    continue
+                logger.error(
+                    f"Error generating Mistral embeddings for batch of {len(batch)}: {e}", exc_info=True)
+                break
+            for position, item in enumerate(response.data or []):
+                index = getattr(item, "index", None)
+                index = index if isinstance(index, int) and 0 <= index < len(batch) else position
+                embedding = getattr(item, "embedding", None)
+                if embedding is None:
+                    continue
+                if self.dimension and len(embedding) != self.dimension:
+                    logger.error(
+                        f"CRITICAL: Embedding dimension mismatch! Got {len(embedding)}, expected {self.dimension}.")
+                    continue
+                results[index] = embedding
+            self.texts_embedded += sum(r is not None for r in results)
+            break
+        for (text, future), embedding in zip(batch, results):
+            if embedding is not None and self.cache is not None:
+                self.cache.put(text, embedding, disk=False)
+            self._inflight.pop(text, None)
+            if not future.done():
+                future.set_result(embedding)
+        if self.cache is not None and self.cache.has_disk:
+            fresh = [(text, e) for (text, _), e in zip(batch, results) if e is not None]
+            if fresh:
+                await asyncio.to_thread(self.cache.put_disk, fresh)
+
+    async def close(self):
+        self._flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests, "coalesced": self.coalesced,
+            "provider_calls": self.provider_calls, "texts_embedded": self.texts_embedded,
+            "avg_batch_size": round(self.texts_embedded / self.provider_calls, 2) if self.provider_calls else 0.0,
+            "rate_limit_waits": self.rate_limiter.waits, "errors": self.errors, "retries": self.retries,
+            "pending": len(self._pending), "inflight": len(self._inflight),
+        }
+
+
+def topic_query_texts(topics: List[str]) -> List[str]:
+    """Query texts the content/assessment endpoints derive from env topic names."""
+    texts: Dict[str, None] = {}
+    for full_name in topics:
+        parts = full_name.split('-')
+        topic = parts[-1].replace('_', ' ')
+        subject = parts[0].replace('_', ' ')
+        variants = [full_name, re.sub(r'\W+', '_', full_name), full_name.replace(' ', '_'), parts[-1].strip()]
+        variants += [template.format(topic=topic, subject=subject) for template in TOPIC_QUERY_TEMPLATES]
+        texts.update(dict.fromkeys(v for v in variants if v))
+    return list(texts)
+
+
+def topic_query_embeddings_path(cache_dir: str) -> str:
+    return os.path.join(cache_dir, f"topic_query_embeddings_v{TOPIC_QUERY_EMBEDDINGS_VERSION}.npz")
+
+
+def _load_query_embeddings(path: str, model_name: str) -> Dict[str, np.ndarray]:
+    if not os.path.exists(path):
+        return {}
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data["meta"]))
+            if meta.get("model") != model_name or meta.get("version") != TOPIC_QUERY_EMBEDDINGS_VERSION:
+                logger.info(f"Ignoring stale topic query embeddings at {path} ({meta}).")
+                return {}
+            return dict(zip(data["texts"].tolist(), data["vectors"]))
+    except Exception as e:
+        logger.warning(f"Could not read topic query embeddings from {path}: {e}")
+        return {}
+
+
+def _save_query_embeddings(path: str, model_name: str, embeddings: Dict[str, np.ndarray]):
+    texts = sorted(embeddings)
+    meta = {"version": TOPIC_QUERY_EMBEDDINGS_VERSION, "model": model_name,
+            "texts_sha256": hashlib.sha256("\n".join(texts).encode("utf-8")).hexdigest()}
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    # A temp file per writer: uvicorn workers warming at once must not truncate each other's file.
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=os.path.basename(path) + ".",
+                                     suffix=".tmp", delete=False) as f:
+        tmp_path = f.name
+        try:
+            np.savez(f, texts=np.array(texts), meta=np.array(json.dumps(meta)),
+                     vectors=np.stack([np.asarray(embeddings[t], dtype=np.float32) for t in texts]))
+        except BaseException:
+            f.close()
+            os.unlink(tmp_path)
+            raise
+    os.replace(tmp_path, path)
+
+
+async def warm_topic_query_embeddings(service: EmbeddingService, topics: List[str], path: str) -> Dict[str, int]:
+    """Load persisted topic query embeddings into the cache and compute any that are missing."""
+    texts = topic_query_texts(topics)
+    stored = await asyncio.to_thread(_load_query_embeddings, path, service.model_name)
+    if service.cache is not None:
+        for text in texts:
+            if text in stored:
+                # Memory only: these are already persisted in the npz, and SQLite writes would block the loop.
+                service.cache.put(text, stored[text].tolist(), disk=False)
+    missing = [text for text in texts if text not in stored]
+    computed = 0
+    if missing:
+        for text, embedding in zip(missing, await service.embed_many(missing)):
+            if embedding is not None:
+                stored[text] = np.asarray(embedding, dtype=np.float32)
+                computed += 1
+        if computed:
+            await asyncio.to_thread(
+                _save_query_embeddings, path, service.model_name, {t: stored[t] for t in texts if t in stored})
+    logger.info(
+        f"Topic query embeddings ready: {len(texts) - len(missing)} loaded, {computed} computed, "
+        f"{len(missing) - computed} failed ({path}).")
+    return {"texts": len(texts), "loaded": len(texts) - len(missing), "computed": computed,
+            "failed": len(missing) - computed}
@@ -0,0 +1,175 @@
+import logging
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+from uuid import NAMESPACE_URL, uuid4, uuid5
+
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+
+from session_store import VERSION_FIELD, version_guard
+
+logger = logging.getLogger("interaction_store")
+
+# Set on session documents whose embedded learning_path has been copied into the collection.
+MIGRATED_FIELD = "interactions_migrated"
+
+# Fields the learning path endpoint returns for each interaction.
+PATH_PROJECTION = {
+    "_id": 0, "interaction_id": 1, "timestamp_utc": 1, "topic": 1, "strategy": 1, "content_type": 1,
+    "mastery_at_request": 1, "mastery_after_feedback": 1, "feedback_details": 1,
+}
+
+
+def _parse_timestamp(value: Any) -> Optional[datetime]:
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, str):
+        try:
+            parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+            return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+        except ValueError:
+            return None
+    return None
+
+
+def assign_legacy_ids(student_id: str, path: List[Any]):
+    """Give path entries saved without an interaction_id a deterministic one, in place.
+
+    The id depends only on the student, the entry's timestamp and its position among
+    entries with that timestamp. Copying the same history again therefore produces
+    the same ids, and the unique index skips entries already stored.
+    """
+    seen: Counter = Counter()
+    for entry in path:
+        if not isinstance(entry, dict):
+            continue
+        timestamp = str(entry.get("timestamp_utc") or "")
+        occurrence = seen[timestamp]
+        seen[timestamp] += 1
+        if not entry.get("interaction_id"):
+            entry["interaction_id"] = str(uuid5(NAMESPACE_URL, f"interaction:{student_id}:{timestamp}:{occurrence}"))
+
+
+def interaction_document(student_id: str, entry: Dict[str, Any]) -> Dict[str, Any]:
+    """Stored form of a learning path entry: the entry plus its owner and a native datetime."""
+    doc = dict(entry)
+    doc.pop("_id", None)
+    doc["student_id"] = student_id
+    doc.setdefault("interaction_id", str(uuid4()))
+    doc["timestamp"] = _parse_timestamp(entry.get("timestamp_utc")) or datetime.now(timezone.utc)
+    return doc
+
+
+class InteractionStore:
+    """Append-only per-student interaction log in its own collection.
+
+    Sessions keep only a short recent tail of `learning_path`; the full history,
+    lookups by interaction/assessment id and cross-student analytics use this
+    collection and its (student_id, ...) indexes.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.recorded = 0
+        self.errors = 0
+
+    async def ensure_indexes(self):
+        await self.collection.create_index(
+            [("student_id", ASCENDING), ("timestamp", ASCENDING)], name="student_timestamp")
+        await self.collection.create_index(
+            [("student_id", ASCENDING), ("interaction_id", ASCENDING)], unique=True, name="student_interaction")
+        await self.collection.create_index(
+            [("student_id", ASCENDING), ("assessment_id", ASCENDING)], sparse=True, name="student_assessment")
+
+    async def record(self, student_id: str, entry: Dict[str, Any]) -> bool:
+        """Store one interaction; re-recording the same interaction_id is a no-op."""
+        doc = interaction_document(student_id, entry)
+        try:
+            await self.collection.update_one(
+                {"student_id": student_id, "interaction_id": doc["interaction_id"]},
+                {"$setOnInsert": doc}, upsert=True)
+            self.recorded += 1
+            return True
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Error recording interaction for {student_id}: {e}", exc_info=True)
+            return False
+
+    async def record_many(self, student_id: str, entries: List[Dict[str, Any]]) -> int:
+        """Store a run of path entries, skipping ones already stored; entries lacking an id get one in place."""
+        assign_legacy_ids(student_id, entries)
+        docs = [interaction_document(student_id, e) for e in entries if isinstance(e, dict)]
+        if not docs:
+            return 0
+        result = await self.collection.bulk_write([
+            UpdateOne({"student_id": student_id, "interaction_id": d["interaction_id"]},
+                      {"$setOnInsert": d}, upsert=True) for d in docs], ordered=False)
+        self.recorded += result.upserted_count
+        return result.upserted_count
+
+    @staticmethod
+    def _key(student_id: str, interaction_id: Optional[str], assessment_id: Optional[str]) -> Dict[str, Any]:
+        if interaction_id:
+            return {"student_id": student_id, "interaction_id": interaction_id}
+        if assessment_id:
+            return {"student_id": student_id, "assessment_id": assessment_id}
+        raise ValueError("interaction_id or assessment_id is required")
+
+    async def find(self, student_id: str, interaction_id: Optional[str] = None,
+                   assessment_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        return await self.collection.find_one(
+            self._key(student_id, interaction_id, assessment_id), {"_id": 0})
+
+    async def update(self, student_id: str, fields: Dict[str, Any], interaction_id: Optional[str] = None,
+                     assessment_id: Optional[str] = None) -> bool:
+        try:
+            result = await self.collection.update_one(
+                self._key(student_id, interaction_id, assessment_id), {"$set": fields})
+            return result.matched_count > 0
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Error updating interaction for {student_id}: {e}", exc_info=True)
+            return False
+
+    async def history(self, student_id: str, skip: int = 0, limit: int = 100,
+                      projection: Optional[Dict[str, Any]] = None, newest_first: bool = False) -> List[Dict[str, Any]]:
+        cursor = self.collection.find({"student_id": student_id}, projection or {"_id": 0}).sort(
+            "timestamp", DESCENDING if newest_first else ASCENDING).skip(skip).limit(limit)
+        return await cursor.to_list(length=limit)
+
+    async def count(self, student_id: str) -> int:
+        return await self.collection.count_documents({"student_id": student_id})
+
+    async def migrate_embedded_paths(self, sessions, tail: int) -> Dict[str, int]:
+        """Copy embedded learning paths into the collection and trim each session to its recent tail.
+
+        Idempotent: entries already copied are skipped by the unique (student_id, interaction_id) index.
+        """
+        results = {"sessions": 0, "copied": 0, "trimmed": 0, "changed": 0, "errors": 0}
+        cursor = sessions.find({MIGRATED_FIELD: {"$ne": True}},
+                               {"student_id": 1, "learning_path": 1, VERSION_FIELD: 1})
+        async for doc in cursor:
+            results["sessions"] += 1
+            student_id = doc.get("student_id")
+            path = doc.get("learning_path") or []
+            try:
+                # record_many fills in missing ids in place, so the trimmed tail still matches the copy.
+                results["copied"] += await self.record_many(student_id, path)
+                # Only trims the path as read; bumping the version makes workers holding a cached copy reload.
+                result = await sessions.update_one(
+                    {"_id": doc["_id"], **version_guard(doc.get(VERSION_FIELD) or 0)},
+                    {"$set": {"learning_path": path[-tail:] if tail > 0 else [], MIGRATED_FIELD: True},
+                     "$inc": {VERSION_FIELD: 1}})
+                if not result.matched_count:
+                    # Saved meanwhile; its next interaction (or the next run) copies whatever was added.
+                    results["changed"] += 1
+                    continue
+                results["trimmed"] += int(len(path) > tail)
+            except Exception as e:
+                results["errors"] += 1
+                logger.error(f"Error migrating learning path for {student_id}: {e}", exc_info=True)
+        logger.info(f"Learning path migration: {results}")
+        return results
+
+    def stats(self) -> Dict[str, Any]:
+        return {"recorded": self.recorded, "errors": self.errors}
@@ -2,6 +2,7 @@ import os
 import logging
 import re
 import json
+import difflib
 from uuid import uuid4
 from dotenv import load_dotenv
 from neo4j import GraphDatabase, exceptions as neo4j_exceptions
@@ -17,6 +18,10 @@ from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_mistralai.chat_models import ChatMistralAI
 from langchain_mistralai.embeddings import MistralAIEmbeddings
+import numpy as np
+
+from kg_cache import (KG_VERSION_QUERY, CHUNK_EMBEDDINGS_QUERY,
+                      normalize_chapter_key, resolve_chapter_candidates)
 
 load_dotenv()
 logging.basicConfig(
@@ -395,6 +400,15 @@ def _merge_chunk_tx(tx, chunk_list):
     tx.run(query, chunk_data=chunk_list)
 
 
+def _bump_kg_version_tx(tx):
+    """Advance the version stamp the API uses to invalidate its retrieval caches."""
+    tx.run("""
+    MERGE (v:KGVersion {id: 'current'})
+    SET v.version = coalesce(v.version, 0) + 1,
+        v.updated_at = timestamp()
+    """)
+
+
 def _merge_concepts_tx(tx, node_list):
     query = """
     UNWIND $node_data AS node
@@ -560,6 +574,103 @@ def extract_prerequisite_chains(driver):
         return []
 
 
+TOPIC_MAP_NAME_CONFIDENCE = {"exact": 1.0, "normalized": 0.95, "substring": 0.8}
+TOPIC_MAP_MIN_CONFIDENCE = 0.75
+TOPIC_MAP_MAX_CHAPTERS = 2
+TOPIC_MAP_ARTIFACT = "topic_chapter_map.json"
+
+
+def _chapter_centroids(driver) -> Dict[str, np.ndarray]:
+    """Mean of the L2-normalised chunk embeddings of each chapter."""
+    with driver.session(database=NEO4J_DATABASE) as session:
+        records = session.run(CHUNK_EMBEDDINGS_QUERY).data()
+    sums: Dict[str, np.ndarray] = {}
+    for record in records:
+        embedding = np.asarray(record["embedding"], dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        if norm > 0:
+            sums[record["chapter"]] = sums.get(record["chapter"], 0) + embedding / norm
+    return {chapter: total / np.linalg.norm(total) for chapter, total in sums.items()
+            if np.linalg.norm(total) > 0}
+
+
+def _store_topic_map_tx(tx, rows):
+    tx.run("""
+    UNWIND $rows AS row
+    MERGE (t:CurriculumTopic {name: row.topic})
+    WITH t, row
+    OPTIONAL MATCH (t)-[old:COVERED_BY]->(:Chapter)
+    DELETE old
+    WITH DISTINCT t, row
+    UNWIND row.chapters AS mapped
+    MATCH (ch:Chapter {name: mapped.chapter})
+    MERGE (t)-[r:COVERED_BY]->(ch)
+    SET r.confidence = mapped.confidence,
+        r.method = mapped.method,
+        r.updated_at = timestamp()
+    """, rows=rows)
+
+
+async def map_topics_to_chapters(driver, embedding_client, topics: List[str],
+                                 min_confidence: float = TOPIC_MAP_MIN_CONFIDENCE,
+                                 max_chapters: int = TOPIC_MAP_MAX_CHAPTERS) -> Dict[str, List[Dict]]:
+    """Match curriculum topics to KG chapters by name and by embedding similarity to each chapter's chunks."""
+    with driver.session(database=NEO4J_DATABASE) as session:
+        chapters = [r["name"] for r in session.run("MATCH (ch:Chapter) RETURN ch.name AS name") if r["name"]]
+    centroids = _chapter_centroids(driver)
+    logger.info(
+        f"Mapping {len(topics)} topics onto {len(chapters)} chapters ({len(centroids)} with embeddings)...")
+
+    topic_texts = [t.split('-')[-1].replace('_', ' ').strip() for t in topics]
+    topic_embeddings = await generate_embeddings_mistral(embedding_client, topic_texts) if centroids else []
+    centroid_names = list(centroids)
+    centroid_matrix = np.stack([centroids[c] for c in centroid_names]) if centroids else None
+
+    mapping: Dict[str, List[Dict]] = {}
+    for i, topic in enumerate(topics):
+        scores: Dict[str, Dict] = {}
+        candidates, method = resolve_chapter_candidates(topic, chapters)
+        for chapter in candidates:
+            confidence = TOPIC_MAP_NAME_CONFIDENCE.get(method) or difflib.SequenceMatcher(
+                None, normalize_chapter_key(topic_texts[i]), normalize_chapter_key(chapter)).ratio()
+            scores[chapter] = {"chapter": chapter, "confidence": round(float(confidence), 4), "method": method}
+
+        embedding = topic_embeddings[i] if i < len(topic_embeddings) else None
+        if embedding and centroid_matrix is not None:
+            query = np.asarray(embedding, dtype=np.float32)
+            similarities = centroid_matrix @ (query / np.linalg.norm(query))
+            for j in np.argsort(-similarities)[:max_chapters]:
+                chapter, confidence = centroid_names[j], round(float(similarities[j]), 4)
+                if confidence > scores.get(chapter, {}).get("confidence", -1.0):
+                    scores[chapter] = {"chapter": chapter, "confidence": confidence, "method": "embedding"}
+
+        ranked = sorted(scores.values(), key=lambda m: m["confidence"], reverse=True)
+        mapping[topic] = [m for m in ranked if m["confidence"] >= min_confidence][:max_chapters]
+        if not mapping[topic]:
+            best = f" (best: {ranked[0]})" if ranked else ""
+            logger.warning(f"No chapter above {min_confidence} for topic '{topic}'{best}.")
+    return mapping
+
+
+def store_topic_map(driver, mapping: Dict[str, List[Dict]], output_path: Optional[str] = TOPIC_MAP_ARTIFACT):
+    """Persist the mapping as COVERED_BY relationships and as a JSON artifact."""
+    rows = [{"topic": topic, "chapters": chapters} for topic, chapters in mapping.items()]
+    with driver.session(database=NEO4J_DATABASE) as session:
+        session.execute_write(_store_topic_map_tx, rows)
+        session.execute_write(_bump_kg_version_tx)
+        version = session.run(KG_VERSION_QUERY).single()
+    if output_path:
+        artifact = {
+            "kg_version": version["version"] if version else None,
+            "embedding_model": EMBEDDING_MODEL,
+            "generated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "topics": mapping,
+        }
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(artifact, f, ensure_ascii=False, indent=2)
+        logger.info(f"Topic-to-chapter map written to {output_path}")
+
+
 def export_visualization(driver, chapter_name=None, format="d3"):
     """Export knowledge graph in a format suitable for visualization."""
     logger.info(
@@ -789,6 +900,7 @@ async def process_pdf_to_graph_async(driver, embedding_client, llm, pdf_path, ch
             for i in tqdm(range(0, len(all_relationships), NEO4J_BATCH_SIZE), desc="Storing Relationships"):
                 session.execute_write(
                     _merge_relationships_tx, all_relationships[i:i + NEO4J_BATCH_SIZE])
+            session.execute_write(_bump_kg_version_tx)
         logger.info("Neo4j storage complete.")
     except neo4j_exceptions.Neo4jError as e:
         logger.error(f"Neo4j Error during storage: {e}", exc_info=True)
@@ -947,6 +1059,15 @@ async def main():
     list_parser = subparsers.add_parser(
         "list", help="List chapters in the knowledge graph")
 
+    map_parser = subparsers.add_parser(
+        "map-topics", help="Map curriculum topics to chapters for the API")
+    map_parser.add_argument("--output", default=TOPIC_MAP_ARTIFACT,
+                            help="JSON artifact path ('' to skip)")
+    map_parser.add_argument("--min-confidence", type=float,
+                            default=TOPIC_MAP_MIN_CONFIDENCE, help="Minimum match confidence")
+    map_parser.add_argument("--max-chapters", type=int,
+                            default=TOPIC_MAP_MAX_CHAPTERS, help="Chapters kept per topic")
+
     args = parser.parse_args()
 
     if not all([NEO4J_URI, NEO4J_USERNAME, NEO4J_PASSWORD, MISTRAL_API_KEY]):
@@ -978,6 +1099,7 @@ async def main():
                 print(f"- Concepts: {result['concepts']}")
                 print(f"- Relationships: {result['relationships']}")
                 print(f"- Duration: {result['duration_seconds']:.2f} seconds")
+                print("Run 'map-topics' to refresh the topic-to-chapter map.")
 
         elif args.command == "query":
             # New query functionality
@@ -1018,6 +1140,21 @@ async def main():
             else:
                 print("Failed to generate visualization data")
 
+        elif args.command == "map-topics":
+            from ncert_tutor import curriculum_topic_names
+
+            topics = curriculum_topic_names()
+            mapping = await map_topics_to_chapters(
+                neo4j_driver, get_embedding_model(), topics,
+                min_confidence=args.min_confidence, max_chapters=args.max_chapters)
+            store_topic_map(neo4j_driver, mapping, args.output or None)
+            mapped = sum(1 for chapters in mapping.values() if chapters)
+            print(f"Mapped {mapped}/{len(topics)} topics to chapters.")
+            for topic, chapters in mapping.items():
+                targets = ", ".join(
+                    f"{m['chapter']} ({m['confidence']:.2f}, {m['method']})" for m in chapters) or "-"
+                print(f"- {topic}: {targets}")
+
         elif args.command == "list":
             # List chapters in the graph
             with neo4j_driver.session(database=NEO4J_DATABASE) as session:
@@ -0,0 +1,480 @@
+import re
+import time
+import asyncio
+import difflib
+import logging
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from caching import LRUCache
+
+logger = logging.getLogger("kg_cache")
+
+# kg_builder_v2 bumps this stamp after every write to the chunk graph.
+KG_VERSION_QUERY = """
+MATCH (v:KGVersion {id: 'current'})
+RETURN v.version AS version
+"""
+
+VersionListener = Callable[[Optional[int], Optional[int]], Any]
+
+
+class KGVersionTracker:
+    """Polls the (:KGVersion {id: 'current'}) stamp and notifies listeners when it changes."""
+
+    def __init__(self, fetch_version: Callable[[], Awaitable[Optional[int]]], poll_interval: float = 60.0):
+        self._fetch_version = fetch_version
+        self.poll_interval = poll_interval
+        self.version: Optional[int] = None
+        self.loaded = False
+        self.last_checked: Optional[float] = None
+        self.changes = 0
+        self.errors = 0
+        self._listeners: List[VersionListener] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def add_listener(self, listener: VersionListener):
+        """Register `listener(old_version, new_version)`; coroutine functions are awaited."""
+        self._listeners.append(listener)
+
+    async def refresh(self) -> Optional[int]:
+        try:
+            version = await self._fetch_version()
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Could not read KG version stamp: {e}")
+            return self.version
+        self.last_checked = time.time()
+        if not self.loaded:
+            self.version, self.loaded = version, True
+            logger.info(f"KG version at startup: {version}")
+            return version
+        if version != self.version:
+            old_version, self.version = self.version, version
+            self.changes += 1
+            logger.info(f"KG version changed: {old_version} -> {version}")
+            for listener in list(self._listeners):
+                try:
+                    result = listener(old_version, version)
+                    if asyncio.iscoroutine(result):
+                        await result
+                except Exception as e:
+                    logger.error(f"KG version listener failed: {e}", exc_info=True)
+        return self.version
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            await self.refresh()
+
+    def start(self):
+        if self._task is None and self.poll_interval > 0:
+            self._task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"version": self.version, "loaded": self.loaded, "changes": self.changes,
+                "errors": self.errors, "last_checked": self.last_checked,
+                "poll_interval": self.poll_interval}
+
+
+class RagContextCache(LRUCache):
+    """Formatted RAG context keyed by (KG version, chapter, query text, top_k, min_similarity).
+
+    The KG version is part of the key, so entries from an older graph can never be
+    served; they are also dropped eagerly when the tracker reports a new version.
+    """
+
+    def __init__(self, max_entries: int = 512, ttl_seconds: Optional[float] = 3600, name: str = "rag_context"):
+        super().__init__(max_entries, ttl_seconds, name=name)
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(kg_version: Optional[int], chapter: str, query_text: str,
+                 top_k: int, min_similarity: float) -> Tuple:
+        return (kg_version, chapter, " ".join(query_text.split()), int(top_k), round(float(min_similarity), 4))
+
+    def invalidate(self, old_version: Optional[int] = None, new_version: Optional[int] = None):
+        dropped = len(self)
+        self.clear()
+        self.invalidations += 1
+        logger.info(f"RAG context cache cleared ({dropped} entries) for KG version {new_version}.")
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        stats["invalidations"] = self.invalidations
+        return stats
+
+
+def normalize_chapter_key(name: str) -> str:
+    """'Science-Food_Where does it come from?' -> 'science food where does it come from'."""
+    return " ".join(re.sub(r"[\W_]+", " ", name or "").lower().split())
+
+
+def _topic_chapter_names(topic_name: str) -> List[str]:
+    # The chapter-name spellings /content/next used to try one by one.
+    topic_part = topic_name.split('-')[-1].strip()
+    return [topic_name, re.sub(r'\W+', '_', topic_name), topic_name.replace(' ', '_'), topic_part]
+
+
+def _approximate_chapter_matches(topic_name: str, keys: Dict[str, str],
+                                 fuzzy_cutoff: float) -> Tuple[List[str], str]:
+    wanted = {normalize_chapter_key(n) for n in _topic_chapter_names(topic_name)} - {""}
+    substring = [c for c, key in keys.items() if key and any(key in w or w in key for w in wanted)]
+    if substring:
+        return substring, "substring"
+
+    by_key: Dict[str, List[str]] = {}
+    for c, key in keys.items():
+        by_key.setdefault(key, []).append(c)
+    topic_key = normalize_chapter_key(topic_name.split('-')[-1])
+    close = difflib.get_close_matches(topic_key, list(by_key), n=3, cutoff=fuzzy_cutoff)
+    fuzzy = [c for key in close for c in by_key[key]]
+    return (fuzzy, "fuzzy") if fuzzy else ([], "none")
+
+
+def resolve_chapter_candidates(topic_name: str, chapters: Iterable[str],
+                               fuzzy_cutoff: float = 0.75) -> Tuple[List[str], str]:
+    """Chapters for an env topic name, trying exact, normalised, substring, then fuzzy matching.
+
+    Returns (candidates, method); candidates is empty when nothing matched.
+    """
+    chapters = [c for c in chapters if c]
+    names = _topic_chapter_names(topic_name)
+    exact = [c for c in chapters if c in names]
+    if exact:
+        return exact, "exact"
+
+    keys = {c: normalize_chapter_key(c) for c in chapters}
+    wanted = {normalize_chapter_key(n) for n in names} - {""}
+    normalized = [c for c, key in keys.items() if key in wanted]
+    if normalized:
+        return normalized, "normalized"
+    return _approximate_chapter_matches(topic_name, keys, fuzzy_cutoff)
+
+
+CHAPTER_CATALOG_QUERY = """
+MATCH (ch:Chapter)
+OPTIONAL MATCH (ch)<-[:PART_OF]-(chunk:Chunk)
+RETURN ch.name AS name, count(chunk) AS chunks, count(chunk.embedding) AS embedded_chunks
+ORDER BY name
+"""
+
+
+# Written by `kg_builder_v2.py map-topics`.
+TOPIC_CHAPTER_MAP_QUERY = """
+MATCH (t:CurriculumTopic)-[r:COVERED_BY]->(ch:Chapter)
+RETURN t.name AS topic, ch.name AS chapter, r.confidence AS confidence, r.method AS method
+ORDER BY topic, confidence DESC
+"""
+
+
+class ChapterInfo(NamedTuple):
+    name: str
+    key: str
+    chunks: int
+    embedded_chunks: int
+
+    @property
+    def has_embeddings(self) -> bool:
+        return self.embedded_chunks > 0
+
+
+class ChapterCatalog:
+    """App-scoped view of the KG's chapters with O(1) lookups by name and normalised key.
+
+    When the builder's topic-to-chapter map is present, topics resolve through it
+    directly and name matching is not used. Loaded at startup, reloaded on a KG
+    version change, and refreshed in the background once `ttl_seconds` have passed.
+    """
+
+    def __init__(self, load_records: Callable[[], Awaitable[List[Dict[str, Any]]]],
+                 ttl_seconds: float = 600.0, fuzzy_cutoff: float = 0.75,
+                 load_topic_map: Optional[Callable[[], Awaitable[List[Dict[str, Any]]]]] = None):
+        self._load_records = load_records
+        self._load_topic_map = load_topic_map
+        self.ttl_seconds = ttl_seconds
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self._by_name: Dict[str, ChapterInfo] = {}
+        self._by_key: Dict[str, List[ChapterInfo]] = {}
+        self._topic_map: Dict[str, List[str]] = {}
+        self._refresh_lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
+        self.loaded_at: Optional[float] = None
+        self.version: Optional[int] = None
+        self.refreshes = 0
+        self.errors = 0
+        self.lookups = 0
+        self.resolved = {"mapped": 0, "unmapped": 0, "exact": 0, "normalized": 0,
+                         "substring": 0, "fuzzy": 0, "none": 0}
+
+    @property
+    def ready(self) -> bool:
+        return self.loaded_at is not None
+
+    @property
+    def names(self) -> List[str]:
+        return list(self._by_name)
+
+    def get(self, name: str) -> Optional[ChapterInfo]:
+        return self._by_name.get(name)
+
+    async def refresh(self, version: Optional[int] = None) -> bool:
+        async with self._refresh_lock:
+            try:
+                records = await self._load_records()
+                map_records = await self._load_topic_map() if self._load_topic_map else []
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Chapter catalog refresh failed: {e}", exc_info=True)
+                return False
+            by_name, by_key = {}, {}
+            for record in records:
+                name = record.get("name")
+                if not name:
+                    continue
+                info = ChapterInfo(name, normalize_chapter_key(name),
+                                   int(record.get("chunks") or 0), int(record.get("embedded_chunks") or 0))
+                by_name[name] = info
+                by_key.setdefault(info.key, []).append(info)
+            topic_map: Dict[str, List[str]] = {}
+            for record in map_records:
+                if record.get("chapter") in by_name:
+                    topic_map.setdefault(record.get("topic"), []).append(record["chapter"])
+            self._by_name, self._by_key, self._topic_map = by_name, by_key, topic_map
+            self.loaded_at = time.monotonic()
+            self.version = version
+            self.refreshes += 1
+            missing = [info.name for info in by_name.values() if not info.has_embeddings]
+            logger.info(f"Chapter catalog loaded {len(by_name)} chapters and {len(topic_map)} mapped topics "
+                        f"(KG version {version}).")
+            if not topic_map:
+                logger.warning("No topic-to-chapter map in the KG; resolving topics by name. "
+                               "Run `kg_builder_v2.py map-topics` to build it.")
+            if missing:
+                logger.warning(f"Chapters without chunk embeddings: {missing}")
+            return True
+
+    async def ensure_loaded(self):
+        """Load on first use; afterwards refresh in the background when the TTL has passed."""
+        if not self.ready:
+            await self.refresh(self.version)
+        elif (self.ttl_seconds and time.monotonic() - self.loaded_at > self.ttl_seconds
+              and (self._refresh_task is None or self._refresh_task.done())):
+            self._refresh_task = asyncio.create_task(self.refresh(self.version))
+
+    def resolve(self, topic_name: str) -> Tuple[List[str], str]:
+        """Chapters for a topic from the builder's map, or by resolve_chapter_candidates' rules without one."""
+        self.lookups += 1
+        if self._topic_map:
+            candidates = self._topic_map.get(topic_name, [])
+            method = "mapped" if candidates else "unmapped"
+            self.resolved[method] += 1
+            return list(candidates), method
+        names = _topic_chapter_names(topic_name)
+        candidates = list(dict.fromkeys(n for n in names if n in self._by_name))
+        method = "exact"
+        if not candidates:
+            method = "normalized"
+            candidates = list(dict.fromkeys(
+                info.name for n in names for info in self._by_key.get(normalize_chapter_key(n), [])))
+        if not candidates:
+            candidates, method = _approximate_chapter_matches(
+                topic_name, {name: info.key for name, info in self._by_name.items()}, self.fuzzy_cutoff)
+        self.resolved[method] += 1
+        return candidates, method
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready, "chapters": len(self._by_name), "kg_version": self.version,
+            "mapped_topics": len(self._topic_map),
+            "without_embeddings": [i.name for i in self._by_name.values() if not i.has_embeddings],
+            "ttl_seconds": self.ttl_seconds, "refreshes": self.refreshes, "errors": self.errors,
+            "lookups": self.lookups, "resolved": dict(self.resolved),
+        }
+
+
+CHUNK_EMBEDDINGS_QUERY = """
+MATCH (chunk:Chunk)-[:PART_OF]->(ch:Chapter)
+WHERE chunk.embedding IS NOT NULL
+RETURN ch.name AS chapter, chunk.text AS text, chunk.embedding AS embedding
+ORDER BY ch.name, chunk.seq_id
+"""
+
+
+class _IndexSnapshot(NamedTuple):
+    matrix: np.ndarray
+    texts: List[str]
+    chapter_ranges: Dict[str, Tuple[int, int]]
+    version: Optional[int]
+
+
+class ChunkVectorIndex:
+    """In-process cosine index over all Chunk embeddings, partitioned by chapter.
+
+    Rows are L2-normalised float32 and grouped by chapter, so a chapter-scoped top-k
+    is one matrix-vector product over a contiguous slice plus argpartition. Scores
+    are reported as (1 + cos) / 2 to match Neo4j's cosine vector index.
+    """
+
+    def __init__(self, load_records: Callable[[], Awaitable[List[Dict[str, Any]]]],
+                 dimension: Optional[int] = None):
+        self._load_records = load_records
+        self.dimension = dimension
+        self._snapshot: Optional[_IndexSnapshot] = None
+        self._refresh_lock = asyncio.Lock()
+        self.loaded_at: Optional[float] = None
+        self.refreshes = 0
+        self.searches = 0
+        self.errors = 0
+
+    @property
+    def ready(self) -> bool:
+        return self._snapshot is not None
+
+    @property
+    def chapters(self) -> List[str]:
+        return list(self._snapshot.chapter_ranges) if self._snapshot else []
+
+    def _build(self, records: List[Dict[str, Any]], version: Optional[int]) -> _IndexSnapshot:
+        rows, texts, chapter_ranges = [], [], {}
+        for record in records:
+            embedding = record.get("embedding")
+            if not embedding or (self.dimension and len(embedding) != self.dimension):
+                continue
+            chapter = record.get("chapter")
+            start, _ = chapter_ranges.get(chapter, (len(rows), len(rows)))
+            rows.append(embedding)
+            texts.append(record.get("text") or "")
+            chapter_ranges[chapter] = (start, len(rows))
+        matrix = np.asarray(rows, dtype=np.float32).reshape(len(rows), -1)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.where(norms > 0, norms, 1.0)
+        return _IndexSnapshot(matrix, texts, chapter_ranges, version)
+
+    async def refresh(self, version: Optional[int] = None) -> bool:
+        async with self._refresh_lock:
+            start = time.perf_counter()
+            try:
+                records = await self._load_records()
+                snapshot = await asyncio.to_thread(self._build, records, version)
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Chunk vector index refresh failed: {e}", exc_info=True)
+                return False
+            self._snapshot = snapshot
+            self.loaded_at = time.time()
+            self.refreshes += 1
+            logger.info(
+                f"Chunk vector index loaded {len(snapshot.texts)} chunks across "
+                f"{len(snapshot.chapter_ranges)} chapters (KG version {version}) "
+                f"in {time.perf_counter() - start:.2f}s.")
+            return True
+
+    def match_chapters(self, chapter_name: str) -> List[str]:
+        """Chapters equal to, containing, or contained in `chapter_name` (the Neo4j fallback's rule)."""
+        if not self._snapshot or not chapter_name:
+            return []
+        return [c for c in self._snapshot.chapter_ranges
+                if c == chapter_name or chapter_name in c or c in chapter_name]
+
+    def search(self, query_embedding: List[float], chapters: Optional[List[str]] = None,
+               top_k: int = 3, min_similarity: float = 0.0) -> Optional[List[Dict[str, Any]]]:
+        """Top-k chunks as [{'chunkText', 'score'}], or None when the index is not loaded."""
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.matrix.shape[0] == 0:
+            return None
+        query = np.asarray(query_embedding, dtype=np.float32)
+        if query.shape[0] != snapshot.matrix.shape[1]:
+            return None
+        query_norm = np.linalg.norm(query)
+        if query_norm == 0:
+            return None
+        self.searches += 1
+        query = query / query_norm
+
+        if chapters is None:
+            row_ids = np.arange(snapshot.matrix.shape[0])
+            scores = snapshot.matrix @ query
+        else:
+            ranges = [snapshot.chapter_ranges[c] for c in chapters if c in snapshot.chapter_ranges]
+            if not ranges:
+                return []
+            row_ids = np.concatenate([np.arange(start, end) for start, end in ranges])
+            scores = np.concatenate([snapshot.matrix[start:end] @ query for start, end in ranges])
+        scores = (1.0 + scores) / 2.0
+
+        k = min(top_k, scores.shape[0])
+        top = np.argpartition(-scores, k - 1)[:k] if k < scores.shape[0] else np.arange(scores.shape[0])
+        top = top[np.argsort(-scores[top])]
+        return [{"chunkText": snapshot.texts[row_ids[i]], "score": float(scores[i])}
+                for i in top if scores[i] >= min_similarity]
+
+    def stats(self) -> Dict[str, Any]:
+        snapshot = self._snapshot
+        return {
+            "ready": snapshot is not None,
+            "chunks": len(snapshot.texts) if snapshot else 0,
+            "chapters": len(snapshot.chapter_ranges) if snapshot else 0,
+            "kg_version": snapshot.version if snapshot else None,
+            "memory_mb": round(snapshot.matrix.nbytes / 2 ** 20, 2) if snapshot else 0.0,
+            "loaded_at": self.loaded_at, "refreshes": self.refreshes,
+            "searches": self.searches, "errors": self.errors,
+        }
+
+
+KG_SCHEMA_QUERY = """
+CALL db.schema.visualization()
+YIELD nodes, relationships
+RETURN
+    [rel IN relationships | type(rel)] AS rel_types,
+    [node IN nodes | labels(node)[0]] AS node_labels
+"""
+
+
+class KGSchema:
+    """Relationship types and node labels present in the KG, introspected once per KG version."""
+
+    def __init__(self, load_schema: Callable[[], Awaitable[Optional[Dict[str, Any]]]]):
+        self._load_schema = load_schema
+        self.rel_types: frozenset = frozenset()
+        self.node_labels: frozenset = frozenset()
+        self.version: Optional[int] = None
+        self.refreshes = 0
+        self.errors = 0
+
+    @property
+    def ready(self) -> bool:
+        return self.refreshes > 0
+
+    def has(self, rel_type: str, label: Optional[str] = None) -> bool:
+        return rel_type in self.rel_types and (label is None or label in self.node_labels)
+
+    async def refresh(self, version: Optional[int] = None) -> bool:
+        try:
+            record = await self._load_schema() or {}
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"KG schema introspection failed: {e}", exc_info=True)
+            return False
+        self.rel_types = frozenset(record.get("rel_types") or [])
+        self.node_labels = frozenset(record.get("node_labels") or [])
+        self.version = version
+        self.refreshes += 1
+        logger.info(f"KG schema: {len(self.node_labels)} labels, {len(self.rel_types)} relationship types "
+                    f"(KG version {version}).")
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {"ready": self.ready, "kg_version": self.version, "refreshes": self.refreshes,
+                "errors": self.errors, "rel_types": sorted(self.rel_types),
+                "node_labels": sorted(self.node_labels)}
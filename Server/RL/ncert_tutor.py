@@ -6,14 +6,32 @@ from stable_baselines3.common.env_checker import check_env
 from stable_baselines3.common.monitor import Monitor
 from stable_baselines3.common.vec_env import DummyVecEnv, SubprocVecEnv
 from stable_baselines3.common.callbacks import EvalCallback, CheckpointCallback
+import torch as th
 import matplotlib.pyplot as plt
-from typing import List, Any, Dict
+from typing import List, Any, Dict, NamedTuple, Optional, Tuple
 import os
 from enum import Enum
 
+try:
+    from sb3_contrib import MaskablePPO
+    from sb3_contrib.common.maskable.callbacks import MaskableEvalCallback
+    from sb3_contrib.common.maskable.policies import MaskableActorCriticPolicy
+    MASKABLE_PPO_AVAILABLE = True
+except ImportError:
+    MaskablePPO = None
+    MaskableEvalCallback = None
+    MaskableActorCriticPolicy = None
+    MASKABLE_PPO_AVAILABLE = False
+
 DEBUG_MODE = False
 LEARNING_ACCELERATION = 2.0
 
+# Topic action masking: a topic is selectable once its prerequisites are
+# mastered on average to at least PREREQ_READINESS_THRESHOLD and it is not
+# already mastered. Both values mirror the penalties in _calculate_reward.
+PREREQ_READINESS_THRESHOLD = 0.4
+MASTERED_TOPIC_THRESHOLD = 0.95
+
 
 class NCERT_CURRICULUM:
     SUBJECTS = {
@@ -177,6 +195,18 @@ class NCERT_CURRICULUM:
     }
 
 
+def curriculum_topic_names(curriculum=NCERT_CURRICULUM) -> List[str]:
+    """Full topic names in env order, e.g. 'Science-Fibre to Fabric' or 'Social_Science-History-...'."""
+    topics = []
+    for subject, content in curriculum.SUBJECTS.items():
+        if isinstance(content, list):
+            topics.extend(f"{subject}-{topic}" for topic in content)
+        else:
+            for subsubject, subtopics in content.items():
+                topics.extend(f"{subject}-{subsubject}-{topic}" for topic in subtopics)
+    return topics
+
+
 class LearningStyles(Enum):
     VISUAL = 0
     AUDITORY = 1
@@ -232,6 +262,78 @@ training_phases = [
 TOTAL_TRAINING_STEPS = sum(p['timesteps'] for p in training_phases)
 
 
+def compute_topic_mask(mastery: np.ndarray, prerequisite_matrix: np.ndarray,
+                       readiness_threshold: float = PREREQ_READINESS_THRESHOLD,
+                       mastered_threshold: float = MASTERED_TOPIC_THRESHOLD) -> np.ndarray:
+    """Boolean mask of topics whose prerequisites are ready and which are not yet mastered."""
+    mastery = np.asarray(mastery, dtype=np.float32)
+    prereq_counts = prerequisite_matrix.sum(axis=1)
+    readiness = np.divide(prerequisite_matrix @ mastery, prereq_counts,
+                          out=np.ones_like(mastery), where=prereq_counts > 0)
+    not_mastered = mastery < mastered_threshold
+    mask = (readiness >= readiness_threshold) & not_mastered
+    if not mask.any():
+        # Never leave the policy without a legal topic.
+        mask = not_mastered if not_mastered.any() else np.ones_like(mask)
+    return mask
+
+
+def build_action_mask(action_nvec: np.ndarray, topic_mask: np.ndarray) -> np.ndarray:
+    """Flat MultiDiscrete mask (sb3-contrib layout) with only the topic dimension restricted."""
+    segments = [np.ones(int(n), dtype=bool) for n in action_nvec]
+    segments[1] = np.asarray(topic_mask, dtype=bool)
+    return np.concatenate(segments)
+
+
+def select_actions_from_logits(logits: np.ndarray, action_nvec: np.ndarray,
+                               action_mask: Optional[np.ndarray] = None,
+                               deterministic: bool = True) -> np.ndarray:
+    """Pick one action per MultiDiscrete dimension from flat logits, honouring an optional flat mask."""
+    logits = np.atleast_2d(np.asarray(logits, dtype=np.float32))
+    if action_mask is not None:
+        mask = np.broadcast_to(np.asarray(action_mask, dtype=bool), logits.shape)
+        logits = np.where(mask, logits, -np.inf)
+    actions = np.empty((logits.shape[0], len(action_nvec)), dtype=np.int64)
+    offset = 0
+    for dim, n in enumerate(action_nvec):
+        segment = logits[:, offset:offset + int(n)]
+        if not deterministic:
+            # Gumbel-max sampling keeps masked (-inf) entries unreachable.
+            segment = segment + np.random.gumbel(size=segment.shape)
+        actions[:, dim] = np.argmax(segment, axis=1)
+        offset += int(n)
+    return actions
+
+
+def masked_predict(model, observation: np.ndarray, action_mask: Optional[np.ndarray] = None,
+                   deterministic: bool = True) -> Tuple[np.ndarray, None]:
+    """predict() for PPO or MaskablePPO models that applies the topic mask to the policy logits."""
+    if MASKABLE_PPO_AVAILABLE and isinstance(model, MaskablePPO):
+        return model.predict(observation, action_masks=action_mask, deterministic=deterministic)
+    policy = model.policy
+    obs_tensor, vectorized = policy.obs_to_tensor(observation)
+    with th.no_grad():
+        distribution = policy.get_distribution(obs_tensor)
+        logits = th.cat([d.logits for d in distribution.distribution], dim=1)
+    actions = select_actions_from_logits(
+        logits.cpu().numpy(), model.action_space.nvec, action_mask, deterministic)
+    return (actions if vectorized else actions[0]), None
+
+
+class SimulatorState(NamedTuple):
+    buffer: np.ndarray
+    profile_idx: int
+    current_topic_idx: int
+    last_avg_mastery: float
+    last_highest_mastery: Optional[float]
+    current_step: int
+    history: List[Dict]
+    history_len: int
+    episode_metrics: Dict
+    global_rng_state: tuple
+    env_rng_state: Optional[Dict]
+
+
 class NCERTStudentEnv(gym.Env):
     metadata = {'render_modes': ['human']}
 
@@ -338,30 +440,116 @@ class NCERTStudentEnv(gym.Env):
             profiles.append(profile)
         return profiles
 
+    def _state_layout(self) -> Dict[str, slice]:
+        """Offsets of the per-student arrays inside one contiguous float32 buffer."""
+        if getattr(self, '_state_slices', None) is None:
+            sizes = [('mastery', self.num_topics), ('engagement', 1), ('attention', 1),
+                     ('cognitive_load', 1), ('motivation', 1),
+                     ('learning_style_prefs', len(LearningStyles)),
+                     ('strategy_history', NUM_STRATEGIES), ('topic_attempts', self.num_topics),
+                     ('time_since_last_practiced', self.num_topics),
+                     ('misconceptions', self.num_topics), ('recent_performance', 1),
+                     ('steps_on_current_topic', 1)]
+            self._state_slices, offset = {}, 0
+            for key, size in sizes:
+                self._state_slices[key] = slice(offset, offset + size)
+                offset += size
+            self._state_size = offset
+        return self._state_slices
+
     def _initialize_student_state(self, profile_idx=None):
         if profile_idx is None:
             profile_idx = np.random.randint(len(self.student_profiles))
         profile = self.student_profiles[profile_idx]
-        student = {
+        # All arrays are views into a single buffer so get_state/set_state are one memcpy.
+        layout = self._state_layout()
+        buffer = np.zeros(self._state_size, dtype=np.float32)
+        student = {key: buffer[sl] for key, sl in layout.items()}
+        student['mastery'][:] = np.random.uniform(0.01, 0.15, size=self.num_topics)
+        student['engagement'][0] = np.random.uniform(0.6, 0.9)
+        student['attention'][0] = profile['attention_span']
+        student['cognitive_load'][0] = np.random.uniform(0.2, 0.4)
+        student['motivation'][0] = profile['motivation_factors']['intrinsic']
+        student['learning_style_prefs'][:] = profile['learning_style_prefs']
+        student['time_since_last_practiced'][:] = self.max_steps / 5.0
+        student['recent_performance'][0] = 0.5
+        student.update({
             'profile_idx': profile_idx, 'profile': profile,
-            'mastery': np.random.uniform(0.01, 0.15, size=self.num_topics).astype(np.float32),
-            'engagement': np.array([np.random.uniform(0.6, 0.9)], dtype=np.float32),
-            'attention': np.array([profile['attention_span']], dtype=np.float32),
-            'cognitive_load': np.array([np.random.uniform(0.2, 0.4)], dtype=np.float32),
-            'motivation': np.array([profile['motivation_factors']['intrinsic']], dtype=np.float32),
-            'learning_style_prefs': profile['learning_style_prefs'].astype(np.float32),
-            'strategy_history': np.zeros(NUM_STRATEGIES, dtype=np.float32),
-            'topic_attempts': np.zeros(self.num_topics, dtype=np.float32),
-            'time_since_last_practiced': np.full(self.num_topics, self.max_steps / 5.0, dtype=np.float32),
-            'misconceptions': np.zeros(self.num_topics, dtype=np.float32),
             'current_topic_idx': self.num_topics,
-            'recent_performance': np.array([0.5], dtype=np.float32),
-            'steps_on_current_topic': np.array([0], dtype=np.float32),
             'internal_history': [],
-            'last_avg_mastery': 0.0
-        }
+            'last_avg_mastery': 0.0,
+            '_buffer': buffer,
+        })
         return student
 
+    def get_state(self) -> "SimulatorState":
+        """Snapshot the simulator (student arrays, counters and RNG) for a later set_state()."""
+        if self.current_student is None:
+            raise RuntimeError("Reset env first.")
+        student = self.current_student
+        return SimulatorState(
+            buffer=student['_buffer'].copy(),
+            profile_idx=student['profile_idx'],
+            current_topic_idx=student['current_topic_idx'],
+            last_avg_mastery=student['last_avg_mastery'],
+            last_highest_mastery=student.get('last_highest_mastery'),
+            current_step=self.current_step,
+            # history is append-only, so the list object plus its length is enough; set_state slices a copy.
+            history=self.history,
+            history_len=len(self.history),
+            episode_metrics=self.episode_metrics,
+            global_rng_state=np.random.get_state(),
+            env_rng_state=self._np_random.bit_generator.state if self._np_random is not None else None,
+        )
+
+    def set_state(self, state: "SimulatorState"):
+        """Restore a snapshot taken with get_state() on an env with the same curriculum."""
+        student = self.current_student
+        if student is None or student['profile_idx'] != state.profile_idx:
+            student = self._initialize_student_state(state.profile_idx)
+            self.current_student = student
+        np.copyto(student['_buffer'], state.buffer)
+        student['current_topic_idx'] = state.current_topic_idx
+        student['last_avg_mastery'] = state.last_avg_mastery
+        if state.last_highest_mastery is None:
+            student.pop('last_highest_mastery', None)
+        else:
+            student['last_highest_mastery'] = state.last_highest_mastery
+        self.current_step = state.current_step
+        # A copy, so restoring one snapshot never truncates entries another snapshot of the same list still needs.
+        self.history = state.history[:state.history_len]
+        self.episode_metrics = state.episode_metrics
+        np.random.set_state(state.global_rng_state)
+        if state.env_rng_state is not None and self._np_random is not None:
+            self._np_random.bit_generator.state = state.env_rng_state
+
+    def evaluate_candidate_actions(self, candidate_actions: np.ndarray, horizon: int = 1,
+                                   rollout_policy=None, gamma: float = 0.99) -> np.ndarray:
+        """Discounted return of each candidate action over a short lookahead horizon.
+
+        Every candidate starts from the same snapshot, including the RNG state, so
+        candidates are compared under common random numbers. After the first step
+        the rollout continues with rollout_policy(obs) if given, otherwise it
+        repeats the candidate. The env is restored to its original state afterwards.
+        """
+        candidate_actions = np.atleast_2d(np.asarray(candidate_actions, dtype=np.int64))
+        root = self.get_state()
+        returns = np.zeros(len(candidate_actions), dtype=np.float64)
+        try:
+            for k, candidate in enumerate(candidate_actions):
+                self.set_state(root)
+                action, discount = candidate, 1.0
+                for _ in range(max(1, horizon)):
+                    obs, reward, done, truncated, _ = self.step(action)
+                    returns[k] += discount * reward
+                    if done or truncated:
+                        break
+                    discount *= gamma
+                    action = np.asarray(rollout_policy(obs)) if rollout_policy is not None else candidate
+        finally:
+            self.set_state(root)
+        return returns
+
     def _get_obs(self):
         if self.current_student is None:
             raise RuntimeError("Reset env first.")
@@ -392,16 +580,6 @@ class NCERTStudentEnv(gym.Env):
         action_int = action.astype(int)
         strategy_idx, topic_idx, difficulty_idx, scaffold_idx, feedback_idx, length_idx = action_int
 
-        topic_priorities = self._calculate_topic_priority()
-        override_prob = 0.30
-        if topic_priorities.size > topic_idx and topic_priorities[topic_idx] < 0.3 and np.random.random() < override_prob:
-            high_priority_topics = np.where(topic_priorities > 0.6)[0]
-            if len(high_priority_topics) > 0:
-                new_topic_idx = np.random.choice(high_priority_topics)
-                self._debug_print(
-                    f"Override topic {topic_idx} (prio {topic_priorities[topic_idx]:.2f}) with {new_topic_idx} (prio {topic_priorities[new_topic_idx]:.2f})")
-                topic_idx = new_topic_idx
-
         topic_idx = np.clip(topic_idx, 0, self.num_topics - 1)
 
         strategy = TeachingStrategies(strategy_idx)
@@ -609,6 +787,14 @@ class NCERTStudentEnv(gym.Env):
 
         return self._get_obs(), reward, done, truncated, info
 
+    def action_masks(self) -> np.ndarray:
+        """Flat action mask consumed by MaskablePPO; only topic selection is restricted."""
+        if self.current_student is None:
+            return np.ones(int(self.action_space.nvec.sum()), dtype=bool)
+        topic_mask = compute_topic_mask(
+            self.current_student['mastery'], self.prerequisite_matrix)
+        return build_action_mask(self.action_space.nvec, topic_mask)
+
     def _calculate_topic_priority(self):
         """Calculate priority scores for each topic (heuristic)."""
         if self.current_student is None:
@@ -789,8 +975,61 @@ class NCERTStudentEnv(gym.Env):
     def close(self): pass
 
 
+# Normalized observation mode. Every component already lives in [0, 1] except
+# the counters below, which are log-compressed against the fixed upper bound of
+# their observation space: x -> log1p(x) / log1p(high). The bounds come from the
+# space definition (topic_attempts: 100, time_since_last_practiced: 2*max_steps,
+# steps_on_current_topic: max_steps), so no running statistics are needed and
+# the API reproduces the exact same transform from the model's env settings.
+LOG_SCALED_OBSERVATION_KEYS = (
+    'topic_attempts', 'time_since_last_practiced', 'steps_on_current_topic')
+
+
+class ObservationFlattener:
+    """Flattens Dict observations into one float32 vector, optionally normalized."""
+
+    def __init__(self, observation_space: spaces.Dict, num_topics: int, normalize: bool = False):
+        self.num_topics = num_topics
+        self.normalize = normalize
+        self.component_order = list(observation_space.spaces.keys())
+        self.component_slices: Dict[str, slice] = {}
+        self.log_scales: Dict[str, float] = {}
+        offset = 0
+        for key in self.component_order:
+            space = observation_space.spaces[key]
+            size = int(np.prod(space.shape)) if isinstance(space, spaces.Box) else 1
+            self.component_slices[key] = slice(offset, offset + size)
+            offset += size
+            if normalize and key in LOG_SCALED_OBSERVATION_KEYS:
+                self.log_scales[key] = float(1.0 / np.log1p(np.max(space.high)))
+        self.size = offset
+
+    @classmethod
+    def from_env(cls, env: NCERTStudentEnv, normalize: bool = False) -> "ObservationFlattener":
+        return cls(env.observation_space, env.num_topics, normalize)
+
+    def flatten(self, obs: Dict[str, Any]) -> np.ndarray:
+        out = np.empty(self.size, dtype=np.float32)
+        for key in self.component_order:
+            view = out[self.component_slices[key]]
+            comp = obs[key]
+            if key == 'current_topic_idx':
+                view[0] = float(comp) / float(self.num_topics) if self.num_topics > 0 else float(comp)
+            elif isinstance(comp, np.ndarray):
+                view[:] = comp.reshape(-1)
+            elif isinstance(comp, (int, float, np.number)):
+                view[0] = comp
+            else:
+                raise TypeError(f"Unexpected type '{key}': {type(comp)}")
+            scale = self.log_scales.get(key)
+            if scale is not None:
+                np.log1p(view, out=view)
+                view *= scale
+        return out
+
+
 class FlattenObservation(gym.ObservationWrapper):
-    def __init__(self, env: NCERTStudentEnv):
+    def __init__(self, env: NCERTStudentEnv, normalize: bool = False):
         super().__init__(env)
         self.topics = getattr(env, 'topics', [])
         self.num_topics = getattr(env, 'num_topics', 0)
@@ -799,43 +1038,34 @@ class FlattenObservation(gym.ObservationWrapper):
             env, 'topic_base_difficulty', np.array([]))
         self.prerequisite_matrix = getattr(
             env, 'prerequisite_matrix', np.array([[]]))
-        flat_size = 0
-        self._component_order = list(env.observation_space.spaces.keys())
-        self._component_shapes = {}
-        for key in self._component_order:
-            space = env.observation_space.spaces[key]
-            size = np.prod(space.shape) if isinstance(space, spaces.Box) else 1
-            flat_size += int(size)
-            self._component_shapes[key] = int(size)
+        self.normalize = normalize
+        self.flattener = ObservationFlattener(
+            env.observation_space, self.num_topics, normalize)
+        self._component_order = self.flattener.component_order
+        self._component_shapes = {
+            key: sl.stop - sl.start for key, sl in self.flattener.component_slices.items()}
         self.observation_space = spaces.Box(
-            low=-np.inf, high=np.inf, shape=(flat_size,), dtype=np.float32)
+            low=-np.inf, high=np.inf, shape=(self.flattener.size,), dtype=np.float32)
 
     def observation(self, obs: Dict[str, Any]) -> np.ndarray:
-        flat_obs_list = []
-        for key in self._component_order:
-            comp = obs[key]
-            if isinstance(comp, np.ndarray):
-                flat_obs_list.append(comp.astype(np.float32).flatten())
-            elif isinstance(comp, (int, float, np.number)):
-                norm_val = float(
-                    comp)/float(self.num_topics) if key == 'current_topic_idx' and self.num_topics > 0 else float(comp)
-                flat_obs_list.append(np.array(
-                    [norm_val] if key == 'current_topic_idx' else [comp], dtype=np.float32))
-            else:
-                raise TypeError(f"Unexpected type '{key}': {type(comp)}")
-        final_obs = np.concatenate(flat_obs_list)
-        if final_obs.shape[0] != self.observation_space.shape[0]:
-            raise ValueError(
-                f"Shape mismatch: Exp {self.observation_space.shape[0]}, Got {final_obs.shape[0]}")
-        return final_obs
+        return self.flattener.flatten(obs)
+
+    def action_masks(self) -> np.ndarray:
+        return self.env.action_masks()
 
 
 class NCERTLearningSystem:
-    def __init__(self, num_students=20, max_steps=250, log_dir="./ncert_tutor_logs_enhanced", num_cpu=4):
+    def __init__(self, num_students=20, max_steps=250, log_dir="./ncert_tutor_logs_enhanced", num_cpu=4, use_action_masking=True, normalize_observations=False, compile_policy=False):
         self.num_students = num_students
         self.max_steps = max_steps
         self.log_dir = log_dir
         self.num_cpu = max(1, num_cpu)
+        self.use_action_masking = use_action_masking and MASKABLE_PPO_AVAILABLE
+        self.normalize_observations = normalize_observations
+        self.compile_policy = compile_policy
+        self.inference_policy = None
+        if use_action_masking and not MASKABLE_PPO_AVAILABLE:
+            print("sb3-contrib not installed; training without topic action masking.")
         os.makedirs(log_dir, exist_ok=True)
         os.makedirs(f"{log_dir}/models", exist_ok=True)
         os.makedirs(f"{log_dir}/tensorboard", exist_ok=True)
@@ -845,13 +1075,16 @@ class NCERTLearningSystem:
             env_fns) if self.num_cpu > 1 else DummyVecEnv(env_fns)
         print(
             f"Using {'SubprocVecEnv' if self.num_cpu > 1 else 'DummyVecEnv'} with {self.num_cpu} process(es).")
+        self.observation_flattener = ObservationFlattener.from_env(
+            NCERTStudentEnv(num_students=1, max_steps=self.max_steps), normalize=normalize_observations)
         self.model = None
 
     def _make_env(self, rank: int, seed: int = 0):
         def _init():
             env = NCERTStudentEnv(
                 num_students=self.num_students, max_steps=self.max_steps)
-            env = FlattenObservation(env)
+            env = FlattenObservation(
+                env, normalize=self.normalize_observations)
             log_file = os.path.join(self.log_dir, f"monitor_{rank}.csv")
             env = Monitor(env, log_file, info_keywords=('reward', 'mastery_gain', 'engagement',
                           'cog_load', 'motivation', 'eff_difficulty', 'miscon_formed', 'miscon_cleared'))
@@ -898,32 +1131,71 @@ class NCERTLearningSystem:
             return None
 
     def create_model(self, policy="MlpPolicy", learning_rate=1e-4, gamma=0.99, verbose=1, ent_coef=0.01, **ppo_kwargs):
+        algorithm = MaskablePPO if self.use_action_masking else PPO
+        self.model = self.build_model(algorithm, self.vec_env, policy=policy, learning_rate=learning_rate,
+                                      gamma=gamma, verbose=verbose, ent_coef=ent_coef, **ppo_kwargs)
+        print(
+            f"{algorithm.__name__} Model Created. LR={learning_rate}, EntCoef={ent_coef}")
+        return self.model
+
+    def build_model(self, algorithm, env, policy="MlpPolicy", learning_rate=1e-4, gamma=0.99, verbose=1, ent_coef=0.01, **ppo_kwargs):
+        """Instantiate a PPO-family algorithm with the system's default hyperparameters."""
         default_policy_kwargs = dict(
             net_arch=dict(pi=[256, 256], vf=[256, 256]))
         final_policy_kwargs = {**default_policy_kwargs,
                                **ppo_kwargs.pop('policy_kwargs', {})}
-        self.model = PPO(policy, self.vec_env, verbose=verbose, tensorboard_log=f"{self.log_dir}/tensorboard/", learning_rate=learning_rate, gamma=gamma,
-                         n_steps=2048, batch_size=64, n_epochs=15, gae_lambda=0.95, clip_range=0.2, ent_coef=ent_coef, policy_kwargs=final_policy_kwargs, **ppo_kwargs)
-        print(f"PPO Model Created. LR={learning_rate}, EntCoef={ent_coef}")
-        return self.model
-
-    def train_model(self, total_timesteps=2_000_000, eval_freq=50000, save_freq=200000, n_eval_episodes=20):
-        if self.model is None:
-            self.create_model()
+        model = algorithm(policy, env, verbose=verbose, tensorboard_log=f"{self.log_dir}/tensorboard/", learning_rate=learning_rate, gamma=gamma,
+                          n_steps=2048, batch_size=64, n_epochs=15, gae_lambda=0.95, clip_range=0.2, ent_coef=ent_coef, policy_kwargs=final_policy_kwargs, **ppo_kwargs)
+        if self.compile_policy:
+            from policy_inference import compile_policy_for_training
+            compile_policy_for_training(model.policy)
+        return model
+
+    def make_callbacks(self, eval_freq, save_freq, n_eval_episodes, n_envs):
         eval_log_path = f"{self.log_dir}/eval_logs"
         os.makedirs(eval_log_path, exist_ok=True)
         eval_env = self._make_env(rank=999)()
-        eval_callback = EvalCallback(eval_env, best_model_save_path=f"{self.log_dir}/models/best", log_path=eval_log_path, eval_freq=max(
-            eval_freq//self.num_cpu, 1), n_eval_episodes=n_eval_episodes, deterministic=True, render=False)
+        eval_callback_cls = MaskableEvalCallback if self.is_maskable else EvalCallback
+        eval_callback = eval_callback_cls(eval_env, best_model_save_path=f"{self.log_dir}/models/best", log_path=eval_log_path, eval_freq=max(
+            eval_freq//n_envs, 1), n_eval_episodes=n_eval_episodes, deterministic=True, render=False)
         checkpoint_callback = CheckpointCallback(save_freq=max(
-            save_freq//self.num_cpu, 1), save_path=f"{self.log_dir}/models/checkpoints", name_prefix="ncert_tutor_enhanced")
+            save_freq//n_envs, 1), save_path=f"{self.log_dir}/models/checkpoints", name_prefix="ncert_tutor_enhanced")
+        return [eval_callback, checkpoint_callback]
+
+    def train_model(self, total_timesteps=2_000_000, eval_freq=50000, save_freq=200000, n_eval_episodes=20):
+        if self.model is None:
+            self.create_model()
+        callbacks = self.make_callbacks(
+            eval_freq, save_freq, n_eval_episodes, self.num_cpu)
         print(f"Starting training phase for {total_timesteps} timesteps...")
         try:
-            self.model.learn(total_timesteps=total_timesteps, callback=[
-                             eval_callback, checkpoint_callback], progress_bar=True, reset_num_timesteps=(self.model.num_timesteps == 0))
+            self.model.learn(total_timesteps=total_timesteps, callback=callbacks,
+                             progress_bar=True, reset_num_timesteps=(self.model.num_timesteps == 0))
         except KeyboardInterrupt:
             print("\nTraining interrupted.")
 
+    def train_model_actor_learner(self, total_timesteps=2_000_000, address="127.0.0.1:6100", num_workers=2,
+                                  envs_per_worker=4, spawn_local_workers=True, authkey=None,
+                                  eval_freq=50000, save_freq=200000, n_eval_episodes=20):
+        """Train with rollouts collected by remote worker processes (see distributed_rollouts.py)."""
+        from distributed_rollouts import ActorLearnerTrainer
+        trainer = ActorLearnerTrainer(
+            self, address=address, num_workers=num_workers, envs_per_worker=envs_per_worker, authkey=authkey)
+        try:
+            if spawn_local_workers:
+                trainer.spawn_local_workers()
+            trainer.accept_workers()
+            callbacks = self.make_callbacks(
+                eval_freq, save_freq, n_eval_episodes, trainer.total_envs)
+            print(
+                f"Starting actor-learner training for {total_timesteps} timesteps with {num_workers} worker(s)...")
+            self.model.learn(total_timesteps=total_timesteps, callback=callbacks,
+                             progress_bar=True, reset_num_timesteps=(self.model.num_timesteps == 0))
+        except KeyboardInterrupt:
+            print("\nTraining interrupted.")
+        finally:
+            trainer.close()
+
     def save_final_model(self):
         if self.model:
             final_path = f"{self.log_dir}/models/final_model_phased"
@@ -938,14 +1210,71 @@ class NCERTLearningSystem:
             self.model = None
             return None
         try:
-            self.model = PPO.load(path, env=self.vec_env)
-            print(f"Model loaded: {path}")
+            self.model = None
+            if self.use_action_masking:
+                try:
+                    model = MaskablePPO.load(path, env=self.vec_env)
+                    if isinstance(model.policy, MaskableActorCriticPolicy):
+                        self.model = model
+                except Exception as e:
+                    print(f"Not a MaskablePPO checkpoint ({e}); loading as PPO.")
+            self.inference_policy = None
+            if self.model is None:
+                # Plain PPO checkpoints are still served with the topic mask via masked_predict.
+                self.model = PPO.load(path, env=self.vec_env)
+            print(f"Model loaded ({type(self.model).__name__}): {path}")
             return self.model
         except Exception as e:
             print(f"Error loading model: {e}")
             self.model = None
             return None
 
+    @property
+    def is_maskable(self) -> bool:
+        return MASKABLE_PPO_AVAILABLE and isinstance(self.model, MaskablePPO)
+
+    def predict(self, observation: np.ndarray, action_mask: Optional[np.ndarray] = None, deterministic: bool = True):
+        """Model prediction restricted to the legal actions in action_mask."""
+        if self.model is None:
+            raise RuntimeError("No model loaded.")
+        if self.inference_policy is not None:
+            return self.inference_policy.predict(observation, action_mask, deterministic)
+        if action_mask is None:
+            return self.model.predict(observation, deterministic=deterministic)
+        return masked_predict(self.model, observation, action_mask, deterministic)
+
+    def sample_observations(self, n_samples=256, seed=0) -> np.ndarray:
+        """Flattened observations from random rollouts, for calibration and equivalence checks."""
+        env = FlattenObservation(NCERTStudentEnv(num_students=self.num_students, max_steps=self.max_steps),
+                                 normalize=self.normalize_observations)
+        env.action_space.seed(seed)
+        obs, _ = env.reset(seed=seed)
+        samples = []
+        for _ in range(n_samples):
+            samples.append(obs)
+            obs, _, done, truncated, _ = env.step(env.action_space.sample())
+            if done or truncated:
+                obs, _ = env.reset()
+        return np.stack(samples)
+
+    def enable_compiled_policy(self, backend="torchscript", use_bf16=False, n_samples=256) -> Dict[str, Any]:
+        """Switch predict() to a compiled actor path if it matches the eager policy; returns a report."""
+        from policy_inference import CompiledPolicy
+        if self.model is None:
+            raise RuntimeError("No model loaded.")
+        observations = self.sample_observations(n_samples)
+        compiled = CompiledPolicy(self.model.policy, self.model.action_space.nvec,
+                                  observations[0], backend=backend, use_bf16=use_bf16)
+        report = {"backend": backend, "dtype": str(compiled.dtype).replace("torch.", ""),
+                  **compiled.verify(observations), **compiled.benchmark(observations)}
+        if report["passed"]:
+            self.inference_policy = compiled
+            print(f"Compiled policy enabled: {report}")
+        else:
+            self.inference_policy = None
+            print(f"Compiled policy rejected (not equivalent to eager): {report}")
+        return report
+
     def evaluate_model(self, n_episodes=20, render=False):
         """Evaluate the trained model and collect detailed metrics."""
         if self.model is None:
@@ -962,7 +1291,8 @@ class NCERTLearningSystem:
             done, truncated = False, False
             total_r, steps = 0, 0
             while not (done or truncated):
-                action, _ = self.model.predict(obs, deterministic=True)
+                action, _ = self.predict(
+                    obs, action_mask=eval_env.env.action_masks(), deterministic=True)
                 obs, r, done, truncated, info = eval_env.step(action)
                 total_r += r
                 steps += 1
@@ -1016,10 +1346,15 @@ if __name__ == "__main__":
     N_CPUS = max(1, os.cpu_count() - 1) if os.cpu_count() else 4
     EVAL_FREQ = 100_000
     SAVE_FREQ = 250_000
+    # Must match the API's RL_NORMALIZE_OBSERVATIONS when serving the trained model.
+    NORMALIZE_OBSERVATIONS = os.getenv(
+        "RL_NORMALIZE_OBSERVATIONS", "false").lower() == "true"
+    COMPILE_POLICY = os.getenv("RL_COMPILE_POLICY", "false").lower() == "true"
 
     print("Initializing NCERTLearningSystem...")
     system = NCERTLearningSystem(
-        num_students=20, max_steps=250, log_dir=LOG_DIR, num_cpu=N_CPUS)
+        num_students=20, max_steps=250, log_dir=LOG_DIR, num_cpu=N_CPUS,
+        normalize_observations=NORMALIZE_OBSERVATIONS, compile_policy=COMPILE_POLICY)
 
     print("\nChecking environment...")
     try:
@@ -0,0 +1,128 @@
+import time
+import logging
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, NamedTuple, Optional, Tuple, TypeVar
+
+from neo4j import AsyncGraphDatabase, Query, READ_ACCESS, WRITE_ACCESS, exceptions as neo4j_exceptions
+
+logger = logging.getLogger("neo4j_async")
+
+T = TypeVar("T")
+LATENCY_WINDOW = 512
+
+
+class PrerequisiteChain(NamedTuple):
+    prerequisite: str
+    chain: List[str]
+    depth: int
+
+
+class ConceptRelations(NamedTuple):
+    topic: str
+    related: List[str]
+
+
+def as_prerequisite_chain(record: Dict[str, Any]) -> PrerequisiteChain:
+    return PrerequisiteChain(record.get("prerequisite"), list(record.get("chain") or []), int(record.get("depth") or 0))
+
+
+def as_concept_relations(record: Dict[str, Any]) -> ConceptRelations:
+    return ConceptRelations(record.get("topic"), [r for r in record.get("related") or [] if r])
+
+
+class _QueryMetrics:
+    __slots__ = ("count", "errors", "total_ms", "max_ms", "recent")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.recent: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+    def observe(self, elapsed_ms: float, failed: bool):
+        self.count += 1
+        self.errors += int(failed)
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.recent.append(elapsed_ms)
+
+    def summary(self) -> Dict[str, Any]:
+        recent = sorted(self.recent)
+
+        def pct(q: float) -> float:
+            return round(recent[min(len(recent) - 1, int(q * len(recent)))], 2) if recent else 0.0
+
+        return {"count": self.count, "errors": self.errors,
+                "avg_ms": round(self.total_ms / self.count, 2) if self.count else 0.0,
+                "p50_ms": pct(0.5), "p95_ms": pct(0.95), "max_ms": round(self.max_ms, 2)}
+
+
+class Neo4jClient:
+    """Async Neo4j access on the native AsyncGraphDatabase driver.
+
+    Sessions come from the driver's bounded connection pool, every query runs with
+    a server-side timeout, and latencies are recorded per query name.
+    """
+
+    def __init__(self, uri: str, auth: Tuple[str, str], database: str = "neo4j",
+                 max_pool_size: int = 50, connection_timeout: float = 10.0,
+                 acquisition_timeout: float = 30.0, query_timeout: float = 15.0,
+                 max_connection_lifetime: int = 3600):
+        self.database = database
+        self.query_timeout = query_timeout
+        self.max_pool_size = max_pool_size
+        self.driver = AsyncGraphDatabase.driver(
+            uri, auth=auth,
+            max_connection_pool_size=max_pool_size,
+            connection_timeout=connection_timeout,
+            connection_acquisition_timeout=acquisition_timeout,
+            max_connection_lifetime=max_connection_lifetime,
+            keep_alive=True)
+        self._metrics: Dict[str, _QueryMetrics] = {}
+
+    async def verify_connectivity(self):
+        await self.driver.verify_connectivity()
+
+    async def close(self):
+        await self.driver.close()
+
+    async def run(self, query: str, parameters: Optional[Dict[str, Any]] = None, name: str = "query",
+                  mapper: Optional[Callable[[Dict[str, Any]], T]] = None, timeout: Optional[float] = None,
+                  write: bool = False) -> List[Any]:
+        """Run a query in an auto-commit transaction and return records as dicts (or `mapper` results)."""
+        start = time.perf_counter()
+        failed = False
+        try:
+            async with self.driver.session(database=self.database,
+                                           default_access_mode=WRITE_ACCESS if write else READ_ACCESS) as session:
+                result = await session.run(Query(query, timeout=timeout or self.query_timeout), parameters or {})
+                records = await result.data()
+        except neo4j_exceptions.ServiceUnavailable as e:
+            failed = True
+            logger.error(f"Neo4j Unavailable ({name}): {e}")
+            raise
+        except neo4j_exceptions.Neo4jError as e:
+            failed = True
+            logger.error(f"Neo4j Query Error ({name}): {e}")
+            raise
+        except Exception as e:
+            failed = True
+            logger.error(f"Unexpected Neo4j query error ({name}): {e}", exc_info=True)
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000.0
+            self._metrics.setdefault(name, _QueryMetrics()).observe(elapsed_ms, failed)
+            logger.debug(f"Neo4j '{name}' took {elapsed_ms:.1f} ms")
+        return [mapper(r) for r in records] if mapper else records
+
+    async def single(self, query: str, parameters: Optional[Dict[str, Any]] = None, name: str = "query",
+                     mapper: Optional[Callable[[Dict[str, Any]], T]] = None,
+                     timeout: Optional[float] = None) -> Optional[Any]:
+        records = await self.run(query, parameters, name=name, mapper=mapper, timeout=timeout)
+        return records[0] if records else None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"database": self.database, "max_pool_size": self.max_pool_size,
+                "query_timeout": self.query_timeout,
+                "queries": {name: m.summary() for name, m in sorted(self._metrics.items())}}
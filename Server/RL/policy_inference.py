@@ -0,0 +1,143 @@
+import time
+import copy
+import logging
+from typing import Dict, Optional, Any
+
+import numpy as np
+import torch as th
+from torch import nn
+
+from ncert_tutor import select_actions_from_logits
+
+logger = logging.getLogger("policy_inference")
+
+POLICY_BACKENDS = ("torchscript", "compile")
+FP32_LOGIT_ATOL = 1e-4
+BF16_LOGIT_ATOL = 5e-2
+BF16_MIN_ACTION_AGREEMENT = 0.98
+
+
+def cpu_supports_bf16() -> bool:
+    """True when the CPU has native bfloat16 support (AVX512-BF16 or AMX)."""
+    for probe in ("_is_avx512_bf16_supported", "_is_amx_tile_supported"):
+        check = getattr(th.cpu, probe, None)
+        try:
+            if check is not None and check():
+                return True
+        except Exception:
+            continue
+    return False
+
+
+def compile_policy_for_training(policy: nn.Module) -> nn.Module:
+    """Wrap the policy MLP forwards in torch.compile; parameters and state_dict keys stay untouched."""
+    extractor = policy.mlp_extractor
+    for name in ("forward", "forward_actor", "forward_critic"):
+        setattr(extractor, name, th.compile(getattr(extractor, name)))
+    return policy
+
+
+def _distribution_logits(distribution) -> th.Tensor:
+    # SB3 MultiCategorical keeps `.distribution`; sb3-contrib's maskable one keeps `.distributions`.
+    parts = getattr(distribution, "distribution", None) or distribution.distributions
+    return th.cat([d.logits for d in parts], dim=1)
+
+
+def _segment_log_softmax(logits: np.ndarray, action_nvec: np.ndarray) -> np.ndarray:
+    out = np.empty_like(logits, dtype=np.float64)
+    offset = 0
+    for n in action_nvec:
+        segment = logits[:, offset:offset + int(n)].astype(np.float64)
+        segment = segment - segment.max(axis=1, keepdims=True)
+        out[:, offset:offset + int(n)] = segment - np.log(np.exp(segment).sum(axis=1, keepdims=True))
+        offset += int(n)
+    return out
+
+
+class _ActorHead(nn.Module):
+    """Observation -> flat action logits (features extractor, policy MLP, action head)."""
+
+    def __init__(self, policy):
+        super().__init__()
+        self.features_extractor = policy.pi_features_extractor
+        self.policy_net = policy.mlp_extractor.policy_net
+        self.action_net = policy.action_net
+
+    def forward(self, obs: th.Tensor) -> th.Tensor:
+        return self.action_net(self.policy_net(self.features_extractor(obs)))
+
+
+class CompiledPolicy:
+    """Inference-only actor path compiled with TorchScript or torch.compile, optionally in bfloat16."""
+
+    def __init__(self, policy, action_nvec: np.ndarray, example_obs: np.ndarray,
+                 backend: str = "torchscript", use_bf16: bool = False):
+        if backend not in POLICY_BACKENDS:
+            raise ValueError(f"Unknown policy backend '{backend}'. Use one of {POLICY_BACKENDS}.")
+        if use_bf16 and not cpu_supports_bf16():
+            logger.warning("bfloat16 requested but the CPU lacks native support; using float32.")
+            use_bf16 = False
+        self.eager_policy = policy
+        self.action_nvec = np.asarray(action_nvec)
+        self.backend = backend
+        self.dtype = th.bfloat16 if use_bf16 else th.float32
+
+        # A private copy keeps bf16 casts away from the training weights.
+        head = copy.deepcopy(_ActorHead(policy)).to("cpu", dtype=self.dtype).eval()
+        for param in head.parameters():
+            param.requires_grad_(False)
+        example = self._to_tensor(np.atleast_2d(example_obs))
+        with th.inference_mode():
+            if backend == "torchscript":
+                self.module = th.jit.optimize_for_inference(th.jit.trace(head, example))
+            else:
+                self.module = th.compile(head, dynamic=True)
+            self.module(example)
+
+    def _to_tensor(self, observations: np.ndarray) -> th.Tensor:
+        return th.as_tensor(np.asarray(observations, dtype=np.float32)).to(self.dtype)
+
+    def logits(self, observations: np.ndarray) -> np.ndarray:
+        with th.inference_mode():
+            return self.module(self._to_tensor(np.atleast_2d(observations))).float().numpy()
+
+    def eager_logits(self, observations: np.ndarray) -> np.ndarray:
+        obs_tensor, _ = self.eager_policy.obs_to_tensor(np.atleast_2d(observations))
+        with th.no_grad():
+            return _distribution_logits(self.eager_policy.get_distribution(obs_tensor)).cpu().numpy()
+
+    def predict(self, observation: np.ndarray, action_mask: Optional[np.ndarray] = None, deterministic: bool = True):
+        vectorized = np.asarray(observation).ndim > 1
+        actions = select_actions_from_logits(
+            self.logits(observation), self.action_nvec, action_mask, deterministic)
+        return (actions if vectorized else actions[0]), None
+
+    def verify(self, observations: np.ndarray) -> Dict[str, Any]:
+        """Compare per-dimension log-probabilities and greedy actions with the eager policy."""
+        compiled = _segment_log_softmax(self.logits(observations), self.action_nvec)
+        eager = _segment_log_softmax(self.eager_logits(observations), self.action_nvec)
+        max_abs_diff = float(np.max(np.abs(compiled - eager)))
+        agreement = float(np.mean(
+            select_actions_from_logits(compiled, self.action_nvec) ==
+            select_actions_from_logits(eager, self.action_nvec)))
+        if self.dtype == th.bfloat16:
+            passed = max_abs_diff <= BF16_LOGIT_ATOL and agreement >= BF16_MIN_ACTION_AGREEMENT
+        else:
+            passed = max_abs_diff <= FP32_LOGIT_ATOL and agreement == 1.0
+        return {"passed": passed, "max_abs_logprob_diff": max_abs_diff, "action_agreement": agreement}
+
+    def benchmark(self, observations: np.ndarray, iterations: int = 200) -> Dict[str, float]:
+        """Mean single-observation latency of the eager and compiled actor paths."""
+        samples = [np.atleast_2d(o) for o in observations[:iterations]] or [np.atleast_2d(observations[0])]
+
+        def _time(fn):
+            fn(samples[0])
+            start = time.perf_counter()
+            for i in range(iterations):
+                fn(samples[i % len(samples)])
+            return (time.perf_counter() - start) / iterations * 1000.0
+
+        eager_ms = _time(self.eager_logits)
+        compiled_ms = _time(self.logits)
+        return {"eager_ms": eager_ms, "compiled_ms": compiled_ms,
+                "speedup": eager_ms / compiled_ms if compiled_ms > 0 else float("inf")}
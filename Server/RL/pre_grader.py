@@ -0,0 +1,175 @@
+import re
+import asyncio
+import logging
+from collections import Counter
+from difflib import SequenceMatcher
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Set
+
+import numpy as np
+
+logger = logging.getLogger("pre_grader")
+
+STOPWORDS = frozenset("""
+a an the and or but if of to in on at by for with from as is are was were be been being it its this that
+these those there their they them he she his her we our you your i me my so than then which who whom what
+when where why how do does did can could should would will shall may might must also very into
+about over under between because while such each other more most some any all only just
+""".split())
+
+# Kept as content words: "is not a conductor" must never match "is a conductor".
+NEGATIONS = frozenset("""
+not no never none nothing neither nor cannot cant dont doesnt didnt isnt arent wasnt werent wont
+wouldnt shouldnt couldnt hasnt havent hadnt without
+""".split())
+
+EMPTY_ANSWERS = frozenset({"", "idk", "i dont know", "i do not know", "dont know", "no idea", "not sure",
+                           "na", "n a", "none", "nothing", "pass", "skip"})
+
+_NON_WORD = re.compile(r"[^a-z0-9\s]+")
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+
+def normalize_answer(text: Any) -> str:
+    text = _NON_WORD.sub(" ", str(text or "").lower().replace("'", ""))
+    return " ".join(text.split())
+
+
+def _stem(token: str) -> str:
+    for suffix in ("ies", "es", "s"):
+        if len(token) > len(suffix) + 2 and token.endswith(suffix):
+            return token[:-len(suffix)] + ("y" if suffix == "ies" else "")
+    return token
+
+
+def content_tokens(text: Any) -> List[str]:
+    return [_stem(t) for t in normalize_answer(text).split() if t not in STOPWORDS and (len(t) > 1 or t.isdigit())]
+
+
+def answer_tokens(text: Any) -> Set[str]:
+    return set(content_tokens(text))
+
+
+def ordered_match(response: str, reference: str) -> float:
+    """Similarity of the content-word sequences, so "absorbs X, releases Y" does not match "absorbs Y, releases X"."""
+    response_tokens, reference_tokens = content_tokens(response), content_tokens(reference)
+    if not response_tokens or not reference_tokens:
+        return 0.0
+    return SequenceMatcher(None, response_tokens, reference_tokens, autojunk=False).ratio()
+
+
+def negated(text: str) -> bool:
+    """Whether a normalized answer is negated (an odd number of negation words)."""
+    return sum(t in NEGATIONS for t in text.split()) % 2 == 1
+
+
+def rubric_keywords(explanation: str, limit: int = 8) -> List[str]:
+    """Most frequent content words of the question's explanation, used as a lightweight rubric."""
+    counts = Counter(_stem(t) for t in normalize_answer(explanation).split()
+                     if t not in STOPWORDS and len(t) >= 4)
+    return [word for word, _ in counts.most_common(limit)]
+
+
+def lexical_score(response: str, reference: str, keywords: List[str]) -> float:
+    """Token-set F1 against the reference answer, blended with rubric keyword coverage."""
+    response_tokens, reference_tokens = answer_tokens(response), answer_tokens(reference)
+    if not response_tokens or not reference_tokens:
+        return 0.0
+    overlap = len(response_tokens & reference_tokens)
+    if not overlap:
+        f1 = 0.0
+    else:
+        precision, recall = overlap / len(response_tokens), overlap / len(reference_tokens)
+        f1 = 2 * precision * recall / (precision + recall)
+    if not keywords:
+        return f1
+    coverage = sum(k in response_tokens for k in keywords) / len(keywords)
+    return 0.8 * f1 + 0.2 * coverage
+
+
+class PreGrade(NamedTuple):
+    tier: str
+    correct: bool
+    score: float
+    confidence: float
+
+
+class PreGrader:
+    """Cheap tiers tried before LLM grading of an open-ended answer.
+
+    Tiers run in order: empty/exact match, a lexical tier that only accepts
+    near-exact answers (every reference content word present, in nearly the same
+    order), then embedding cosine against the reference, which only rejects.
+    Overlap and similarity cannot tell swapped terms or antonyms ("east"/"west")
+    from a correct answer, so anything that is not clearly right or clearly
+    unrelated returns None and the caller asks the LLM.
+    """
+
+    def __init__(self, embed: Optional[Callable[[str], Awaitable[Optional[List[float]]]]] = None,
+                 lexical_accept: float = 0.85, embedding_reject: float = 0.55, enabled: bool = True):
+        self.embed = embed
+        self.lexical_accept = lexical_accept
+        self.embedding_reject = embedding_reject
+        self.enabled = enabled
+        self.decided: Counter = Counter()
+        self.inconclusive = 0
+        self.embedding_errors = 0
+
+    async def _cosine(self, response: str, reference: str) -> Optional[float]:
+        if self.embed is None:
+            return None
+        try:
+            # Issued together so the embedding service can batch them into one call.
+            a, b = await asyncio.gather(self.embed(response), self.embed(reference))
+        except Exception as e:
+            self.embedding_errors += 1
+            logger.warning(f"Pre-grader embedding failed: {e}")
+            return None
+        if a is None or b is None:
+            return None
+        a, b = np.asarray(a, dtype=np.float32), np.asarray(b, dtype=np.float32)
+        denom = float(np.linalg.norm(a) * np.linalg.norm(b))
+        return float(a @ b) / denom if denom else None
+
+    def _decide(self, tier: str, correct: bool, score: float, confidence: float) -> PreGrade:
+        self.decided[tier] += 1
+        return PreGrade(tier, correct, score, round(confidence, 4))
+
+    async def grade(self, student_response: str, correct_answer: str, explanation: str = "") -> Optional[PreGrade]:
+        if not self.enabled:
+            return None
+        response, reference = normalize_answer(student_response), normalize_answer(correct_answer)
+        # Exact match first: "Na" (sodium) or "none" can be the right answer.
+        if reference and response == reference:
+            return self._decide("exact", True, 100, 1.0)
+        if response in EMPTY_ANSWERS:
+            return self._decide("empty", False, 0, 1.0)
+        if not reference:
+            self.inconclusive += 1
+            return None
+
+        # Overlap and embeddings barely separate "24" from "42" or "is" from "is not", so numbers in the
+        # reference must appear verbatim and both answers must agree in negation before accepting.
+        can_accept = (set(_NUMBER.findall(reference)) <= set(_NUMBER.findall(response))
+                      and negated(response) == negated(reference)
+                      and answer_tokens(reference) <= answer_tokens(response))
+        if can_accept:
+            ordered = ordered_match(response, reference)
+            if ordered >= self.lexical_accept:
+                return self._decide("lexical", True, 90, ordered)
+
+        lexical = lexical_score(response, reference, rubric_keywords(explanation))
+        if lexical == 0.0:
+            cosine = await self._cosine(response, reference)
+            if cosine is not None and cosine <= self.embedding_reject:
+                return self._decide("embedding", False, 0, 1.0 - cosine)
+
+        self.inconclusive += 1
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        avoided = sum(self.decided.values())
+        total = avoided + self.inconclusive
+        return {"enabled": self.enabled, "llm_calls_avoided": avoided, "sent_to_llm": self.inconclusive,
+                "avoided_rate": round(avoided / total, 4) if total else 0.0,
+                "by_tier": dict(self.decided), "embedding_errors": self.embedding_errors,
+                "bands": {"lexical_accept": self.lexical_accept, "embedding_reject": self.embedding_reject}}
@@ -0,0 +1,227 @@
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger("question_bank")
+
+DEFAULT_QUESTION_TYPES = ("multiple_choice", "short_answer", "true_false")
+
+RefillKey = Tuple[str, int, Tuple[str, ...]]
+
+
+def difficulty_band(difficulty: float, bands: int) -> int:
+    """Bucket a 0-1 difficulty into one of `bands` equal-width bands."""
+    return min(bands - 1, max(0, int(float(difficulty) * bands)))
+
+
+def band_midpoint(band: int, bands: int) -> float:
+    return round((band + 0.5) / bands, 3)
+
+
+def question_content_hash(question: Dict[str, Any]) -> str:
+    """Hash of the parts a student sees, so regenerated duplicates are stored once."""
+    content = {
+        "type": question.get("exercise_type", ""),
+        "question": " ".join(str(question.get("question", "")).split()).lower(),
+        "options": question.get("options") or [],
+        "correct_answer": str(question.get("correct_answer", "")).strip().lower(),
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+# Matches bank entries no student has been served yet (entries banked before servings were counted have no field).
+UNSERVED = {"served_count": {"$in": [None, 0]}}
+
+
+class QuestionBank:
+    """Pre-generated assessment questions in Mongo, keyed by (topic, difficulty band, question type).
+
+    Questions are sampled without replacement per student, using a separate
+    (user_id, question_id) servings collection. A background worker tops a key up
+    through `ExerciseGenerator.generate_multiple_exercises` when its unserved
+    stock runs low. Each key is checked at most once per `refill_cooldown`, and
+    four times less often after a refill that produced only duplicates.
+    """
+
+    def __init__(self, collection, generator, servings=None, bands: int = 5, min_stock: int = 20,
+                 refill_batch_size: int = 5, workers: int = 1, refill_cooldown: float = 300.0):
+        self.collection = collection
+        self.servings = servings if servings is not None else collection.database["question_servings"]
+        self.generator = generator
+        self.refill_cooldown = max(0.0, refill_cooldown)
+        self.bands = max(1, bands)
+        self.min_stock = max(0, min_stock)
+        self.refill_batch_size = max(1, refill_batch_size)
+        self._queue: "asyncio.Queue[RefillKey]" = asyncio.Queue()
+        self._queued: Set[RefillKey] = set()
+        self._next_check: Dict[RefillKey, float] = {}
+        self._workers: List[asyncio.Task] = []
+        self._pending_adds: Set[asyncio.Task] = set()
+        self.worker_count = max(1, workers)
+        self.served = 0
+        self.shortfalls = 0
+        self.refills = 0
+        self.stock_checks = 0
+        self.generated = 0
+        self.duplicates = 0
+        self.errors = 0
+
+    async def ensure_indexes(self):
+        await self.collection.create_index(
+            [("topic", ASCENDING), ("band", ASCENDING), ("question_type", ASCENDING),
+             ("content_hash", ASCENDING)], unique=True, name="bank_key_hash")
+        await self.collection.create_index(
+            [("topic", ASCENDING), ("band", ASCENDING), ("question_type", ASCENDING),
+             ("served_count", ASCENDING)], name="bank_served_count")
+        await self.servings.create_index(
+            [("user_id", ASCENDING), ("question_id", ASCENDING)], unique=True, name="serving_user_question")
+        await self.servings.create_index(
+            [("user_id", ASCENDING), ("topic", ASCENDING), ("band", ASCENDING)], name="serving_user_key")
+
+    def start(self):
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, *self._pending_adds, return_exceptions=True)
+        self._workers = []
+
+    def _filter(self, topic: str, band: int, question_types: Sequence[str]) -> Dict[str, Any]:
+        return {"topic": topic, "band": band, "question_type": {"$in": list(question_types)}}
+
+    async def draw(self, user_id: str, topic: str, difficulty: float, count: int,
+                   question_types: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
+        """Sample up to `count` questions this student has not been served; may return fewer."""
+        question_types = tuple(sorted(question_types or DEFAULT_QUESTION_TYPES))
+        band = difficulty_band(difficulty, self.bands)
+        questions = []
+        try:
+            seen = await self.servings.distinct("question_id", {"user_id": user_id, "topic": topic, "band": band})
+            match = self._filter(topic, band, question_types)
+            if seen:
+                match["_id"] = {"$nin": seen}
+            docs = await self.collection.aggregate([
+                {"$match": match}, {"$sample": {"size": count}},
+                {"$project": {"question": 1}}]).to_list(length=count)
+            if docs:
+                await self._record_servings(user_id, topic, band, [d["_id"] for d in docs])
+            questions = [d["question"] for d in docs]
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Question bank draw failed for '{topic}' (band {band}): {e}", exc_info=True)
+        self.served += len(questions)
+        if len(questions) < count:
+            self.shortfalls += 1
+        self._request_check((topic, band, question_types))
+        return questions
+
+    async def _record_servings(self, user_id: str, topic: str, band: int, question_ids: List[Any]):
+        now = datetime.now(timezone.utc)
+        result = await self.servings.bulk_write([
+            UpdateOne({"user_id": user_id, "question_id": qid},
+                      {"$setOnInsert": {"user_id": user_id, "question_id": qid, "topic": topic,
+                                        "band": band, "served_at": now}}, upsert=True)
+            for qid in question_ids], ordered=False)
+        # Only servings new to this student count, so a replayed draw does not inflate served_count.
+        fresh = [question_ids[i] for i in result.upserted_ids]
+        if fresh:
+            await self.collection.update_many({"_id": {"$in": fresh}}, {"$inc": {"served_count": 1}})
+
+    def _request_check(self, key: RefillKey):
+        """Queue a stock check for `key` unless one is queued or it was checked within the cooldown."""
+        if key in self._queued or time.monotonic() < self._next_check.get(key, 0.0):
+            return
+        self._queued.add(key)
+        self._queue.put_nowait(key)
+
+    async def add(self, topic: str, difficulty: float, questions: List[Dict[str, Any]],
+                  served_to: Sequence[str] = ()) -> int:
+        """Store generated questions, skipping fallbacks and content already in the bank."""
+        band = difficulty_band(difficulty, self.bands)
+        now = datetime.now(timezone.utc)
+        ops, hashes = [], []
+        for question in questions:
+            if question.get("source") == "fallback" or not question.get("question"):
+                continue
+            key = {"topic": topic, "band": band, "question_type": question.get("exercise_type", "short_answer"),
+                   "content_hash": question_content_hash(question)}
+            hashes.append(key["content_hash"])
+            ops.append(UpdateOne(key, {"$setOnInsert": {
+                **key, "question": question, "created_at": now, "served_count": 0}}, upsert=True))
+        if not ops:
+            return 0
+        try:
+            result = await self.collection.bulk_write(ops, ordered=False)
+            inserted = result.upserted_count
+        except BulkWriteError as e:
+            inserted = e.details.get("nUpserted", 0)
+            logger.warning(f"Question bank insert for '{topic}' partially failed: {e.details.get('writeErrors', [])[:1]}")
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Question bank insert for '{topic}' failed: {e}", exc_info=True)
+            return 0
+        self.generated += inserted
+        self.duplicates += len(ops) - inserted
+        if served_to:
+            try:
+                docs = await self.collection.find(
+                    {"topic": topic, "band": band, "content_hash": {"$in": hashes}}, {"_id": 1}).to_list(length=len(hashes))
+                for user_id in served_to:
+                    await self._record_servings(user_id, topic, band, [d["_id"] for d in docs])
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Recording servings of banked questions for '{topic}' failed: {e}", exc_info=True)
+        return inserted
+
+    def add_later(self, topic: str, difficulty: float, questions: List[Dict[str, Any]],
+                  served_to: Sequence[str] = ()):
+        """Bank live-generated questions without delaying the response."""
+        task = asyncio.create_task(self.add(topic, difficulty, questions, served_to))
+        self._pending_adds.add(task)
+        task.add_done_callback(self._pending_adds.discard)
+
+    async def _worker(self):
+        while True:
+            key = await self._queue.get()
+            topic, band, question_types = key
+            inserted = None
+            try:
+                self.stock_checks += 1
+                match = self._filter(topic, band, question_types)
+                match.update(UNSERVED)
+                stock = await self.collection.count_documents(match, limit=self.min_stock)
+                if stock < self.min_stock:
+                    questions = await self.generator.generate_multiple_exercises(
+                        topic=topic, difficulty=band_midpoint(band, self.bands),
+                        question_count=self.refill_batch_size, question_types=list(question_types),
+                        use_cache=False)
+                    inserted = await self.add(topic, band_midpoint(band, self.bands), questions)
+                    self.refills += 1
+                    logger.info(f"Question bank refill for '{topic}' (band {band}): {inserted} new questions.")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Question bank refill failed for '{topic}' (band {band}): {e}", exc_info=True)
+            finally:
+                # A refill that only produced duplicates backs off longer, so a saturated key stops costing LLM calls.
+                backoff = self.refill_cooldown * (4 if inserted == 0 else 1)
+                self._next_check[key] = time.monotonic() + backoff
+                self._queued.discard(key)
+                self._queue.task_done()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"bands": self.bands, "min_stock": self.min_stock, "served": self.served,
+                "shortfalls": self.shortfalls, "stock_checks": self.stock_checks, "refills": self.refills,
+                "generated": self.generated, "refill_cooldown": self.refill_cooldown,
+                "duplicates": self.duplicates, "errors": self.errors,
+                "refill_queue": self._queue.qsize(), "workers": len(self._workers)}
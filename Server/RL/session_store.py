@@ -0,0 +1,371 @@
+import asyncio
+import logging
+import weakref
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from uuid import uuid4
+
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from caching import LRUCache
+
+logger = logging.getLogger("session_store")
+
+# Bumped by every session write; a delta is only applied on top of the version it was computed from.
+VERSION_FIELD = "version"
+# Stamped by the guarded update so the follow-up $push only runs when that update matched.
+WRITE_ID_FIELD = "write_id"
+
+
+class SessionConflict(Exception):
+    """Another worker wrote the session document after the version a write was based on."""
+
+
+def version_guard(version: int) -> Dict[str, Any]:
+    # Documents saved before versioning have no version field.
+    return {VERSION_FIELD: version} if version else {VERSION_FIELD: {"$in": [None, 0]}}
+
+
+def session_update_ops(student_id: str, delta, version: Optional[int] = None) -> List[UpdateOne]:
+    """Mongo updates for a session delta: field/entry edits first, then appended path entries.
+
+    With `version` the edits only match that document version; `None` applies them unconditionally.
+    """
+    write_id = uuid4().hex
+    key = {"student_id": student_id}
+    sets = dict(delta.sets)
+    sets[WRITE_ID_FIELD] = write_id
+    array_filters = []
+    for i, (interaction_id, entry) in enumerate(delta.entry_updates):
+        sets[f"learning_path.$[e{i}]"] = entry
+        array_filters.append({f"e{i}.interaction_id": interaction_id})
+    if delta.full_path is not None:
+        sets["learning_path"] = delta.full_path
+    update: Dict[str, Any] = {"$set": sets, "$inc": {VERSION_FIELD: 1}}
+    if delta.unsets:
+        update["$unset"] = delta.unsets
+    guarded = dict(key, **version_guard(version)) if version is not None else key
+    ops = [UpdateOne(guarded, update, array_filters=array_filters or None)]
+    if delta.new_entries or delta.trimmed:
+        # A path can't be $set and $pushed in one update, so appends go in a second op.
+        ops.append(UpdateOne(dict(key, **{WRITE_ID_FIELD: write_id}), {"$push": {"learning_path": {
+            "$each": delta.new_entries, "$slice": -delta.path_length}}}))
+    return ops
+
+
+class SessionStore:
+    """App-scoped cache of validated student sessions with per-user locks and write-behind saves.
+
+    Handlers change a session with `update(student_id, mutate)`, which runs the
+    mutation under the student's lock and marks the session dirty. One delayed flush
+    then writes the accumulated delta, so several updates within `flush_delay` cost a
+    single Mongo write. Writes are versioned. When another worker changed the
+    document first, it is reloaded and the pending mutations are re-run on it, so
+    `update` uses cached copies without reading Mongo. Read-only callers use
+    `cached_current`, which re-checks the stored version at most every
+    `version_check_ttl` seconds.
+    """
+
+    def __init__(self, collection, session_cls, max_entries: int = 2048, ttl_seconds: float = 300.0,
+                 flush_delay: float = 2.0, insert_fields: Optional[Dict[str, Any]] = None,
+                 max_replays: int = 3, prepare: Optional[Callable[[Dict[str, Any]], Awaitable[Any]]] = None,
+                 version_check_ttl: float = 5.0):
+        self.collection = collection
+        self.session_cls = session_cls
+        # Awaited with each loaded document before it is validated.
+        self.prepare = prepare
+        self.flush_delay = flush_delay
+        self.max_replays = max(0, max_replays)
+        self.insert_fields = dict(insert_fields or {})
+        self._cache = LRUCache(max_entries, ttl_seconds or None, name="sessions")
+        # Students whose cached copy matched the stored version within the last `version_check_ttl` seconds.
+        self._checked = LRUCache(max_entries, version_check_ttl, name="session_versions")
+        self.version_check_ttl = version_check_ttl
+        # Dirty sessions live here until flushed, so LRU eviction never drops unsaved changes.
+        self._dirty: Dict[str, Any] = {}
+        self._flushes: Dict[str, asyncio.Task] = {}
+        # Mutations applied since the last successful write, re-run on a reloaded copy after a conflict.
+        self._mutations: Dict[str, List[Callable[[Any], Awaitable[Any]]]] = {}
+        self._locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+        self.loads = 0
+        self.partial_loads = 0
+        self.version_checks = 0
+        self.stale = 0
+        self.replays = 0
+        self.dropped = 0
+        self.writes = 0
+        self.coalesced = 0
+        self.conflicts = 0
+        self.flush_errors = 0
+
+    def lock(self, student_id: str) -> asyncio.Lock:
+        lock = self._locks.get(student_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[student_id] = lock
+        return lock
+
+    def cached(self, student_id: str):
+        """The in-process copy of a session, or None; never reads Mongo."""
+        session = self._dirty.get(student_id)
+        return session if session is not None else self._cache.get(student_id)
+
+    async def _stored_version(self, student_id: str) -> Optional[int]:
+        doc = await self.collection.find_one({"student_id": student_id}, {"_id": 0, VERSION_FIELD: 1})
+        return None if doc is None else doc.get(VERSION_FIELD) or 0
+
+    async def cached_current(self, student_id: str):
+        """The in-process copy for read-only use, or None when another worker has written a newer version.
+
+        The version is re-read (a small projected read) at most once per `version_check_ttl`.
+        """
+        session = self.cached(student_id)
+        if session is None or self._checked.get(student_id) == session.persisted_version:
+            return session
+        self.version_checks += 1
+        if await self._stored_version(student_id) != session.persisted_version:
+            self.stale += 1
+            return None
+        self._confirm(student_id, session.persisted_version)
+        return session
+
+    def _confirm(self, student_id: str, version: int):
+        # A TTL of 0 means every read-only hit is checked.
+        if self.version_check_ttl > 0:
+            self._checked.set(student_id, version)
+
+    async def get(self, student_id: str):
+        async with self.lock(student_id):
+            return await self._current(student_id)
+
+    async def _current(self, student_id: str):
+        # Caller holds the student's lock. A stale copy is fine: its write conflicts and re-runs on a reload.
+        session = self.cached(student_id)
+        return session if session is not None else await self._load(student_id)
+
+    async def _load(self, student_id: str, cache: bool = True):
+        data = await self.collection.find_one({"student_id": student_id})
+        self.loads += 1
+        if not data:
+            return None
+        data.pop("_id", None)
+        if self.prepare is not None:
+            await self.prepare(data)
+        session = self.session_cls.model_validate(data)
+        session.mark_persisted(data.get("learning_path") or [], version=data.get(VERSION_FIELD) or 0)
+        if cache:
+            self._cache.set(student_id, session)
+            self._confirm(student_id, session.persisted_version)
+        return session
+
+    async def update(self, student_id: str, mutate: Callable[[Any], Awaitable[Any]],
+                     create: Optional[Callable[[], Any]] = None) -> Tuple[Any, Any]:
+        """Load, mutate and save a session under its lock; returns (session, mutate's result).
+
+        `mutate` is kept until its change is written, and is re-run on a reloaded copy
+        if another worker wrote first; that copy and its result are then returned. With
+        `create`, a missing session starts from `create()`; otherwise (None, None) is returned.
+        """
+        async with self.lock(student_id):
+            session = await self._current(student_id)
+            if session is None:
+                if create is None:
+                    return None, None
+                session = create()
+            try:
+                result = await mutate(session)
+            except Exception:
+                await self._discard_failed(student_id)
+                raise
+            self._mutations.setdefault(student_id, []).append(mutate)
+            written, rerun_result = await self._save(session)
+        if written is not None and written is not session:
+            session, result = written, rerun_result
+        return session, result
+
+    async def _discard_failed(self, student_id: str):
+        """Drop a session a mutation failed part-way through; unwritten earlier mutations are re-run on a reload."""
+        self._cache.pop(student_id)
+        if self._dirty.pop(student_id, None) is None:
+            return
+        mutations = self._mutations.get(student_id)
+        try:
+            fresh = await self._load(student_id, cache=False) if mutations else None
+            if fresh is not None:
+                for mutate in mutations:
+                    await mutate(fresh)
+        except Exception as e:
+            logger.error(f"Re-running updates of session {student_id} failed: {e}", exc_info=True)
+            fresh = None
+        if fresh is None:
+            self.dropped += 1
+            self._mutations.pop(student_id, None)
+            return
+        self._cache.set(student_id, fresh)
+        self._dirty[student_id] = fresh
+        self._schedule(student_id)
+
+    async def find_fields(self, student_id: str, fields: Iterable[str],
+                          path_tail: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """Projected read of selected top-level session fields, without validation or caching.
+
+        With `path_tail`, only the last `path_tail` learning_path entries are fetched.
+        """
+        projection: Dict[str, Any] = {"_id": 0, "student_id": 1}
+        for field in fields:
+            projection[field] = 1
+        if "learning_path" in projection and path_tail is not None:
+            if path_tail > 0:
+                projection["learning_path"] = {"$slice": -path_tail}
+            else:
+                del projection["learning_path"]
+        self.partial_loads += 1
+        return await self.collection.find_one({"student_id": student_id}, projection)
+
+    async def save(self, session):
+        """Save changes made outside `update`; they cannot be re-run, so a conflicting write drops them."""
+        async with self.lock(session.student_id):
+            await self._save(session)
+
+    async def _save(self, session) -> Tuple[Any, Any]:
+        student_id = session.student_id
+        self._cache.set(student_id, session)
+        if self.flush_delay <= 0 or not session.is_tracked:
+            # New sessions are written at once so other workers can find them.
+            self._dirty.pop(student_id, None)
+            try:
+                return await self._write_replaying(session)
+            except Exception:
+                # The caller sees the failure, so its changes are not re-run by a later write.
+                self._mutations.pop(student_id, None)
+                self._cache.pop(student_id)
+                raise
+        if student_id in self._dirty:
+            self.coalesced += 1
+        self._dirty[student_id] = session
+        self._schedule(student_id)
+        return session, None
+
+    def _schedule(self, student_id: str):
+        if student_id not in self._flushes:
+            self._flushes[student_id] = asyncio.create_task(self._flush_later(student_id))
+
+    async def _flush_later(self, student_id: str):
+        await asyncio.sleep(self.flush_delay)
+        # Cleared before flushing so saves arriving meanwhile schedule their own flush.
+        self._flushes.pop(student_id, None)
+        await self.flush(student_id)
+
+    async def flush(self, student_id: str) -> bool:
+        async with self.lock(student_id):
+            return await self._flush_locked(student_id)
+
+    async def _flush_locked(self, student_id: str) -> bool:
+        session = self._dirty.pop(student_id, None)
+        if session is None:
+            return True
+        try:
+            await self._write_replaying(session)
+            return True
+        except Exception as e:
+            self.flush_errors += 1
+            logger.error(f"Error flushing session {student_id}: {e}", exc_info=True)
+            # Its mutations are still pending, so a later conflict re-runs them all.
+            self._dirty.setdefault(student_id, session)
+            self._schedule(student_id)
+            return False
+
+    async def _write_replaying(self, session) -> Tuple[Any, Any]:
+        """Write the session; on a conflict, reload it and re-run the pending mutations, then try again.
+
+        Returns the session written and the last re-run mutation's result (None if nothing
+        was re-run), or (None, None) when the changes were dropped.
+        """
+        student_id = session.student_id
+        result = None
+        for _ in range(self.max_replays + 1):
+            try:
+                await self._write(session)
+            except SessionConflict:
+                self.conflicts += 1
+                mutations = self._mutations.get(student_id)
+                fresh = await self._load(student_id, cache=False) if mutations else None
+                if fresh is None:
+                    self.dropped += 1
+                    logger.warning(f"Session {student_id} changed in another worker; dropping changes "
+                                   f"that cannot be re-run.")
+                    self._mutations.pop(student_id, None)
+                    self._cache.pop(student_id)
+                    return None, None
+                logger.info(f"Session {student_id} changed in another worker; re-running {len(mutations)} updates.")
+                try:
+                    for mutate in mutations:
+                        result = await mutate(fresh)
+                except Exception as e:
+                    self.dropped += 1
+                    logger.error(f"Re-running updates of session {student_id} failed; dropping them: {e}",
+                                 exc_info=True)
+                    self._mutations.pop(student_id, None)
+                    self._cache.pop(student_id)
+                    return None, None
+                self.replays += 1
+                session = fresh
+                continue
+            self._mutations.pop(student_id, None)
+            self._cache.set(student_id, session)
+            self._confirm(student_id, session.persisted_version)
+            return session, result
+        raise SessionConflict(f"Session {student_id} still conflicting after {self.max_replays} re-runs")
+
+    async def _write(self, session):
+        student_id = session.student_id
+        if not session.is_tracked:
+            payload = session.persisted_document()
+            payload.pop('created_at', None)
+            try:
+                # Only creates the document or overwrites an unversioned one; anything newer is a conflict.
+                doc = await self.collection.find_one_and_update(
+                    dict({"student_id": student_id}, **version_guard(0)),
+                    {"$set": payload, "$inc": {VERSION_FIELD: 1},
+                     "$setOnInsert": {"created_at": session.created_at, **self.insert_fields}},
+                    projection={VERSION_FIELD: 1}, upsert=True, return_document=ReturnDocument.AFTER)
+            except DuplicateKeyError:
+                raise SessionConflict(f"Session {student_id} already exists") from None
+            session.mark_persisted(payload["learning_path"], version=(doc or {}).get(VERSION_FIELD, 1))
+            self.writes += 1
+            return
+
+        delta = session.persistence_delta()
+        if delta.empty:
+            return
+        version = session.persisted_version
+        result = await self.collection.bulk_write(session_update_ops(student_id, delta, version), ordered=True)
+        if not result.matched_count:
+            raise SessionConflict(f"Session {student_id} changed since version {version}")
+        session.commit_persisted(delta, version=version + 1)
+        self.writes += 1
+
+    def invalidate(self, student_id: Optional[str] = None):
+        """Drop clean cached sessions (all of them without `student_id`); dirty ones are still flushed."""
+        if student_id is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(student_id)
+
+    async def close(self):
+        """Write out every pending change; called on shutdown."""
+        for task in self._flushes.values():
+            task.cancel()
+        await asyncio.gather(*self._flushes.values(), return_exceptions=True)
+        self._flushes.clear()
+        await asyncio.gather(*(self.flush(s) for s in list(self._dirty)), return_exceptions=True)
+        for task in self._flushes.values():
+            task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"cache": self._cache.stats(), "dirty": len(self._dirty), "pending_flushes": len(self._flushes),
+                "version_checks": self.version_checks,
+                "flush_delay": self.flush_delay, "loads": self.loads, "partial_loads": self.partial_loads,
+                "stale": self.stale, "writes": self.writes, "coalesced": self.coalesced,
+                "conflicts": self.conflicts, "replays": self.replays, "dropped": self.dropped,
+                "flush_errors": self.flush_errors}
@@ -0,0 +1,236 @@
+import hashlib
+import logging
+from collections.abc import Mapping, MutableMapping
+from typing import Any, Dict, Iterator, Optional, Sequence
+
+import numpy as np
+from pydantic_core import core_schema
+
+logger = logging.getLogger("state_vectors")
+
+# Packed vectors are little-endian float32; NaN marks a topic with no value.
+VECTOR_DTYPE = np.dtype("<f4")
+
+
+class TopicLayout:
+    """Fixed topic order for packed per-topic vectors, identified by a hash of that order."""
+
+    def __init__(self, topics: Sequence[str]):
+        self.topics = tuple(topics)
+        self.index = {topic: i for i, topic in enumerate(self.topics)}
+        self.version = hashlib.sha256("\n".join(self.topics).encode("utf-8")).hexdigest()[:16]
+
+    def __len__(self) -> int:
+        return len(self.topics)
+
+    def matches(self, topic_to_idx: Dict[str, int]) -> bool:
+        return self.index == topic_to_idx
+
+
+EMPTY_LAYOUT = TopicLayout(())
+_layouts: Dict[str, TopicLayout] = {EMPTY_LAYOUT.version: EMPTY_LAYOUT}
+_current = EMPTY_LAYOUT
+# The `state_layouts` collection, set by `sync_layouts`; layouts added later by other workers are fetched from it.
+_collection = None
+
+
+def register_layout(topics: Sequence[str], make_current: bool = False) -> TopicLayout:
+    global _current
+    layout = TopicLayout(topics)
+    layout = _layouts.setdefault(layout.version, layout)
+    if make_current:
+        _current = layout
+    return layout
+
+
+def current_layout() -> TopicLayout:
+    return _current
+
+
+def get_layout(version: str) -> TopicLayout:
+    """A known layout; call `ensure_layout` first for documents other workers may have written."""
+    layout = _layouts.get(version)
+    if layout is None:
+        raise ValueError(f"Unknown topic layout '{version}'")
+    return layout
+
+
+async def ensure_layout(stored_state: Optional[Dict[str, Any]]):
+    """Make sure the layout a stored state was packed in is known, fetching it from `state_layouts` if needed.
+
+    A worker started after this one (e.g. with a retrained topic set) records its
+    layout there and may write documents in it before this process sees it.
+    """
+    packed = stored_state.get("vectors") if isinstance(stored_state, dict) else None
+    if not isinstance(packed, dict):
+        return
+    version = packed.get("layout", EMPTY_LAYOUT.version)
+    if version in _layouts or _collection is None:
+        return
+    doc = await _collection.find_one({"version": version}, {"_id": 0, "topics": 1})
+    if doc is None:
+        logger.error(f"Topic layout '{version}' is not in the layouts collection.")
+        return
+    layout = register_layout(doc.get("topics") or [])
+    if layout.version != version:
+        logger.error(f"Stored topic layout '{version}' hashes to '{layout.version}'.")
+        return
+    logger.info(f"Loaded topic layout {version} ({len(layout)} topics) written by another worker.")
+
+
+async def sync_layouts(collection, topic_to_idx: Optional[Dict[str, int]] = None) -> TopicLayout:
+    """Load every layout stored documents may use, and record the current one (from the RL env's topic map).
+
+    Layouts are kept forever: a document is only rewritten in the current layout on its next save.
+    """
+    global _collection
+    _collection = collection
+    async for doc in collection.find({}, {"_id": 0, "topics": 1}):
+        register_layout(doc.get("topics") or [])
+    if topic_to_idx:
+        register_layout(sorted(topic_to_idx, key=topic_to_idx.get), make_current=True)
+    layout = current_layout()
+    await collection.update_one({"version": layout.version},
+                                {"$setOnInsert": {"version": layout.version, "topics": list(layout.topics)}},
+                                upsert=True)
+    logger.info(f"Topic layout {layout.version} ({len(layout)} topics) current; {len(_layouts)} known.")
+    return layout
+
+
+class TopicVector(MutableMapping):
+    """Topic -> float map backed by a float32 array in a `TopicLayout`, with a dict for topics outside it.
+
+    Behaves like the `Dict[str, float]` it replaces (and serialises as one), while
+    observations read `as_array` directly and documents store the packed bytes.
+    """
+
+    def __init__(self, values: Optional[Mapping] = None, layout: Optional[TopicLayout] = None):
+        self.layout = layout or current_layout()
+        self.values = np.full(len(self.layout), np.nan, dtype=VECTOR_DTYPE)
+        self.extra: Dict[str, float] = {}
+        for topic, value in (values or {}).items():
+            self[topic] = value
+
+    @classmethod
+    def unpack(cls, layout_version: str, data: Optional[bytes], extra: Optional[Dict[str, float]] = None) -> "TopicVector":
+        vector = cls(layout=get_layout(layout_version))
+        if data:
+            values = np.frombuffer(data, dtype=VECTOR_DTYPE)
+            if len(values) != len(vector.layout):
+                raise ValueError(f"Vector of {len(values)} values does not fit layout {layout_version}")
+            vector.values = values.copy()
+        vector.extra = {str(k): float(v) for k, v in (extra or {}).items()}
+        return vector
+
+    def pack(self) -> bytes:
+        # Plain bytes are stored as BSON Binary (subtype 0) and read back as bytes, so snapshots compare equal.
+        return self.values.tobytes()
+
+    def rebase(self, layout: TopicLayout):
+        """Move the values into `layout` in place; topics it lacks go to the overflow dict."""
+        if layout is self.layout:
+            return
+        items = list(self.items())
+        self.layout = layout
+        self.values = np.full(len(layout), np.nan, dtype=VECTOR_DTYPE)
+        self.extra = {}
+        for topic, value in items:
+            self[topic] = value
+
+    def as_array(self, layout: Optional[TopicLayout] = None, fill: float = 0.0) -> np.ndarray:
+        """Values in layout order, with `fill` for topics that have none."""
+        self.rebase(layout or self.layout)
+        return np.where(np.isnan(self.values), np.float32(fill), self.values)
+
+    def __getitem__(self, topic: str) -> float:
+        i = self.layout.index.get(topic)
+        if i is None:
+            return self.extra[topic]
+        value = self.values[i]
+        if np.isnan(value):
+            raise KeyError(topic)
+        return float(value)
+
+    def __setitem__(self, topic: str, value: float):
+        i = self.layout.index.get(topic)
+        if i is None:
+            self.extra[topic] = float(value)
+        else:
+            self.values[i] = value
+
+    def __delitem__(self, topic: str):
+        i = self.layout.index.get(topic)
+        if i is None:
+            del self.extra[topic]
+        elif np.isnan(self.values[i]):
+            raise KeyError(topic)
+        else:
+            self.values[i] = np.nan
+
+    def __iter__(self) -> Iterator[str]:
+        topics = self.layout.topics
+        for i in np.flatnonzero(~np.isnan(self.values)):
+            yield topics[i]
+        yield from self.extra
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(~np.isnan(self.values))) + len(self.extra)
+
+    def __contains__(self, topic: object) -> bool:
+        i = self.layout.index.get(topic)
+        return topic in self.extra if i is None else not np.isnan(self.values[i])
+
+    def copy(self) -> "TopicVector":
+        vector = TopicVector(layout=self.layout)
+        vector.values = self.values.copy()
+        vector.extra = dict(self.extra)
+        return vector
+
+    def __deepcopy__(self, memo) -> "TopicVector":
+        return self.copy()
+
+    def __repr__(self) -> str:
+        return f"TopicVector({dict(self.items())!r})"
+
+    @classmethod
+    def __get_pydantic_core_schema__(cls, source: Any, handler: Any) -> core_schema.CoreSchema:
+        as_dict = core_schema.dict_schema(core_schema.str_schema(), core_schema.float_schema())
+        from_dict = core_schema.no_info_after_validator_function(cls, as_dict)
+        return core_schema.json_or_python_schema(
+            json_schema=from_dict,
+            python_schema=core_schema.union_schema([core_schema.is_instance_schema(cls), from_dict]),
+            serialization=core_schema.plain_serializer_function_ser_schema(
+                lambda vector: dict(vector.items()), return_schema=as_dict))
+
+
+def pack_vectors(vectors: Dict[str, TopicVector]) -> Dict[str, Any]:
+    """Stored form of a set of vectors, all rebased into the current layout."""
+    layout = current_layout()
+    packed: Dict[str, Any] = {"layout": layout.version}
+    extra = {}
+    for name, vector in vectors.items():
+        vector.rebase(layout)
+        packed[name] = vector.pack()
+        if vector.extra:
+            extra[name] = dict(vector.extra)
+    if extra:
+        packed["extra"] = extra
+    return packed
+
+
+def unpack_vectors(packed: Dict[str, Any], names: Sequence[str]) -> Dict[str, TopicVector]:
+    version = packed.get("layout", EMPTY_LAYOUT.version)
+    extra = packed.get("extra") or {}
+    return {name: TopicVector.unpack(version, packed.get(name), extra.get(name)) for name in names}
+
+
+def expand_vectors(stored_state: Dict[str, Any]) -> Dict[str, Any]:
+    """A stored state with its packed vectors expanded into plain topic -> value dicts, for raw-document readers."""
+    packed = stored_state.get("vectors")
+    if not isinstance(packed, dict):
+        return stored_state
+    view = {k: v for k, v in stored_state.items() if k != "vectors"}
+    names = [k for k in packed if k not in ("layout", "extra")]
+    for name, vector in unpack_vectors(packed, names).items():
+        view[name] = dict(vector.items())
+    return view
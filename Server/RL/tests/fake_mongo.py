@@ -0,0 +1,180 @@
+"""In-memory stand-in for the subset of motor's collection API the stores use."""
+import copy
+from types import SimpleNamespace
+
+from pymongo.errors import DuplicateKeyError
+
+_MISSING = object()
+
+
+def _get(doc, path):
+    for part in path.split("."):
+        if not isinstance(doc, dict) or part not in doc:
+            return _MISSING
+        doc = doc[part]
+    return doc
+
+
+def _matches_value(value, condition):
+    if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+        for op, arg in condition.items():
+            if op == "$in":
+                if not any((value is _MISSING and a is None) or value == a for a in arg):
+                    return False
+            elif op == "$ne":
+                if value is not _MISSING and value == arg:
+                    return False
+            else:
+                raise NotImplementedError(op)
+        return True
+    return value is not _MISSING and value == condition
+
+
+def matches(doc, query):
+    return all(_matches_value(_get(doc, path), condition) for path, condition in query.items())
+
+
+def _project(doc, projection):
+    doc = copy.deepcopy(doc)
+    if not projection:
+        return doc
+    include_id = projection.get("_id", 1)
+    fields = {k: v for k, v in projection.items() if k != "_id"}
+    if fields:
+        projected = {}
+        for field, spec in fields.items():
+            if field not in doc:
+                continue
+            if isinstance(spec, dict) and "$slice" in spec:
+                n = spec["$slice"]
+                projected[field] = doc[field][n:] if n < 0 else doc[field][:n]
+            else:
+                projected[field] = doc[field]
+        if "_id" in doc:
+            projected["_id"] = doc["_id"]
+        doc = projected
+    if not include_id:
+        doc.pop("_id", None)
+    return doc
+
+
+def _parent(doc, path, array_filters):
+    """(container, key) pairs a dotted path resolves to, creating intermediate dicts."""
+    targets = [doc]
+    parts = path.split(".")
+    for part in parts[:-1]:
+        next_targets = []
+        for target in targets:
+            if part.startswith("$[") and part.endswith("]"):
+                name = part[2:-1]
+                condition = {k[len(name) + 1:]: v for f in array_filters for k, v in f.items()
+                             if k.startswith(name + ".")}
+                next_targets.extend(e for e in target if isinstance(e, dict) and matches(e, condition))
+            else:
+                next_targets.append(target.setdefault(part, {}))
+        targets = next_targets
+    last = parts[-1]
+    if last.startswith("$[") and last.endswith("]"):
+        name = last[2:-1]
+        condition = {k[len(name) + 1:]: v for f in array_filters for k, v in f.items() if k.startswith(name + ".")}
+        return [(t, i) for t in targets for i, e in enumerate(t) if isinstance(e, dict) and matches(e, condition)]
+    return [(t, last) for t in targets]
+
+
+def apply_update(doc, update, array_filters=None, inserting=False):
+    array_filters = array_filters or []
+    for path, value in update.get("$set", {}).items():
+        for container, key in _parent(doc, path, array_filters):
+            container[key] = copy.deepcopy(value)
+    if inserting:
+        for path, value in update.get("$setOnInsert", {}).items():
+            for container, key in _parent(doc, path, array_filters):
+                container[key] = copy.deepcopy(value)
+    for path in update.get("$unset", {}):
+        for container, key in _parent(doc, path, array_filters):
+            container.pop(key, None)
+    for path, amount in update.get("$inc", {}).items():
+        for container, key in _parent(doc, path, array_filters):
+            container[key] = (container.get(key) or 0) + amount
+    for path, spec in update.get("$push", {}).items():
+        for container, key in _parent(doc, path, array_filters):
+            items = container.setdefault(key, [])
+            items.extend(copy.deepcopy(spec["$each"]) if isinstance(spec, dict) else [copy.deepcopy(spec)])
+            if isinstance(spec, dict) and "$slice" in spec:
+                n = spec["$slice"]
+                container[key] = items[n:] if n < 0 else items[:n]
+
+
+class _Cursor:
+    def __init__(self, docs):
+        self._docs = docs
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self._docs:
+            yield doc
+
+
+class FakeCollection:
+    """Documents in a list; `unique` names the fields of a unique index checked on insert."""
+
+    def __init__(self, docs=(), unique=()):
+        self.docs = [copy.deepcopy(d) for d in docs]
+        self.unique = tuple(unique)
+        self._next_id = 0
+        for doc in self.docs:
+            self._assign_id(doc)
+        self.calls = []
+
+    def _assign_id(self, doc):
+        if "_id" not in doc:
+            self._next_id += 1
+            doc["_id"] = self._next_id
+
+    def _insert(self, doc):
+        if self.unique and any(all(d.get(f) == doc.get(f) for f in self.unique) for d in self.docs):
+            raise DuplicateKeyError(f"duplicate key on {self.unique}")
+        self._assign_id(doc)
+        self.docs.append(doc)
+        return doc
+
+    def _first(self, query):
+        return next((d for d in self.docs if matches(d, query)), None)
+
+    def _update(self, query, update, upsert=False, array_filters=None):
+        self.calls.append(("update", query, update))
+        doc = self._first(query)
+        if doc is not None:
+            apply_update(doc, update, array_filters)
+            return doc, SimpleNamespace(matched_count=1, upserted_id=None)
+        if not upsert:
+            return None, SimpleNamespace(matched_count=0, upserted_id=None)
+        doc = {k: copy.deepcopy(v) for k, v in query.items() if not isinstance(v, dict)}
+        apply_update(doc, update, array_filters, inserting=True)
+        self._insert(doc)
+        return doc, SimpleNamespace(matched_count=0, upserted_id=doc["_id"])
+
+    async def find_one(self, query, projection=None):
+        self.calls.append(("find_one", query, projection))
+        doc = self._first(query)
+        return None if doc is None else _project(doc, projection)
+
+    def find(self, query, projection=None):
+        return _Cursor([_project(d, projection) for d in self.docs if matches(d, query)])
+
+    async def find_one_and_update(self, query, update, projection=None, upsert=False, return_document=None):
+        doc, _ = self._update(query, update, upsert=upsert)
+        return None if doc is None else _project(doc, projection)
+
+    async def update_one(self, query, update, upsert=False):
+        return self._update(query, update, upsert=upsert)[1]
+
+    async def bulk_write(self, ops, ordered=True):
+        matched = upserted = 0
+        for op in ops:
+            _, result = self._update(op._filter, op._doc, upsert=op._upsert, array_filters=op._array_filters)
+            matched += result.matched_count
+            upserted += result.upserted_id is not None
+        return SimpleNamespace(matched_count=matched, upserted_count=upserted)
@@ -0,0 +1,40 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+th = pytest.importorskip("torch")
+pytest.importorskip("gymnasium")
+pytest.importorskip("stable_baselines3")
+
+from ncert_tutor import NCERTLearningSystem  # noqa: E402
+from distributed_rollouts import ActorLearnerTrainer  # noqa: E402
+
+
+@pytest.fixture
+def system(tmp_path):
+    return NCERTLearningSystem(num_students=2, max_steps=20, log_dir=str(tmp_path), num_cpu=1,
+                               use_action_masking=False)
+
+
+def test_previous_learning_rate_reaches_the_optimizer(system):
+    system.create_model(learning_rate=3e-4, ent_coef=0.02, verbose=0)
+    previous = system.model
+    trainer = ActorLearnerTrainer(system, address="127.0.0.1:0", num_workers=1, envs_per_worker=1,
+                                  authkey="test")
+    model = trainer.model
+    assert model is not previous
+    assert model.lr_schedule(1.0) == pytest.approx(3e-4)
+    assert model.ent_coef == pytest.approx(0.02)
+    assert all(group["lr"] == pytest.approx(3e-4) for group in model.policy.optimizer.param_groups)
+
+
+def test_local_worker_rollouts_drive_a_learn_step(system):
+    trainer = ActorLearnerTrainer(system, address="127.0.0.1:0", num_workers=1, envs_per_worker=1,
+                                  authkey="test")
+    try:
+        trainer.spawn_local_workers()
+        trainer.accept_workers()
+        trainer.model.learn(total_timesteps=1)
+    finally:
+        trainer.close()
+    assert trainer.model.num_timesteps == trainer.model.n_steps
+    assert not trainer.worker_processes
@@ -0,0 +1,51 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from embedding_service import EmbeddingService, TokenBucket  # noqa: E402
+
+
+class FlakyEmbeddings:
+    """embeddings.create stand-in that fails its first `failures` calls."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = []
+
+    def create(self, model, inputs):
+        self.calls.append(list(inputs))
+        if len(self.calls) <= self.failures:
+            raise RuntimeError("upstream unavailable")
+        return SimpleNamespace(data=[SimpleNamespace(index=i, embedding=[float(len(t)), 1.0])
+                                     for i, t in enumerate(inputs)])
+
+
+def make_service(failures, max_retries):
+    embeddings = FlakyEmbeddings(failures)
+    service = EmbeddingService(SimpleNamespace(embeddings=embeddings), "test-model",
+                               rate_limiter=TokenBucket(rate=1000.0, capacity=100.0),
+                               batch_window=0.001, max_retries=max_retries, retry_backoff=0.0)
+    return service, embeddings
+
+
+def test_concurrent_texts_share_one_batch():
+    service, embeddings = make_service(failures=0, max_retries=0)
+    results = asyncio.run(service.embed_many(["ab", "abc", "ab"]))
+    assert results == [[2.0, 1.0], [3.0, 1.0], [2.0, 1.0]]
+    assert embeddings.calls == [["ab", "abc"]]
+
+
+def test_failed_batch_is_retried():
+    service, embeddings = make_service(failures=2, max_retries=2)
+    assert asyncio.run(service.embed_many(["ab", "abc"])) == [[2.0, 1.0], [3.0, 1.0]]
+    assert len(embeddings.calls) == 3
+    assert service.stats()["retries"] == 2
+
+
+def test_callers_get_none_once_retries_are_exhausted():
+    service, embeddings = make_service(failures=5, max_retries=1)
+    assert asyncio.run(service.embed_many(["ab"])) == [None]
+    assert len(embeddings.calls) == 2
@@ -0,0 +1,99 @@
+import asyncio
+import copy
+
+import pytest
+
+pytest.importorskip("pymongo")
+
+from fake_mongo import FakeCollection  # noqa: E402
+from interaction_store import MIGRATED_FIELD, InteractionStore, assign_legacy_ids  # noqa: E402
+
+
+def legacy_entry(second, interaction_id=None):
+    entry = {"timestamp_utc": f"2024-01-01T00:00:{second:02d}+00:00", "topic": "algebra"}
+    if interaction_id:
+        entry["interaction_id"] = interaction_id
+    return entry
+
+
+def legacy_session(student_id, path_length, version=None):
+    doc = {"student_id": student_id, "learning_path": [legacy_entry(n) for n in range(path_length)]}
+    if version is not None:
+        doc["version"] = version
+    return doc
+
+
+def interactions():
+    return FakeCollection(unique=("student_id", "interaction_id"))
+
+
+def test_legacy_ids_are_deterministic_and_keep_existing_ones():
+    path = [legacy_entry(1), legacy_entry(1), legacy_entry(2, "kept"), "not an entry"]
+    again = copy.deepcopy(path)
+    assign_legacy_ids("s1", path)
+    assign_legacy_ids("s1", again)
+    assert path == again
+    assert path[2]["interaction_id"] == "kept"
+    # Entries sharing a timestamp are told apart by their position among them.
+    assert path[0]["interaction_id"] != path[1]["interaction_id"]
+
+    other = [legacy_entry(1)]
+    assign_legacy_ids("s2", other)
+    assert other[0]["interaction_id"] != path[0]["interaction_id"]
+
+
+def test_record_many_skips_stored_entries():
+    store = InteractionStore(interactions())
+    path = [legacy_entry(n) for n in range(3)]
+    assert asyncio.run(store.record_many("s1", path)) == 3
+    assert asyncio.run(store.record_many("s1", path + [legacy_entry(3)])) == 1
+    assert len(store.collection.docs) == 4
+    assert all(d["timestamp"].tzinfo is not None for d in store.collection.docs)
+
+
+def test_migration_copies_trims_and_is_idempotent():
+    sessions = FakeCollection([legacy_session("s1", 5, version=2), legacy_session("s2", 1)])
+    store = InteractionStore(interactions())
+
+    results = asyncio.run(store.migrate_embedded_paths(sessions, tail=2))
+    assert results == {"sessions": 2, "copied": 6, "trimmed": 1, "changed": 0, "errors": 0}
+    s1, s2 = sessions.docs
+    assert [e["timestamp_utc"] for e in s1["learning_path"]] == [legacy_entry(3)["timestamp_utc"],
+                                                                 legacy_entry(4)["timestamp_utc"]]
+    assert s1[MIGRATED_FIELD] and s2[MIGRATED_FIELD]
+    assert (s1["version"], s2["version"]) == (3, 1)
+    # The trimmed tail keeps the ids its copies were stored under.
+    stored_ids = {d["interaction_id"] for d in store.collection.docs}
+    assert {e["interaction_id"] for e in s1["learning_path"]} <= stored_ids
+
+    assert asyncio.run(store.migrate_embedded_paths(sessions, tail=2))["sessions"] == 0
+
+
+def test_rerunning_an_interrupted_migration_copies_nothing_twice():
+    original = legacy_session("s1", 4)
+    store = InteractionStore(interactions())
+    asyncio.run(store.migrate_embedded_paths(FakeCollection([original]), tail=1))
+
+    # As if the trim had not happened: the same untrimmed document is migrated again.
+    results = asyncio.run(store.migrate_embedded_paths(FakeCollection([original]), tail=1))
+    assert results["copied"] == 0
+    assert len(store.collection.docs) == 4
+
+
+class ConcurrentlySavedSessions(FakeCollection):
+    """Session collection where another worker saves each document right after the migration reads it."""
+
+    def find(self, query, projection=None):
+        cursor = super().find(query, projection)
+        for doc in self.docs:
+            doc["version"] = (doc.get("version") or 0) + 1
+        return cursor
+
+
+def test_migration_leaves_sessions_saved_meanwhile_untrimmed():
+    sessions = ConcurrentlySavedSessions([legacy_session("s1", 3, version=1)])
+    store = InteractionStore(interactions())
+    results = asyncio.run(store.migrate_embedded_paths(sessions, tail=1))
+    assert results["changed"] == 1 and results["trimmed"] == 0 and results["copied"] == 3
+    assert len(sessions.docs[0]["learning_path"]) == 3
+    assert MIGRATED_FIELD not in sessions.docs[0]
@@ -0,0 +1,49 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+th = pytest.importorskip("torch")
+pytest.importorskip("stable_baselines3")
+spaces = pytest.importorskip("gymnasium.spaces")
+
+from stable_baselines3.common.policies import ActorCriticPolicy  # noqa: E402
+
+from policy_inference import CompiledPolicy  # noqa: E402
+
+
+@pytest.fixture
+def policy_and_obs():
+    th.manual_seed(0)
+    observation_space = spaces.Box(low=0.0, high=1.0, shape=(12,), dtype=np.float32)
+    action_space = spaces.MultiDiscrete([3, 5, 2])
+    policy = ActorCriticPolicy(observation_space, action_space, lr_schedule=lambda _: 1e-3,
+                               net_arch=dict(pi=[16, 16], vf=[16]))
+    policy.eval()
+    observations = np.random.default_rng(0).random((64, 12), dtype=np.float32)
+    return policy, action_space.nvec, observations
+
+
+def test_torchscript_policy_matches_eager(policy_and_obs):
+    policy, nvec, observations = policy_and_obs
+    compiled = CompiledPolicy(policy, nvec, observations[0], backend="torchscript")
+    report = compiled.verify(observations)
+    assert report["passed"]
+    assert report["action_agreement"] == 1.0
+    assert report["max_abs_logprob_diff"] <= 1e-4
+    actions, _ = compiled.predict(observations[0])
+    assert actions.shape == (len(nvec),)
+
+
+def test_bf16_check_requires_close_logprobs_and_agreement(policy_and_obs):
+    policy, nvec, observations = policy_and_obs
+    compiled = CompiledPolicy(policy, nvec, observations[0], backend="torchscript")
+    compiled.dtype = th.bfloat16
+    exact = compiled.module
+    compiled.module = lambda obs: exact(obs.float())
+    assert compiled.verify(observations)["passed"]
+
+    # Scaling keeps every greedy action but moves the log-probabilities far apart
+    # (SB3 initialises the action head with gain 0.01, so raw logits are tiny).
+    compiled.module = lambda obs: exact(obs.float()) * 1000.0
+    report = compiled.verify(observations)
+    assert report["action_agreement"] == 1.0
+    assert not report["passed"]
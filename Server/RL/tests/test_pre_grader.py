@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from pre_grader import PreGrader, ordered_match  # noqa: E402
+
+REFERENCE = "Plants absorb carbon dioxide and release oxygen"
+
+
+def grade(response, reference=REFERENCE, **kwargs):
+    return asyncio.run(PreGrader(**kwargs).grade(response, reference))
+
+
+def test_exact_and_empty_answers():
+    assert grade("Na", "Na").tier == "exact"
+    assert grade("none", "None").correct
+    result = grade("idk", "Sodium")
+    assert result.tier == "empty" and not result.correct
+
+
+def test_near_exact_answer_is_accepted_lexically():
+    result = grade("plants absorb carbon dioxide and then release oxygen")
+    assert result.tier == "lexical" and result.correct
+
+
+def test_swapped_terms_go_to_llm():
+    assert ordered_match("Plants absorb oxygen and release carbon dioxide", REFERENCE) < 0.85
+    assert grade("Plants absorb oxygen and release carbon dioxide") is None
+
+
+def test_antonym_and_guards_go_to_llm():
+    assert grade("The sun rises in the west", "The sun rises in the east") is None
+    assert grade("It is not a conductor", "It is a conductor") is None
+    assert grade("42", "24") is None
+
+
+def test_embedding_tier_only_rejects():
+    vectors = {"photosynthesis": [1.0, 0.0], "volcano": [0.0, 1.0], "the sun rises in the west": [1.0, 0.0],
+               "the sun rises in the east": [1.0, 0.0]}
+
+    async def embed(text):
+        return vectors[text]
+
+    rejected = grade("volcano", "photosynthesis", embed=embed)
+    assert rejected.tier == "embedding" and not rejected.correct
+    # Identical embeddings never accept on their own.
+    assert grade("The sun rises in the west", "The sun rises in the east", embed=embed) is None
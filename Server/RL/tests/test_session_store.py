@@ -0,0 +1,294 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("pymongo")
+routes = pytest.importorskip("adaptive_content_routes_v3")
+
+import state_vectors  # noqa: E402
+from fake_mongo import FakeCollection  # noqa: E402
+from session_store import SessionStore, session_update_ops  # noqa: E402
+
+TOPICS = ("algebra", "fractions", "geometry")
+# Bookkeeping fields the store keeps next to the session itself.
+STORE_FIELDS = {"_id", "version", "write_id", "created_at"}
+
+
+@pytest.fixture(autouse=True)
+def layout(monkeypatch):
+    monkeypatch.setattr(state_vectors, "_layouts", dict(state_vectors._layouts))
+    monkeypatch.setattr(state_vectors, "_current", state_vectors._current)
+    return state_vectors.register_layout(TOPICS, make_current=True)
+
+
+def make_session(student_id="s1"):
+    return routes.StudentSessionData(student_id=student_id, profile=routes.StudentProfile(student_id=student_id),
+                                     state=routes.StudentState())
+
+
+def entry(n):
+    return {"interaction_id": f"i{n}", "timestamp_utc": f"2024-01-01T00:00:{n:02d}+00:00", "topic": "algebra"}
+
+
+def persisted_session(path_length=0):
+    session = make_session()
+    session.learning_path = [entry(n) for n in range(path_length)]
+    session.mark_persisted(version=1)
+    return session
+
+
+def stored(collection, student_id="s1"):
+    doc = next(d for d in collection.docs if d["student_id"] == student_id)
+    return {k: v for k, v in doc.items() if k not in STORE_FIELDS}
+
+
+def expected(session):
+    return {k: v for k, v in session.persisted_document().items() if k not in STORE_FIELDS}
+
+
+def make_store(collection, **kwargs):
+    kwargs.setdefault("flush_delay", 0)
+    return SessionStore(collection, routes.StudentSessionData, **kwargs)
+
+
+def test_update_ops_guard_edits_by_version_and_push_appends_by_write_id():
+    delta = routes.SessionDelta(sets={"state.engagement": 0.5}, unsets={"analytics.stale": ""},
+                                entry_updates=[("i1", entry(1))], new_entries=[entry(2)], path_length=3,
+                                trimmed=False, full_path=None, stored={})
+    edit, push = session_update_ops("s1", delta, version=4)
+    assert edit._filter == {"student_id": "s1", "version": 4}
+    sets = edit._doc["$set"]
+    assert sets["state.engagement"] == 0.5 and sets["learning_path.$[e0]"] == entry(1)
+    assert edit._doc["$unset"] == {"analytics.stale": ""}
+    assert edit._doc["$inc"] == {"version": 1}
+    assert edit._array_filters == [{"e0.interaction_id": "i1"}]
+    assert push._filter == {"student_id": "s1", "write_id": sets["write_id"]}
+    assert push._doc == {"$push": {"learning_path": {"$each": [entry(2)], "$slice": -3}}}
+
+
+def test_update_ops_version_guard_forms():
+    delta = routes.SessionDelta({"last_active": "x"}, {}, [], [], 0, False, None, {})
+    (unversioned,) = session_update_ops("s1", delta, version=0)
+    assert unversioned._filter == {"student_id": "s1", "version": {"$in": [None, 0]}}
+    (unguarded,) = session_update_ops("s1", delta)
+    assert unguarded._filter == {"student_id": "s1"}
+    assert unguarded._array_filters is None
+
+
+def test_delta_is_empty_right_after_mark_persisted():
+    assert persisted_session(path_length=3).persistence_delta().empty
+
+
+def test_delta_sets_changed_fields_only():
+    session = persisted_session()
+    session.state.engagement = 0.25
+    session.state.mastery["algebra"] = 0.6
+    session.analytics["per_topic_analytics"] = {"algebra": {"attempts": 1}}
+    delta = session.persistence_delta()
+    assert set(delta.sets) == {"state.engagement", "state.vectors.mastery", "analytics.per_topic_analytics"}
+    assert delta.sets["state.engagement"] == 0.25
+    assert not (delta.unsets or delta.entry_updates or delta.new_entries or delta.trimmed)
+    assert delta.full_path is None
+
+
+def test_delta_unsets_removed_keys():
+    session = make_session()
+    session.analytics = {"keep": 1, "drop": 2}
+    session.mark_persisted(version=1)
+    del session.analytics["drop"]
+    delta = session.persistence_delta()
+    assert delta.unsets == {"analytics.drop": ""}
+    assert not delta.sets
+
+
+def test_delta_updates_changed_entries_by_interaction_id_and_appends_new_ones():
+    session = persisted_session(path_length=3)
+    session.learning_path[1]["feedback_details"] = {"rating": 4}
+    session.learning_path.append(entry(3))
+    delta = session.persistence_delta()
+    assert delta.entry_updates == [("i1", session.learning_path[1])]
+    assert delta.new_entries == [entry(3)]
+    assert delta.path_length == 4 and not delta.trimmed and delta.full_path is None
+
+
+def test_delta_trims_a_pruned_path_with_slice():
+    session = persisted_session(path_length=3)
+    session.learning_path.append(entry(3))
+    session.prune_learning_path(max_entries=2)
+    delta = session.persistence_delta()
+    assert delta.new_entries == [entry(3)]
+    assert delta.path_length == 2 and delta.trimmed
+    assert not delta.empty
+
+
+def test_delta_falls_back_to_the_full_path():
+    session = persisted_session(path_length=3)
+    session.learning_path[1] = entry(7)
+    assert session.persistence_delta().full_path == session.learning_path
+
+    session = persisted_session(path_length=2)
+    session.learning_path[1]["interaction_id"] = "i0"
+    session.mark_persisted(version=1)
+    session.learning_path[1]["topic"] = "fractions"
+    # Duplicate ids can't be addressed with an array filter.
+    assert session.persistence_delta().full_path == session.learning_path
+
+
+def test_saved_deltas_reproduce_the_full_document():
+    collection = FakeCollection(unique=("student_id",))
+    store = make_store(collection)
+
+    async def scenario():
+        async def first(session):
+            session.learning_path.extend(entry(n) for n in range(3))
+            session.analytics["note"] = "x"
+        await store.update("s1", first, create=make_session)
+
+        async def second(session):
+            session.state.mastery["geometry"] = 0.7
+            session.state.interaction_counter += 1
+            session.learning_path[2]["feedback_details"] = {"rating": 5}
+            session.learning_path.extend([entry(3), entry(4)])
+            session.prune_learning_path(max_entries=4)
+            del session.analytics["note"]
+        session, _ = await store.update("s1", second)
+        return session
+
+    session = asyncio.run(scenario())
+    assert stored(collection) == expected(session)
+    assert [e["interaction_id"] for e in stored(collection)["learning_path"]] == ["i1", "i2", "i3", "i4"]
+    assert collection.docs[0]["version"] == 2
+
+
+def test_conflicting_write_reloads_and_reruns_pending_mutations():
+    collection = FakeCollection(unique=("student_id",))
+    worker_a, worker_b = make_store(collection), make_store(collection)
+
+    async def practice(session):
+        session.state.interaction_counter += 1
+        return session.state.interaction_counter
+
+    async def scenario():
+        await worker_a.update("s1", practice, create=make_session)
+        await worker_b.update("s1", practice)
+        # worker_a's cached copy is a version behind; its write conflicts and is re-run on a reload.
+        return await worker_a.update("s1", practice)
+
+    session, result = asyncio.run(scenario())
+    # The caller gets the reloaded copy that was written, and the re-run's result.
+    assert session.state.interaction_counter == result == 3
+    assert stored(collection)["state"]["interaction_counter"] == 3
+    assert (worker_a.conflicts, worker_a.replays, worker_a.dropped) == (1, 1, 0)
+    assert session.persisted_version == 3
+
+
+def test_changes_that_cannot_be_rerun_are_dropped_on_conflict():
+    collection = FakeCollection(unique=("student_id",))
+    worker_a, worker_b = make_store(collection), make_store(collection)
+
+    async def practice(session):
+        session.state.interaction_counter += 1
+
+    async def scenario():
+        session, _ = await worker_a.update("s1", practice, create=make_session)
+        await worker_b.update("s1", practice)
+        session.state.engagement = 0.1
+        await worker_a.save(session)
+
+    asyncio.run(scenario())
+    assert worker_a.dropped == 1
+    assert stored(collection)["state"]["interaction_counter"] == 2
+    assert worker_a.cached("s1") is None
+
+
+def test_creating_an_existing_session_conflicts_and_reruns_on_the_stored_one():
+    collection = FakeCollection(unique=("student_id",))
+    worker_a, worker_b = make_store(collection), make_store(collection)
+
+    async def practice(session):
+        session.state.interaction_counter += 1
+
+    async def scenario():
+        await worker_b.update("s1", practice, create=make_session)
+        worker_a._cache.set("s1", make_session())
+        return (await worker_a.update("s1", practice))[0]
+
+    session = asyncio.run(scenario())
+    assert session.state.interaction_counter == 2
+    assert worker_a.replays == 1
+
+
+def test_failed_mutation_is_discarded_and_earlier_pending_ones_rerun():
+    collection = FakeCollection(unique=("student_id",))
+    store = make_store(collection, flush_delay=60)
+
+    async def practice(session):
+        session.state.interaction_counter += 1
+
+    async def broken(session):
+        session.state.engagement = 0.05
+        raise RuntimeError("half applied")
+
+    async def scenario():
+        await store.update("s1", practice, create=make_session)
+        await store.update("s1", practice)
+        with pytest.raises(RuntimeError):
+            await store.update("s1", broken)
+        cached = store.cached("s1")
+        await store.close()
+        return cached
+
+    cached = asyncio.run(scenario())
+    assert cached.state.interaction_counter == 2
+    assert cached.state.engagement != 0.05
+    state = stored(collection)["state"]
+    assert state["interaction_counter"] == 2 and state["engagement"] != 0.05
+
+
+def test_cached_current_rechecks_the_stored_version():
+    collection = FakeCollection(unique=("student_id",))
+    reader, writer = make_store(collection, version_check_ttl=60), make_store(collection)
+
+    async def practice(session):
+        session.state.interaction_counter += 1
+
+    async def scenario():
+        await reader.update("s1", practice, create=make_session)
+        first = await reader.cached_current("s1")
+        checks = reader.version_checks
+        await writer.update("s1", practice)
+        # Within the TTL the cached copy is trusted without a read.
+        assert await reader.cached_current("s1") is first
+        assert reader.version_checks == checks
+        reader._checked.clear()
+        return await reader.cached_current("s1")
+
+    assert asyncio.run(scenario()) is None
+    assert reader.stale == 1
+
+
+def test_legacy_time_since_last_practiced_is_converted_to_steps():
+    state = routes.StudentState.model_validate(
+        {"time_since_last_practiced": {"algebra": 2.0, "geometry": 5.0}, "mastery": {"algebra": 0.4}})
+    assert state.interaction_counter == 5
+    assert dict(state.last_practiced_step) == {"algebra": 3.0, "geometry": 0.0}
+    assert state.time_since_practiced("algebra") == 2.0
+    assert state.time_since_practiced("fractions") is None
+    assert state.mastery["algebra"] == pytest.approx(0.4)
+
+
+def test_legacy_state_is_rewritten_packed_on_the_next_save():
+    legacy = {"student_id": "s1", "profile": {"student_id": "s1"}, "learning_path": [],
+              "state": {"mastery": {"algebra": 0.4}, "time_since_last_practiced": {"algebra": 2.0}}}
+    collection = FakeCollection([legacy], unique=("student_id",))
+    store = make_store(collection)
+
+    async def practice(session):
+        session.state.interaction_counter += 1
+
+    session, _ = asyncio.run(store.update("s1", practice))
+    state = stored(collection)["state"]
+    assert "time_since_last_practiced" not in state and "mastery" not in state
+    assert state == session.state.packed()
+    assert state["vectors"]["layout"] == state_vectors.current_layout().version
@@ -0,0 +1,125 @@
+import asyncio
+import math
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pydantic = pytest.importorskip("pydantic")
+pytest.importorskip("pymongo")
+
+import state_vectors  # noqa: E402
+from fake_mongo import FakeCollection  # noqa: E402
+from state_vectors import (TopicLayout, TopicVector, ensure_layout, expand_vectors, get_layout,  # noqa: E402
+                           pack_vectors, register_layout, sync_layouts, unpack_vectors)
+
+
+@pytest.fixture(autouse=True)
+def isolated_layouts(monkeypatch):
+    monkeypatch.setattr(state_vectors, "_layouts", dict(state_vectors._layouts))
+    monkeypatch.setattr(state_vectors, "_current", state_vectors._current)
+    monkeypatch.setattr(state_vectors, "_collection", None)
+
+
+@pytest.fixture
+def layout():
+    return register_layout(("algebra", "fractions", "geometry"), make_current=True)
+
+
+def test_vector_behaves_like_a_dict(layout):
+    vector = TopicVector({"algebra": 0.5, "statistics": 0.25})
+    assert vector["algebra"] == 0.5 and vector["statistics"] == 0.25
+    assert "fractions" not in vector and vector.get("fractions") is None
+    assert dict(vector) == {"algebra": 0.5, "statistics": 0.25}
+    assert len(vector) == 2
+    del vector["algebra"]
+    with pytest.raises(KeyError):
+        del vector["algebra"]
+    assert list(vector) == ["statistics"]
+
+
+def test_pack_unpack_round_trip(layout):
+    vector = TopicVector({"geometry": 0.75, "algebra": 0.125, "statistics": 2.0})
+    data = vector.pack()
+    assert len(data) == 4 * len(layout)
+    restored = TopicVector.unpack(layout.version, data, vector.extra)
+    assert dict(restored) == dict(vector)
+    assert math.isnan(restored.values[layout.index["fractions"]])
+    restored["fractions"] = 0.5
+    assert "fractions" not in vector
+
+
+def test_unpack_rejects_a_vector_of_the_wrong_size(layout):
+    with pytest.raises(ValueError):
+        TopicVector.unpack(layout.version, np.zeros(2, dtype=state_vectors.VECTOR_DTYPE).tobytes())
+    with pytest.raises(ValueError):
+        TopicVector.unpack("unknown", b"")
+
+
+def test_rebase_moves_values_and_overflows_missing_topics(layout):
+    vector = TopicVector({"algebra": 0.5, "geometry": 0.25, "statistics": 1.0})
+    smaller = TopicLayout(("statistics", "algebra"))
+    vector.rebase(smaller)
+    assert vector.layout is smaller
+    assert vector.values.tolist() == [1.0, 0.5]
+    assert vector.extra == {"geometry": 0.25}
+    assert dict(vector) == {"statistics": 1.0, "algebra": 0.5, "geometry": 0.25}
+    assert vector.as_array(layout, fill=-1.0).tolist() == [0.5, -1.0, 0.25]
+
+
+def test_pack_vectors_rebases_into_the_current_layout(layout):
+    old = register_layout(("geometry", "algebra"))
+    mastery = TopicVector({"algebra": 0.5, "statistics": 0.75}, layout=old)
+    attempts = TopicVector({"geometry": 3.0}, layout=old)
+    packed = pack_vectors({"mastery": mastery, "attempts": attempts})
+    assert packed["layout"] == layout.version
+    assert packed["extra"] == {"mastery": {"statistics": 0.75}}
+    restored = unpack_vectors(packed, ["mastery", "attempts"])
+    assert dict(restored["mastery"]) == {"algebra": 0.5, "statistics": 0.75}
+    assert dict(restored["attempts"]) == {"geometry": 3.0}
+    view = expand_vectors({"interaction_counter": 4, "vectors": packed})
+    assert view == {"interaction_counter": 4, "mastery": {"algebra": 0.5, "statistics": 0.75},
+                    "attempts": {"geometry": 3.0}}
+
+
+def test_vectors_validate_and_serialise_as_dicts(layout):
+    class State(pydantic.BaseModel):
+        mastery: TopicVector = pydantic.Field(default_factory=TopicVector)
+
+    state = State.model_validate({"mastery": {"algebra": 0.5}})
+    assert isinstance(state.mastery, TopicVector)
+    assert state.model_dump() == {"mastery": {"algebra": 0.5}}
+    assert State.model_validate_json(state.model_dump_json()).mastery["algebra"] == 0.5
+
+
+def test_ensure_layout_fetches_layouts_written_by_other_workers(layout):
+    topics = ("algebra", "probability")
+    version = TopicLayout(topics).version
+    collection = FakeCollection([{"version": version, "topics": list(topics)}])
+    state_vectors._collection = collection
+    asyncio.run(ensure_layout({"vectors": {"layout": version}}))
+    assert get_layout(version).topics == topics
+
+    # Known layouts and unpacked states don't read the collection.
+    collection.calls.clear()
+    asyncio.run(ensure_layout({"vectors": {"layout": version}}))
+    asyncio.run(ensure_layout({"mastery": {"algebra": 0.5}}))
+    assert collection.calls == []
+
+
+def test_ensure_layout_ignores_mismatched_or_missing_layouts(layout):
+    state_vectors._collection = FakeCollection([{"version": "deadbeefdeadbeef", "topics": ["algebra"]}])
+    asyncio.run(ensure_layout({"vectors": {"layout": "deadbeefdeadbeef"}}))
+    asyncio.run(ensure_layout({"vectors": {"layout": "0000000000000000"}}))
+    with pytest.raises(ValueError):
+        get_layout("deadbeefdeadbeef")
+
+
+def test_sync_layouts_loads_stored_layouts_and_records_the_current_one():
+    stored = TopicLayout(("geometry",))
+    collection = FakeCollection([{"version": stored.version, "topics": ["geometry"]}])
+    current = asyncio.run(sync_layouts(collection, {"fractions": 1, "algebra": 0}))
+    assert current.topics == ("algebra", "fractions")
+    assert get_layout(stored.version).topics == ("geometry",)
+    assert {d["version"] for d in collection.docs} == {stored.version, current.version}
+    asyncio.run(sync_layouts(collection, {"fractions": 1, "algebra": 0}))
+    assert len(collection.docs) == 2